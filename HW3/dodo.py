@@ -1,6 +1,7 @@
 """Run or update the project. This file uses the `doit` Python package. It works
 like a Makefile, but is Python-based
 """
+import shutil
 import sys
 sys.path.insert(1, './src/')
 
@@ -40,6 +41,19 @@ def jupyter_clear_output(notebook):
 #     shutil.copy(env_example_file, env_file)
 
 
+def remove_targets(targets):
+    """Clean action that removes the `targets` of a task, including the
+    year-partitioned parquet datasets (directories) written by the pulls,
+    which doit's own clean leaves in place when not empty.
+    """
+    for target in targets:
+        path = Path(target)
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+
+
 def task_pull_CRSP_Compustat():
     """Pull CRSP/Compustat data from WRDS and save to disk
     """
@@ -70,7 +84,39 @@ def task_pull_CRSP_Compustat():
         ],
         "targets": targets,
         "file_dep": file_dep,
-        "clean": True,
+        "clean": [remove_targets],
+        "verbosity": 2, # Print everything immediately. This is important in
+        # case WRDS asks for credentials.
+    }
+
+
+def task_pull_CRSP_daily_stock():
+    """Pull the CRSP daily stock file from WRDS, one year at a time, and
+    save it to disk partitioned by year
+    """
+    def pull_CRSP_daily_stock():
+        import load_CRSP_Compustat
+
+        load_CRSP_Compustat.pull_CRSP_daily_stock_ciz(
+            data_dir=DATA_DIR, incremental=config.INCREMENTAL_PULLS
+        )
+
+    file_dep = [
+        "./src/config.py",
+        "./src/load_CRSP_Compustat.py",
+        ]
+    targets = [
+        ## src/load_CRSP_Compustat.py, partitioned by year
+        Path(DATA_DIR) / "pulled" / "CRSP_stock_ciz_daily",
+    ]
+
+    return {
+        "actions": [
+            pull_CRSP_daily_stock,
+        ],
+        "targets": targets,
+        "file_dep": file_dep,
+        "clean": [remove_targets],
         "verbosity": 2, # Print everything immediately. This is important in
         # case WRDS asks for credentials.
     }
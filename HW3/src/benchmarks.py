@@ -0,0 +1,972 @@
+"""
+Benchmarks for the performance-sensitive stages of the Fama-French
+factor pipeline.
+
+The benchmarks build synthetic inputs of a configurable size, so they
+can be run without WRDS credentials. Run them from the `src` directory:
+
+    python benchmarks.py
+
+Each benchmark checks that the fast and the original code paths agree
+before reporting timings.
+"""
+import multiprocessing
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from pandas.testing import assert_frame_equal
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import calc_CRSP_indices
+import calc_Fama_French_1993_factors
+import config
+import load_CRSP_Compustat
+import load_CRSP_stock
+import misc_tools
+
+DATA_DIR = config.DATA_DIR
+
+
+def time_function(func, *args, n_repeats=1, **kwargs):
+    """Call `func(*args, **kwargs)` `n_repeats` times and return the
+    result of the last call and the best wall-clock time in seconds.
+    """
+    best = np.inf
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def peak_memory(func, *args, **kwargs):
+    """Call `func(*args, **kwargs)` and return the result and the peak
+    memory (in MB) allocated during the call, as traced by `tracemalloc`.
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak / 1e6
+
+
+def _max_rss_mb():
+    if resource is None:
+        return np.nan
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes on Linux
+    return max_rss / 1e6 if sys.platform == "darwin" else max_rss / 1e3
+
+
+def _timed_call_with_rss(func, args, kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    return len(result), seconds, _max_rss_mb()
+
+
+def measure_in_subprocess(func, *args, **kwargs):
+    """Call `func(*args, **kwargs)` in a fresh process and return the
+    length of the result, the wall-clock time in seconds and the peak
+    resident set size (RSS, in MB) of that process. Using a fresh process
+    keeps the peak RSS of one measurement from hiding another's.
+    `func` must be defined at module level so that it can be pickled.
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_timed_call_with_rss, func, args, kwargs).result()
+
+
+def _make_ccm_jun_and_crsp3(n_rows=1_000_000, n_years=60, seed=0):
+    """Synthetic stand-ins for the `ccm_jun` and `crsp3` frames used
+    by `assign_size_and_bm_portfolios`.
+    """
+    rng = np.random.default_rng(seed)
+    n_firms = int(np.ceil(n_rows / n_years))
+    permno = np.repeat(np.arange(10000, 10000 + n_firms), n_years)[:n_rows]
+    year = np.tile(np.arange(2022 - n_years + 1, 2023), n_firms)[:n_rows]
+    jdate = pd.to_datetime(pd.DataFrame({"year": year, "month": 6, "day": 30}))
+
+    ccm_jun = pd.DataFrame(
+        {
+            "permno": permno,
+            "mthcaldt": jdate,
+            "jdate": jdate,
+            "primaryexch": rng.choice(["N", "A", "Q"], n_rows, p=[0.4, 0.1, 0.5]),
+            "me": rng.lognormal(12, 2, n_rows),
+            "beme": rng.lognormal(-0.5, 1, n_rows) * np.sign(rng.normal(1, 0.5, n_rows)),
+            "count": rng.integers(0, 20, n_rows),
+        }
+    )
+
+    crsp3 = ccm_jun[["mthcaldt", "permno", "primaryexch", "me", "jdate"]].copy()
+    for col in [
+        "sharetype", "securitytype", "securitysubtype", "usincflg",
+        "issuertype", "conditionaltype", "tradingstatusflg",
+    ]:
+        crsp3[col] = ""
+    crsp3["mthret"] = rng.normal(0.01, 0.1, n_rows)
+    crsp3["wt"] = crsp3["me"]
+    crsp3["cumretx"] = 1.0
+    crsp3["ffyear"] = year
+    return ccm_jun, crsp3
+
+
+def benchmark_assign_size_and_bm_portfolios(n_rows=1_000_000):
+    """Compare the row-wise and vectorized portfolio assignment in
+    `assign_size_and_bm_portfolios`.
+    """
+    ccm_jun, crsp3 = _make_ccm_jun_and_crsp3(n_rows=n_rows)
+    f = calc_Fama_French_1993_factors.assign_size_and_bm_portfolios
+
+    ccm4_apply, t_apply = time_function(f, ccm_jun, crsp3, vectorized=False)
+    ccm4_vec, t_vec = time_function(f, ccm_jun, crsp3, vectorized=True, n_repeats=3)
+    assert_frame_equal(ccm4_apply, ccm4_vec)
+
+    return pd.DataFrame(
+        {
+            "rows": [n_rows, n_rows],
+            "seconds": [t_apply, t_vec],
+            "speedup": [1.0, t_apply / t_vec],
+        },
+        index=pd.Index(["apply", "vectorized"], name="assign_size_and_bm_portfolios"),
+    )
+
+
+def _calc_portfolios_serial(ccm_jun, crsp3):
+    f = calc_Fama_French_1993_factors
+    june = f.calc_june_portfolio_assignments(ccm_jun)
+    ccm4 = f.merge_june_portfolio_assignments(june, crsp3)
+    return (june,) + f.create_fama_french_portfolios(ccm4)
+
+
+def benchmark_calc_portfolios_by_formation_year(n_rows=5_000_000, n_jobs=(2, 4, 8, None)):
+    """Compare the serial sort and weighted-return stages with
+    `calc_portfolios_by_formation_year` for several numbers of processes
+    (None uses all cores).
+    """
+    ccm_jun, crsp3 = _make_ccm_jun_and_crsp3(n_rows=n_rows)
+    (_, vwret, vwret_n), t_serial = time_function(_calc_portfolios_serial, ccm_jun, crsp3)
+    results = [{"n_jobs": 1, "seconds": t_serial, "speedup": 1.0}]
+    for n in n_jobs:
+        (_, vwret_par, vwret_n_par), t_par = time_function(
+            calc_Fama_French_1993_factors.calc_portfolios_by_formation_year,
+            ccm_jun, crsp3, n_jobs=n,
+        )
+        assert_frame_equal(vwret, vwret_par)
+        assert_frame_equal(vwret_n, vwret_n_par)
+        results.append({"n_jobs": n, "seconds": t_par, "speedup": t_serial / t_par})
+    return pd.DataFrame(results).set_index("n_jobs")
+
+
+def _make_ccm4(n_months=700, n_portfolios=6, firms_per_portfolio=500, seed=0):
+    """Synthetic stand-in for the `ccm4` frame used by
+    `create_fama_french_portfolios`.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = n_months * n_portfolios * firms_per_portfolio
+    jdate = pd.date_range("1963-07-31", periods=n_months, freq="M")
+    n_sz = int(np.ceil(np.sqrt(n_portfolios)))
+    port = np.tile(np.repeat(np.arange(n_portfolios), firms_per_portfolio), n_months)
+    mthret = rng.normal(0.01, 0.1, n_rows)
+    mthret[rng.random(n_rows) < 0.01] = np.nan
+    return pd.DataFrame(
+        {
+            "jdate": np.repeat(jdate, n_portfolios * firms_per_portfolio),
+            "szport": (port // n_sz).astype(str),
+            "bmport": (port % n_sz).astype(str),
+            "mthret": mthret,
+            "wt": rng.lognormal(12, 2, n_rows),
+        }
+    )
+
+
+def benchmark_create_fama_french_portfolios(n_portfolios=(6, 25, 100)):
+    """Compare `groupby().apply(wavg)` plus a separate count with the
+    fused `groupby_wavg_and_count` in `create_fama_french_portfolios`.
+    """
+    f = calc_Fama_French_1993_factors.create_fama_french_portfolios
+    results = []
+    for n in n_portfolios:
+        ccm4 = _make_ccm4(n_portfolios=n, firms_per_portfolio=3000 // n)
+        (vwret_apply, vwret_n_apply), t_apply = time_function(f, ccm4, vectorized=False)
+        (vwret_vec, vwret_n_vec), t_vec = time_function(f, ccm4, vectorized=True, n_repeats=3)
+        assert_frame_equal(vwret_apply, vwret_vec)
+        assert_frame_equal(vwret_n_apply, vwret_n_vec)
+        results.append(
+            {"portfolios": n, "rows": len(ccm4), "apply": t_apply,
+             "vectorized": t_vec, "speedup": t_apply / t_vec}
+        )
+    return pd.DataFrame(results).set_index("portfolios")
+
+
+def benchmark_calculate_market_equity(data_dir=DATA_DIR, n_rows=5_000_000):
+    """Compare the merge-based `calculate_market_equity` with the
+    vectorized version (`transform('sum')` and `transform('max')`, ties
+    on ME going to the smallest permno) on the pulled CIZ panel (or a
+    synthetic panel of `n_rows` rows if it has not been pulled).
+    """
+    f = calc_Fama_French_1993_factors.calculate_market_equity
+    path = Path(data_dir) / "pulled" / "CRSP_stock_ciz.parquet"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if not path.exists():
+            _write_crsp_stock_ciz(tmp_dir, n_rows=n_rows)
+            data_dir = tmp_dir
+        crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(
+            data_dir=data_dir, common_stock_only=True
+        )
+    crsp2_merge, t_merge = time_function(f, crsp.copy(), vectorized=False)
+    crsp2_vec, t_vec = time_function(f, crsp.copy(), n_repeats=3)
+    return pd.Series(
+        {"rows": len(crsp), "merge": t_merge, "vectorized": t_vec,
+         "speedup": t_merge / t_vec,
+         # Only differ when permnos of a permco tie on ME
+         "rows_merge": len(crsp2_merge), "rows_vectorized": len(crsp2_vec)}
+    )
+
+
+def _make_crsp2(n_firms=10_000, n_months=600, seed=0):
+    """Synthetic stand-in for the `crsp2` frame used by
+    `use_dec_market_equity`, with firms listing at different dates.
+    """
+    rng = np.random.default_rng(seed)
+    jdate = pd.date_range("1963-01-31", periods=n_months, freq="M")
+    first = rng.integers(0, n_months // 2, n_firms)
+    length = rng.integers(12, n_months, n_firms)
+    length = np.minimum(length, n_months - first)
+    permno = np.repeat(np.arange(n_firms), length)
+    # Month index within the panel of every row
+    month = np.arange(len(permno)) - np.repeat(np.cumsum(length) - length, length)
+    month += np.repeat(first, length)
+    n_rows = len(permno)
+    mthretx = rng.normal(0.01, 0.1, n_rows)
+    mthretx[rng.random(n_rows) < 0.01] = np.nan
+    crsp2 = pd.DataFrame(
+        {
+            "permno": permno,
+            "mthcaldt": jdate[month],
+            "jdate": jdate[month],
+            "mthret": mthretx + 0.002,
+            "mthretx": mthretx,
+            "me": rng.lognormal(12, 2, n_rows),
+        }
+    )
+    for col in ["sharetype", "securitytype", "securitysubtype", "usincflg",
+                "issuertype", "primaryexch", "conditionaltype", "tradingstatusflg"]:
+        crsp2[col] = ""
+    return crsp2
+
+
+def _prior_returns_groupby_apply(crsp2):
+    """Per-permno `groupby().apply()` of a rolling window over a monthly
+    period index (reindexed to fill gaps), the usual ad-hoc momentum code.
+    """
+    def prior_returns(group):
+        ret = group.set_index(group["jdate"].dt.to_period("M"))["mthret"]
+        months = pd.period_range(ret.index.min(), ret.index.max(), freq="M")
+        logret = np.log1p(ret.reindex(months))
+        prior = np.expm1(logret.shift(2).rolling(11, min_periods=11).sum())
+        return pd.Series(prior.reindex(ret.index).to_numpy(), index=group.index)
+
+    return crsp2.groupby("permno", group_keys=False).apply(prior_returns)
+
+
+def benchmark_calc_prior_returns(n_firms=10_000):
+    """Compare a `groupby().apply(rolling)` momentum prior return with
+    the vectorized, gap-aware `calc_prior_returns`.
+    """
+    crsp2 = _make_crsp2(n_firms=n_firms)
+    # Drop 1% of the months to create gaps
+    crsp2 = crsp2.sample(frac=0.99, random_state=0).sort_index()
+    expected, t_apply = time_function(_prior_returns_groupby_apply, crsp2)
+    prior, t_vec = time_function(
+        calc_Fama_French_1993_factors.calc_prior_returns, crsp2, n_repeats=3
+    )
+    assert np.allclose(prior, expected.reindex(crsp2.index), equal_nan=True)
+    return pd.Series(
+        {"rows": len(crsp2), "groupby_apply": t_apply, "vectorized": t_vec,
+         "speedup": t_apply / t_vec}
+    )
+
+
+def _lagged_me_groupby_shift(crsp2):
+    """Gap-aware lagged market equity with `groupby().shift()`: sort by
+    permno and month, shift the market equity and the month, and drop the
+    lags that are not from the previous month.
+    """
+    crsp2 = crsp2.sort_values(["permno", "jdate"])
+    month = crsp2["jdate"].dt.year * 12 + crsp2["jdate"].dt.month
+    lagged = pd.DataFrame({"me": crsp2["me"], "month": month}).groupby(crsp2["permno"]).shift(1)
+    return lagged["me"].where(month - lagged["month"] == 1).sort_index()
+
+
+def benchmark_lag_by_month_ordinal(n_firms=10_000):
+    """Compare lagged market equity from `groupby().shift()` (which
+    takes a stale value after a gap), a gap-aware `groupby().shift()` and
+    `misc_tools.lag_by_month_ordinal`, on rows in date order with 1% of
+    the months missing.
+    """
+    crsp2 = _make_crsp2(n_firms=n_firms)
+    crsp2 = crsp2.sample(frac=0.99, random_state=0).sort_values(["jdate", "permno"])
+    sorted_crsp2 = crsp2.sort_values(["permno", "jdate"])
+    _, t_shift = time_function(
+        lambda: sorted_crsp2.groupby("permno")["me"].shift(1), n_repeats=3
+    )
+    expected, t_gap_aware = time_function(_lagged_me_groupby_shift, crsp2, n_repeats=3)
+
+    def lag_by_month_ordinal(df):
+        month = misc_tools.calc_month_ordinal(df["jdate"])
+        return misc_tools.lag_by_month_ordinal(df["permno"], month, df["me"])
+
+    lagged, t_ordinal = time_function(lag_by_month_ordinal, crsp2, n_repeats=3)
+    _, t_ordinal_sorted = time_function(lag_by_month_ordinal, sorted_crsp2, n_repeats=3)
+    assert np.allclose(lagged, expected.reindex(crsp2.index), equal_nan=True)
+    return pd.Series(
+        {"rows": len(crsp2), "groupby_shift_sorted": t_shift,
+         "lag_by_month_ordinal_sorted": t_ordinal_sorted,
+         "groupby_shift_gap_aware": t_gap_aware, "lag_by_month_ordinal": t_ordinal,
+         "speedup_gap_aware": t_gap_aware / t_ordinal}
+    )
+
+
+def benchmark_use_dec_market_equity(n_firms=10_000):
+    """Compare the groupby and merge version of `use_dec_market_equity`
+    with the segment-wise kernel (`calc_cumulative_return_weights`).
+    """
+    f = calc_Fama_French_1993_factors.use_dec_market_equity
+    crsp2 = _make_crsp2(n_firms=n_firms)
+    (crsp3_groupby, _), t_groupby = time_function(f, crsp2.copy(), segment_kernel=False)
+    (crsp3_kernel, _), t_kernel = time_function(f, crsp2.copy(), n_repeats=3)
+    assert_frame_equal(crsp3_groupby, crsp3_kernel, check_exact=True)
+
+    sorted_crsp2 = f(crsp2.copy())[0]
+    args = [
+        sorted_crsp2[col].to_numpy()
+        for col in ["permno", "ffyear", "ffmonth", "1+retx", "me"]
+    ]
+    _, t_only_kernel = time_function(
+        calc_Fama_French_1993_factors.calc_cumulative_return_weights, *args, n_repeats=3
+    )
+    return pd.Series(
+        {"rows": len(crsp2), "groupby": t_groupby, "segment_kernel": t_kernel,
+         "speedup": t_groupby / t_kernel, "kernel_only": t_only_kernel}
+    )
+
+
+def _make_comp_ccm_and_crsp_jun(n_firms=20_000, n_years=60, links_per_gvkey=4, seed=0):
+    """Synthetic stand-ins for the `comp`, `ccm` and `crsp_jun` frames
+    used by `merge_CRSP_and_Compustat`. Each gvkey has `links_per_gvkey`
+    consecutive, non-overlapping links to different permnos.
+    """
+    rng = np.random.default_rng(seed)
+    gvkey = np.array([f"{i:06d}" for i in range(1000, 1000 + n_firms)], dtype=object)
+    years = np.arange(2022 - n_years + 1, 2023)
+
+    comp = pd.DataFrame(
+        {
+            "gvkey": np.repeat(gvkey, n_years),
+            "datadate": pd.to_datetime(
+                pd.DataFrame({"year": np.tile(years, n_firms), "month": 12, "day": 31})
+            ),
+            "be": rng.lognormal(3, 1, n_firms * n_years),
+            "count": np.tile(np.arange(n_years), n_firms),
+        }
+    )
+
+    years_per_link = n_years // links_per_gvkey
+    link_start = years[0] + years_per_link * np.arange(links_per_gvkey)
+    ccm = pd.DataFrame(
+        {
+            "gvkey": np.repeat(gvkey, links_per_gvkey),
+            "permno": np.arange(n_firms * links_per_gvkey) + 10000,
+            "linktype": "LC",
+            "linkprim": "P",
+            "linkdt": pd.to_datetime(
+                pd.DataFrame({"year": np.tile(link_start, n_firms), "month": 1, "day": 1})
+            ),
+            "linkenddt": pd.to_datetime(
+                pd.DataFrame(
+                    {"year": np.tile(link_start + years_per_link - 1, n_firms), "month": 12, "day": 31}
+                )
+            ),
+        }
+    )
+    ccm.loc[ccm.index[links_per_gvkey - 1 :: links_per_gvkey], "linkenddt"] = pd.NaT
+
+    # One June record per permno and year of its link
+    link_year = np.repeat(link_start, years_per_link) + np.tile(np.arange(years_per_link), links_per_gvkey)
+    crsp_jun = pd.DataFrame(
+        {
+            "permno": np.repeat(ccm["permno"].to_numpy(), years_per_link),
+            "jdate": pd.to_datetime(
+                pd.DataFrame({"year": np.tile(link_year + 1, n_firms), "month": 6, "day": 30})
+            ),
+            "me": rng.lognormal(12, 2, n_firms * links_per_gvkey * years_per_link),
+        }
+    )
+    crsp_jun["dec_me"] = crsp_jun["me"]
+    return comp, ccm, crsp_jun
+
+
+def benchmark_merge_CRSP_and_Compustat(n_firms=20_000, links_per_gvkey=4):
+    """Compare time and peak memory of the merge-then-filter and the
+    interval-join paths of `merge_CRSP_and_Compustat`.
+    """
+    comp, ccm, crsp_jun = _make_comp_ccm_and_crsp_jun(
+        n_firms=n_firms, links_per_gvkey=links_per_gvkey
+    )
+    f = calc_Fama_French_1993_factors.merge_CRSP_and_Compustat
+
+    results = {}
+    for name, interval_join in [("merge_then_filter", False), ("interval_join", True)]:
+        ccm_jun, mb = peak_memory(f, crsp_jun, comp, ccm.copy(), interval_join=interval_join)
+        _, seconds = time_function(f, crsp_jun, comp, ccm.copy(), interval_join=interval_join)
+        results[name] = {"rows": len(ccm_jun), "seconds": seconds, "peak_MB": mb}
+    assert results["merge_then_filter"]["rows"] == results["interval_join"]["rows"]
+    return pd.DataFrame(results).T
+
+
+def _write_crsp_stock_ciz(data_dir, n_rows=5_000_000, seed=0):
+    """Write a synthetic `CRSP_stock_ciz.parquet` to `data_dir / "pulled"`,
+    sorted by date like a WRDS pull. About a third of the rows are
+    outside the common stock universe.
+    """
+    rng = np.random.default_rng(seed)
+    n_months = 768
+    mthcaldt = pd.date_range("1959-01-31", periods=n_months, freq="M")
+    crsp = pd.DataFrame(
+        {
+            "permno": rng.integers(10000, 95000, n_rows),
+            "permco": rng.integers(1, 60000, n_rows),
+            "mthcaldt": np.sort(rng.choice(mthcaldt.to_numpy(), n_rows)),
+            "issuertype": rng.choice(["CORP", "ACOR", "FUND"], n_rows, p=[0.85, 0.1, 0.05]),
+            "securitytype": rng.choice(["EQTY", "FUND"], n_rows, p=[0.95, 0.05]),
+            "securitysubtype": rng.choice(["COM", "ETF", "UIT"], n_rows, p=[0.9, 0.05, 0.05]),
+            "sharetype": rng.choice(["NS", "AD", "SBI"], n_rows, p=[0.9, 0.05, 0.05]),
+            "usincflg": rng.choice(["Y", "N"], n_rows, p=[0.95, 0.05]),
+            "primaryexch": rng.choice(["N", "A", "Q", "X"], n_rows, p=[0.3, 0.1, 0.55, 0.05]),
+            "conditionaltype": rng.choice(["RW", "NW"], n_rows, p=[0.98, 0.02]),
+            "tradingstatusflg": rng.choice(["A", "H"], n_rows, p=[0.98, 0.02]),
+            "mthret": rng.normal(0.01, 0.1, n_rows),
+            "mthretx": rng.normal(0.01, 0.1, n_rows),
+            "shrout": rng.lognormal(9, 1.5, n_rows),
+            "mthprc": rng.lognormal(3, 1, n_rows),
+        }
+    )
+    crsp["jdate"] = crsp["mthcaldt"] + pd.offsets.MonthEnd(0)
+    pulled = Path(data_dir) / "pulled"
+    pulled.mkdir(parents=True, exist_ok=True)
+    crsp.to_parquet(pulled / "CRSP_stock_ciz.parquet", row_group_size=250_000)
+
+
+def _load_CRSP_stock_ciz_then_subset(data_dir):
+    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=data_dir)
+    return calc_Fama_French_1993_factors.subset_CRSP_to_common_stock_and_exchanges(crsp)
+
+
+def _load_CRSP_stock_ciz_pushdown(data_dir):
+    return load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=data_dir, common_stock_only=True)
+
+
+def _load_CRSP_stock_ciz_pushdown_last_decade(data_dir):
+    return load_CRSP_Compustat.load_CRSP_stock_ciz(
+        data_dir=data_dir,
+        columns=["permno", "permco", "mthcaldt", "jdate", "mthret", "mthretx", "shrout", "mthprc"],
+        common_stock_only=True,
+        start_date="2013-01-01",
+    )
+
+
+def benchmark_load_CRSP_stock_ciz(n_rows=5_000_000):
+    """Compare load time and peak RSS of reading all of
+    `CRSP_stock_ciz.parquet` and then subsetting with reading it with the
+    filters (and optionally a column projection) pushed down to pyarrow.
+    """
+    with tempfile.TemporaryDirectory() as data_dir:
+        _write_crsp_stock_ciz(data_dir, n_rows=n_rows)
+        results = {}
+        for name, func in [
+            ("read_all_then_subset", _load_CRSP_stock_ciz_then_subset),
+            ("pushdown", _load_CRSP_stock_ciz_pushdown),
+            ("pushdown_8_columns_since_2013", _load_CRSP_stock_ciz_pushdown_last_decade),
+        ]:
+            rows, seconds, rss = measure_in_subprocess(func, data_dir)
+            results[name] = {"rows": rows, "seconds": seconds, "peak_rss_MB": rss}
+    return pd.DataFrame(results).T
+
+
+def _anonymous_memory_mb():
+    """Memory of this process that is not backed by a file (heap), in MB.
+    Unlike RSS, it leaves out the pages of memory-mapped files, which the
+    OS can share between processes. NaN where /proc is not available.
+    """
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return np.nan
+    return int(fields["Anonymous"].split()[0]) / 1e3
+
+
+def _load_and_sum_CRSP_monthly_file(data_dir, memory_map):
+    start = time.perf_counter()
+    df = load_CRSP_stock.load_CRSP_monthly_file(data_dir=data_dir, memory_map=memory_map)
+    load_seconds = time.perf_counter() - start
+    # Touch every numeric value, as an analysis would (np.sum does not
+    # copy, unlike the NaN-skipping Series.sum)
+    numeric = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+    total = np.nansum([np.sum(df[col].to_numpy()) for col in numeric])
+    return {
+        "rows": len(df),
+        "load_seconds": load_seconds,
+        "load_and_sum_seconds": time.perf_counter() - start,
+        "anonymous_MB": _anonymous_memory_mb(),
+        "total": total,
+    }
+
+
+def benchmark_memory_mapped_CRSP_monthly_file(n_firms=20_000):
+    """Compare loading the CRSP monthly stock file from parquet with
+    opening its Arrow IPC copy memory-mapped, each in a fresh process.
+
+    The anonymous (heap) memory of a worker is what each additional
+    worker costs: the mapped pages of the file are shared by every
+    process that maps it, and are left out.
+    """
+    import generate_synthetic_data
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate_synthetic_data.write_synthetic_data(
+            data_dir=data_dir, n_firms=n_firms, start_year=1959, end_year=2022
+        )
+        path = Path(data_dir) / "pulled" / "CRSP_MSF_INDEX_INPUTS.parquet"
+        misc_tools.arrow_ipc_copy(path)
+        results = {}
+        # Spawned rather than forked, so that the workers do not inherit
+        # the memory of this process
+        spawn = multiprocessing.get_context("spawn")
+        for name, memory_map in [("parquet", False), ("memory_map", True)]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                results[name] = executor.submit(
+                    _load_and_sum_CRSP_monthly_file, data_dir, memory_map
+                ).result()
+    results = pd.DataFrame(results).T
+    assert np.isclose(results.loc["parquet", "total"], results.loc["memory_map", "total"])
+    return results.drop(columns="total")
+
+
+def benchmark_calc_CRSP_indices(n_firms=20_000):
+    """Compare the original value and equal weighted index functions
+    (seven groupbys, columns added to the input) with the single-pass
+    `calc_CRSP_indices` on a synthetic CRSP monthly stock file.
+    """
+    import generate_synthetic_data
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate_synthetic_data.write_synthetic_data(
+            data_dir=data_dir, n_firms=n_firms, start_year=1959, end_year=2022
+        )
+        df_msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=data_dir)
+        df_msix = load_CRSP_stock.load_CRSP_index_files(data_dir=data_dir)
+    # The original functions add columns to their input, so they are
+    # given a copy of the columns they use (timed with them)
+    df_msf = df_msf[["permno", "date", "shrout", "altprc", "ret", "retx"]]
+    f = calc_CRSP_indices.calc_CRSP_indices_merge
+    expected, t_groupby = time_function(
+        lambda: f(df_msf.copy(), df_msix, single_pass=False), n_repeats=3
+    )
+    output, t_single_pass = time_function(f, df_msf, df_msix, n_repeats=3)
+    assert_frame_equal(output, expected)
+    return pd.Series(
+        {"rows": len(df_msf), "groupby": t_groupby, "single_pass": t_single_pass,
+         "speedup": t_groupby / t_single_pass}
+    )
+
+
+def _sub_indices_groupby(df_msf):
+    """Decile and exchange sub-indices with `groupby().quantile()`
+    breakpoints and `groupby().apply(wavg)` returns, the usual ad-hoc
+    code.
+    """
+    wavg = calc_Fama_French_1993_factors.wavg
+    df = df_msf[["date", "permno", "exchcd", "ret", "altprc", "shrout"]].sort_values(
+        ["permno", "date"]
+    )
+    df["mktcap"] = df["shrout"] * df["altprc"]
+    df["month"] = df["date"].dt.year * 12 + df["date"].dt.month
+    lagged = df.groupby("permno")[["mktcap", "month"]].shift(1)
+    df["lag_mktcap"] = lagged["mktcap"].where(df["month"] - lagged["month"] == 1)
+    df = df[df["lag_mktcap"].notna() & df["ret"].notna()]
+
+    breakpoints = (
+        df[df["exchcd"] == 1].groupby("date")["lag_mktcap"]
+        .quantile(np.arange(1, 10) / 10).unstack()
+    )
+    df = df.join(breakpoints, on="date")
+    df["decile"] = (df[["lag_mktcap"]].to_numpy() > df[breakpoints.columns].to_numpy()).sum(axis=1)
+    decret = df.groupby(["date", "decile"]).apply(wavg, "ret", "lag_mktcap").unstack()
+    decret.columns = [f"decret{j + 1}" for j in decret.columns]
+    vwretd = df.groupby(["date", "exchcd"]).apply(wavg, "ret", "lag_mktcap").unstack()
+    vwretd.columns = [f"vwretd_{calc_CRSP_indices.EXCHANGES[code]}" for code in vwretd.columns]
+    return decret.join(vwretd)
+
+
+def benchmark_calc_CRSP_sub_indices(n_firms=20_000):
+    """Compare the decile and exchange sub-indices of
+    `calc_CRSP_sub_indices` with a `groupby().quantile()` and
+    `groupby().apply()` version, on a synthetic CRSP monthly stock file.
+    """
+    import generate_synthetic_data
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate_synthetic_data.write_synthetic_data(
+            data_dir=data_dir, n_firms=n_firms, start_year=1959, end_year=2022
+        )
+        df_msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=data_dir)
+    expected, t_groupby = time_function(_sub_indices_groupby, df_msf)
+    output, t_single_pass = time_function(
+        calc_CRSP_indices.calc_CRSP_sub_indices, df_msf, n_repeats=3
+    )
+    assert_frame_equal(output.loc[expected.index, expected.columns], expected, check_freq=False)
+    return pd.Series(
+        {"rows": len(df_msf), "groupby_apply": t_groupby, "single_pass": t_single_pass,
+         "speedup": t_groupby / t_single_pass}
+    )
+
+
+def _apply_delisting_returns_select(df):
+    """The original `apply_delisting_returns`: `isin` and `np.select`
+    separately for `dlret` and `dlretx`, modifying `df`.
+    """
+    df["dlret"] = np.select(
+        [
+            df["dlstcd"].isin([500, 520, 580, 584] + list(range(551, 575)))
+            & df["dlret"].isna(),
+            df["dlret"].isna() & df["dlstcd"].notna() & (df["dlstcd"] >= 200),
+            True,
+        ],
+        [-0.3, -1, df["dlret"]],
+        default=df["dlret"],
+    )
+    df["dlretx"] = np.select(
+        [
+            df["dlstcd"].isin([500, 520, 580, 584] + list(range(551, 575)))
+            & df["dlretx"].isna(),
+            df["dlretx"].isna() & df["dlstcd"].notna() & (df["dlstcd"] >= 200),
+            True,
+        ],
+        [-0.3, -1, df["dlretx"]],
+        default=df["dlretx"],
+    )
+    df.loc[df["dlret"].notna(), "ret"] = df["dlret"]
+    df.loc[df["dlretx"].notna(), "retx"] = df["dlretx"]
+    return df
+
+
+def benchmark_apply_delisting_returns(n_rows=5_000_000, seed=0):
+    """Compare the original `np.select` version of
+    `apply_delisting_returns` (with its precedence bug fixed) with the
+    lookup-array version, on synthetic returns with 1% delisting records.
+    """
+    rng = np.random.default_rng(seed)
+    delisting = rng.random(n_rows) < 0.01
+    codes = [100, 231, 241, 331, 450, 500, 520, 551, 552, 560, 574, 580, 584]
+    df = pd.DataFrame(
+        {
+            "ret": rng.normal(0.01, 0.1, n_rows),
+            "retx": rng.normal(0.01, 0.1, n_rows),
+            "dlret": np.where(delisting & (rng.random(n_rows) < 0.5), rng.normal(0, 0.2, n_rows), np.nan),
+            "dlstcd": np.where(delisting, rng.choice(codes, n_rows), np.nan),
+        }
+    )
+    df["dlretx"] = df["dlret"]
+    columns = ["ret", "retx", "dlret", "dlretx"]
+    expected, t_select = time_function(
+        lambda: _apply_delisting_returns_select(df.copy())[columns], n_repeats=3
+    )
+    output, t_lookup = time_function(
+        lambda: load_CRSP_stock.apply_delisting_returns(df)[columns], n_repeats=3
+    )
+    assert_frame_equal(output, expected)
+    return pd.Series(
+        {"rows": n_rows, "select": t_select, "lookup": t_lookup,
+         "speedup": t_select / t_lookup}
+    )
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process (Linux only), which a spawned
+    process otherwise inherits from its parent across exec."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    """Peak RSS of this process since `_reset_peak_rss`, in MB. NaN where
+    /proc is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return np.nan
+    return int(fields["VmHWM"].split()[0]) / 1e3
+
+
+def _pull_CRSP_stock_ciz_to_parquet(db_dir, path, chunksize):
+    import generate_synthetic_data
+
+    _reset_peak_rss()
+    start = time.perf_counter()
+    db = generate_synthetic_data.connect_sqlite_stand_in(db_dir)
+    if chunksize is None:
+        load_CRSP_Compustat.pull_CRSP_stock_ciz(db=db).to_parquet(path)
+    else:
+        load_CRSP_Compustat.pull_CRSP_stock_ciz(db=db, output_path=path, chunksize=chunksize)
+    db.close()
+    return {
+        "rows": pq.ParquetDataset(path).read(columns=["permno"]).num_rows,
+        "seconds": time.perf_counter() - start,
+        "peak_rss_MB": _peak_rss_mb(),
+    }
+
+
+def benchmark_streaming_pull(n_firms=10_000, chunksizes=(None, 500_000, 100_000)):
+    """Peak RSS of pulling the CRSP monthly stock file from the SQLite
+    stand-in (see `generate_synthetic_data.write_sqlite_stand_in`) into
+    one parquet file (`chunksize=None`) and of streaming it to a parquet
+    dataset partitioned by year, each in a fresh process.
+    """
+    import generate_synthetic_data
+
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate_synthetic_data.write_synthetic_data(
+            data_dir=data_dir, n_firms=n_firms, start_year=1959, end_year=2022
+        )
+        db_dir = generate_synthetic_data.write_sqlite_stand_in(data_dir=data_dir)
+        # Spawned rather than forked, so that the workers do not inherit
+        # the memory of this process
+        spawn = multiprocessing.get_context("spawn")
+        for chunksize in chunksizes:
+            path = Path(data_dir) / f"CRSP_stock_ciz_{chunksize}.parquet"
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as executor:
+                results[chunksize] = executor.submit(
+                    _pull_CRSP_stock_ciz_to_parquet, db_dir, path, chunksize
+                ).result()
+    results = pd.DataFrame(results).T.rename_axis("chunksize")
+    assert results["rows"].nunique() == 1
+    return results
+
+
+def benchmark_incremental_pull(n_firms=10_000, lookback_months=12):
+    """Compare a full pull of the CRSP monthly stock file from the SQLite
+    stand-in with an incremental pull of the same dataset, which only
+    queries and rewrites the last `lookback_months` months.
+    """
+    import generate_synthetic_data
+    import wrds_pool
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        generate_synthetic_data.write_synthetic_data(
+            data_dir=data_dir, n_firms=n_firms, start_year=1959, end_year=2022
+        )
+        db_dir = generate_synthetic_data.write_sqlite_stand_in(data_dir=data_dir)
+        path = Path(data_dir) / "CRSP_stock_ciz.parquet"
+        engine = generate_synthetic_data.sqlite_stand_in_engine(db_dir)
+        with wrds_pool.ConnectionPool(engine=engine) as pool:
+            _, full = time_function(
+                load_CRSP_Compustat.pull_CRSP_stock_ciz, db=pool, output_path=path
+            )
+            stored = pd.read_parquet(path)
+            _, incremental = time_function(
+                load_CRSP_Compustat.pull_CRSP_stock_ciz,
+                db=pool,
+                output_path=path,
+                incremental=True,
+                lookback_months=lookback_months,
+            )
+        updated = pd.read_parquet(path)
+    by = ["mthcaldt", "permno"]
+    assert_frame_equal(
+        updated.sort_values(by, ignore_index=True).drop(columns="year"),
+        stored.sort_values(by, ignore_index=True).drop(columns="year"),
+    )
+    return pd.Series(
+        {"rows": len(stored), "full": full, "incremental": incremental,
+         "speedup": full / incremental}
+    )
+
+
+def report_dtype_schema_memory(data_dir=DATA_DIR):
+    """Memory used by each pulled dataset as stored on disk (raw
+    `pd.read_parquet`) and after the compact dtype schemas declared in
+    `load_CRSP_Compustat` and `load_CRSP_stock`, with float64 and float32
+    price and share columns. Datasets that have not been pulled are skipped.
+    """
+    datasets = {
+        "Compustat.parquet": load_CRSP_Compustat.schema_compustat,
+        "CRSP_stock_ciz.parquet": load_CRSP_Compustat.schema_crsp,
+        "CRSP_Comp_Link_Table.parquet": load_CRSP_Compustat.schema_crsp_comp_link,
+        "CRSP_MSF_INDEX_INPUTS.parquet": load_CRSP_stock.schema_msf,
+    }
+    reports = []
+    for file, schema in datasets.items():
+        path = Path(data_dir) / "pulled" / file
+        if not path.exists():
+            continue
+        raw = pd.read_parquet(path)
+        # Columns that a pull from before the schema stored as categoricals
+        # are compared as the object columns they used to be.
+        raw = raw.astype({col: object for col in raw.select_dtypes("category")})
+        report = misc_tools.memory_usage_report(
+            {
+                "raw": raw,
+                "schema": misc_tools.apply_dtype_schema(raw, schema),
+                "schema_float32": misc_tools.apply_dtype_schema(raw, schema, float32=True),
+            }
+        )
+        report.index = pd.MultiIndex.from_product([[file], report.index])
+        reports.append(report)
+    return pd.concat(reports)
+
+
+def _write_CRSP_daily_stock_ciz(data_dir, n_stocks=5_000, n_years=10, seed=0):
+    """Write a synthetic year-partitioned CRSP daily stock file and return
+    a matching daily portfolio base (see
+    `calc_Fama_French_1993_daily_factors.calc_daily_portfolio_base`).
+    """
+    rng = np.random.default_rng(seed)
+    years = range(2022 - n_years + 1, 2023)
+    for year in years:
+        dates = pd.bdate_range(f"{year}-01-01", f"{year}-12-31")
+        n_rows = n_stocks * len(dates)
+        dlyret = rng.normal(0.0005, 0.02, n_rows)
+        crsp_d = pd.DataFrame(
+            {
+                "permno": np.repeat(np.arange(n_stocks, dtype="int32"), len(dates)),
+                "dlycaldt": np.tile(dates, n_stocks),
+                "dlyret": dlyret,
+                "dlyretx": dlyret - 0.0001,
+            }
+        )
+        load_CRSP_Compustat.save_CRSP_daily_partition(crsp_d, year, data_dir=data_dir)
+    ffyears = np.arange(years[0] - 1, years[-1] + 1)
+    base = pd.DataFrame(
+        {
+            "permno": np.repeat(np.arange(n_stocks), len(ffyears)),
+            "ffyear": np.tile(ffyears, n_stocks),
+        }
+    )
+    base["szport"] = rng.choice(["S", "B"], len(base))
+    base["bmport"] = rng.choice(["L", "M", "H"], len(base))
+    base["mebase"] = rng.lognormal(12, 2, len(base))
+    return base
+
+
+def _create_daily_Fama_French_factors(data_dir, base, chunk_freq):
+    import calc_Fama_French_1993_daily_factors
+
+    return calc_Fama_French_1993_daily_factors.create_daily_Fama_French_factors(
+        data_dir=data_dir, base=base, chunk_freq=chunk_freq
+    )[0]
+
+
+def benchmark_daily_factors_memory(n_stocks=5_000, years=(5, 10)):
+    """Peak RSS of the daily factors for different sample lengths and
+    chunk sizes. With bounded chunks, the peak RSS should not grow with
+    the number of years.
+    """
+    results = []
+    for n_years in years:
+        with tempfile.TemporaryDirectory() as data_dir:
+            base = _write_CRSP_daily_stock_ciz(data_dir, n_stocks=n_stocks, n_years=n_years)
+            for chunk_freq in ["MS", "QS", "YS"]:
+                rows, seconds, rss = measure_in_subprocess(
+                    _create_daily_Fama_French_factors, data_dir, base, chunk_freq
+                )
+                results.append(
+                    {"years": n_years, "chunk_freq": chunk_freq, "days": rows,
+                     "seconds": seconds, "peak_rss_MB": rss}
+                )
+    return pd.DataFrame(results).set_index(["years", "chunk_freq"])
+
+
+def _create_Fama_French_factors_pandas(data_dir):
+    return calc_Fama_French_1993_factors.create_Fama_French_factors(data_dir=data_dir)[0]
+
+
+def _create_Fama_French_factors_polars(data_dir):
+    return calc_Fama_French_1993_factors.create_Fama_French_factors(
+        data_dir=data_dir, backend="polars"
+    )[0]
+
+
+def benchmark_create_Fama_French_factors_backends(data_dir=DATA_DIR):
+    """Compare wall time and peak RSS of the full factor pipeline with the
+    pandas and the lazy polars backends on the pulled data.
+    """
+    results = {}
+    for name, func in [
+        ("pandas", _create_Fama_French_factors_pandas),
+        ("polars", _create_Fama_French_factors_polars),
+    ]:
+        rows, seconds, rss = measure_in_subprocess(func, data_dir)
+        results[name] = {"portfolio_rows": rows, "seconds": seconds, "peak_rss_MB": rss}
+    return pd.DataFrame(results).T
+
+
+def benchmark_dtype_schema(n_rows=5_000_000):
+    """Compare memory use and the time of
+    `subset_CRSP_to_common_stock_and_exchanges` for a synthetic CIZ file
+    with object flag columns and with the compact `schema_crsp` dtypes.
+    """
+    with tempfile.TemporaryDirectory() as data_dir:
+        _write_crsp_stock_ciz(data_dir, n_rows=n_rows)
+        raw = pd.read_parquet(Path(data_dir) / "pulled" / "CRSP_stock_ciz.parquet")
+    compact = misc_tools.apply_dtype_schema(raw, load_CRSP_Compustat.schema_crsp)
+
+    f = calc_Fama_French_1993_factors.subset_CRSP_to_common_stock_and_exchanges
+    subset_raw, t_raw = time_function(f, raw, n_repeats=3)
+    subset_compact, t_compact = time_function(f, compact, n_repeats=3)
+    assert subset_raw.index.equals(subset_compact.index)
+
+    report = misc_tools.memory_usage_report({"object_flags": raw, "schema": compact})
+    report["subset_seconds"] = [t_raw, t_compact]
+    return report
+
+
+if __name__ == "__main__":
+    print(benchmark_assign_size_and_bm_portfolios(n_rows=1_000_000))
+    print(benchmark_create_fama_french_portfolios())
+    print(benchmark_calc_portfolios_by_formation_year())
+    print(benchmark_calculate_market_equity())
+    print(benchmark_use_dec_market_equity())
+    print(benchmark_calc_prior_returns())
+    print(benchmark_lag_by_month_ordinal())
+    print(benchmark_merge_CRSP_and_Compustat())
+    print(benchmark_load_CRSP_stock_ciz())
+    print(benchmark_memory_mapped_CRSP_monthly_file())
+    print(benchmark_calc_CRSP_indices())
+    print(benchmark_calc_CRSP_sub_indices())
+    print(benchmark_apply_delisting_returns())
+    print(benchmark_streaming_pull())
+    print(benchmark_incremental_pull())
+    print(benchmark_dtype_schema())
+    print(report_dtype_schema_memory())
+    print(benchmark_create_Fama_French_factors_backends())
+    print(benchmark_daily_factors_memory())
@@ -11,6 +11,10 @@ DATA_DIR = config.DATA_DIR
 import misc_tools
 import load_CRSP_stock
 
+# Exchanges of the exchange sub-indices, by CRSP exchange code
+EXCHANGES = {1: 'nyse', 2: 'amex', 3: 'nasdaq'}
+N_DECILES = 10
+
 
 def calc_equal_weighted_index(df):
     """
@@ -46,7 +50,11 @@ def calc_CRSP_value_weighted_index(df):
     """
     
     df['mktcap'] = df['shrout'] * df['altprc']
-    df['shift_mktcap'] = df.groupby('permno')['mktcap'].shift(1)
+    # Previous calendar month's market cap of the same permno (missing
+    # after a gap in its records)
+    df['shift_mktcap'] = misc_tools.lag_by_month_ordinal(
+        df['permno'], misc_tools.calc_month_ordinal(df['date']), df['mktcap']
+    )
     total_mktcap = df.groupby('date')['mktcap'].sum()
     df['weighted_ret'] = df['ret'] * df['shift_mktcap']
     df['weighted_ret'] = df['ret'] * df['shift_mktcap']
@@ -63,11 +71,102 @@ def calc_CRSP_value_weighted_index(df):
 
 
 
-def calc_CRSP_indices_merge(df_msf, df_msix):
+def calc_lagged_market_cap(df, month=None):
+    """
+    Market cap (shrout * altprc) of every row and of the same permno in
+    the previous calendar month (missing if the permno has no record that
+    month), see `misc_tools.lag_by_month_ordinal`. `month` is the month
+    ordinal of each row (`misc_tools.calc_month_ordinal(df['date'])` if
+    not given).
+    """
+    if month is None:
+        month = misc_tools.calc_month_ordinal(df['date'])
+    mktcap = df['shrout'].to_numpy(dtype=float) * df['altprc'].to_numpy(dtype=float)
+    shift_mktcap = misc_tools.lag_by_month_ordinal(df['permno'].to_numpy(), month, mktcap)
+    return mktcap, shift_mktcap
+
+
+def calc_CRSP_indices(df):
+    """
+    Value and equal weighted indices (vwretd, vwretx, totval, ewretd,
+    ewretx, totcnt) in a single pass, without writing to `df`.
+
+    Gives the results of `calc_CRSP_value_weighted_index` and
+    `calc_equal_weighted_index`, indexed by every date of `df`. The
+    value weighted returns of the first date are missing, as they have
+    no previous market cap. The weights are the market caps of
+    `calc_lagged_market_cap`. `date` is factorized once, and each per-date
+    sum that the indices are made of (market caps, weighted returns,
+    returns and counts) is one `np.bincount` over the date codes.
+    Missing values are left out of the sums, like in `groupby().sum()`.
+    """
+    date_codes, dates = pd.factorize(df['date'], sort=True)
+    n_dates = len(dates)
+    # Rows without a date go to an extra bin that is dropped
+    date_codes = np.where(date_codes < 0, n_dates, date_codes)
+
+    def sum_by_date(values=None):
+        return np.bincount(date_codes, weights=values, minlength=n_dates + 1)[:n_dates]
+
+    # Month ordinal of each row from the month ordinals of the dates
+    month = np.append(misc_tools.calc_month_ordinal(dates), -1)[date_codes]
+    mktcap, shift_mktcap = calc_lagged_market_cap(df, month=month)
+    shift_mktcap = np.where(np.isnan(shift_mktcap), 0.0, shift_mktcap)
+    sums = {
+        'mktcap': sum_by_date(np.where(np.isnan(mktcap), 0.0, mktcap)),
+        'count': sum_by_date(df['permno'].notna().to_numpy()),
+    }
+    for ret_col in ['ret', 'retx']:
+        ret = df[ret_col].to_numpy(dtype=float)
+        has_ret = ~np.isnan(ret)
+        ret = np.where(has_ret, ret, 0.0)
+        sums[f'weighted_{ret_col}'] = sum_by_date(ret * shift_mktcap)
+        sums[f'sum_{ret_col}'] = sum_by_date(ret)
+        sums[f'n_{ret_col}'] = sum_by_date(has_ret)
+
+    # Weights are the market caps at the end of the previous date
+    prev_totval = np.concatenate([[np.nan], sums['mktcap'][:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df_idx = pd.DataFrame(
+            {
+                'vwretd': sums['weighted_ret'] / prev_totval,
+                'vwretx': sums['weighted_retx'] / prev_totval,
+                'totval': sums['mktcap'],
+                'ewretd': sums['sum_ret'] / sums['n_ret'],
+                'ewretx': sums['sum_retx'] / sums['n_retx'],
+                'totcnt': sums['count'].astype(np.int64),
+            },
+            index=pd.Index(dates, name='date'),
+        )
+    return df_idx
+
+
+def calc_CRSP_indices_merge(df_msf, df_msix, single_pass=True):
+    """
+    Merge the CRSP index file with the manually calculated indices, which
+    get the suffix "_manual".
+
+    With `single_pass=True` (the default), the indices are calculated by
+    `calc_CRSP_indices`, which does not write to `df_msf`. With
+    `single_pass=False`, the original `calc_CRSP_value_weighted_index` and
+    `calc_equal_weighted_index` are used, which add columns to `df_msf`.
+    """
+    df_msix = df_msix.rename(columns={"caldt": "date"})
+    if single_pass:
+        df_idx = calc_CRSP_indices(df_msf)
+        df_idx = df_idx.dropna(subset=['vwretd', 'vwretx'])
+        df = df_msix.merge(
+            df_idx.reset_index(),
+            on="date",
+            how="inner",
+            suffixes=("", "_manual"),
+        )
+        df = df.set_index("date")
+        return df
+
     # Merge everything with appropriate suffixes
     df_vw_idx = calc_CRSP_value_weighted_index(df_msf)
     df_eq_idx = calc_equal_weighted_index(df_msf)
-    df_msix = df_msix.rename(columns={"caldt": "date"})
 
     df = df_msix.merge(
         df_vw_idx.reset_index(),
@@ -84,6 +183,140 @@ def calc_CRSP_indices_merge(df_msf, df_msix):
     return df
 
 
+def calc_cap_decile_breakpoints(mktcap, date_codes, n_dates, n_deciles=N_DECILES):
+    """
+    Capitalization decile breakpoints of every date: the 10%, ..., 90%
+    percentiles (linear interpolation, as in `groupby().quantile()`) of
+    the market caps `mktcap` of the stocks with date code `date_codes`.
+    Returns an array with one row per date and `n_deciles - 1` columns,
+    missing for dates without stocks. Missing market caps are left out.
+    """
+    has_cap = ~np.isnan(mktcap) & (date_codes >= 0) & (date_codes < n_dates)
+    date_codes, mktcap = date_codes[has_cap], mktcap[has_cap]
+    # Sort by cap, then (stable, a radix sort for small ints) by date
+    order = np.argsort(mktcap)
+    date_dtype = np.uint16 if n_dates < 2**16 else np.int64
+    order = order[np.argsort(date_codes[order].astype(date_dtype), kind='stable')]
+    mktcap = mktcap[order]
+    counts = np.bincount(date_codes, minlength=n_dates)
+    starts = np.cumsum(counts) - counts
+
+    # Position of each percentile among the sorted caps of its date
+    pos = (counts[:, None] - 1) * (np.arange(1, n_deciles) / n_deciles)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, counts[:, None] - 1)
+    frac = pos - lo
+    has_stocks = counts[:, None] > 0
+    lo = np.where(has_stocks, starts[:, None] + lo, 0)
+    hi = np.where(has_stocks, starts[:, None] + hi, 0)
+    if len(mktcap) == 0:
+        return np.full(pos.shape, np.nan)
+    breakpoints = mktcap[lo] + (mktcap[hi] - mktcap[lo]) * frac
+    return np.where(has_stocks, breakpoints, np.nan)
+
+
+def calc_CRSP_sub_indices(df, breakpoint_exchcd=(1,)):
+    """
+    Capitalization decile indices (decret1, ..., decret10, decile 1
+    holding the smallest stocks) and NYSE, AMEX and NASDAQ sub-indices
+    (vwretd, vwretx, ewretd, ewretx and usdval with the suffixes of
+    `EXCHANGES`) in a single pass, without writing to `df`.
+
+    Each month, stocks are assigned to deciles by their market cap at
+    the end of the previous month (`calc_lagged_market_cap`), with
+    breakpoints from the previous month's caps of the stocks listed on
+    the exchanges `breakpoint_exchcd` (NYSE by default, `None` for all
+    stocks). A stock without a previous month's cap is in no decile.
+
+    Decile returns and value weighted exchange returns are weighted by
+    the previous month's cap of the stocks that have a return (`usdval`
+    in the CRSP index files). Every stock belongs to at most one decile
+    and one exchange: both memberships are stacked, so that each sum over
+    all the (date, sub-index) groups is a single `np.bincount`.
+    """
+    date_codes, dates = pd.factorize(df['date'], sort=True)
+    n_dates = len(dates)
+    date_codes = np.where(date_codes < 0, n_dates, date_codes)
+    month = np.append(misc_tools.calc_month_ordinal(dates), -1)[date_codes]
+    _, shift_mktcap = calc_lagged_market_cap(df, month=month)
+    exchcd = df['exchcd'].to_numpy(dtype=float)
+
+    in_breakpoints = np.ones(len(df), dtype=bool)
+    if breakpoint_exchcd is not None:
+        in_breakpoints = np.isin(exchcd, list(breakpoint_exchcd))
+    breakpoints = calc_cap_decile_breakpoints(
+        np.where(in_breakpoints, shift_mktcap, np.nan), date_codes, n_dates
+    )
+    # Rows without a date or breakpoints get the missing breakpoints of
+    # the extra date
+    breakpoints = np.vstack([breakpoints, np.full(N_DECILES - 1, np.nan)])
+    decile = np.zeros(len(df), dtype=np.int64)
+    for j in range(N_DECILES - 1):
+        decile += shift_mktcap > breakpoints[:, j][date_codes]
+    in_decile = ~np.isnan(shift_mktcap) & ~np.isnan(breakpoints[:, 0][date_codes])
+
+    exchange = np.full(len(df), -1)
+    for i, code in enumerate(EXCHANGES):
+        exchange[exchcd == code] = i
+
+    # Sub-indices 0-9 are the deciles, 10 onward the exchanges. Rows in
+    # no decile or exchange go to the groups of the extra date, which
+    # are dropped.
+    n_sub = N_DECILES + len(EXCHANGES)
+    groups = np.concatenate(
+        [
+            np.where(in_decile, date_codes * n_sub + decile, n_dates * n_sub),
+            np.where(exchange >= 0, date_codes * n_sub + N_DECILES + exchange, n_dates * n_sub),
+        ]
+    )
+
+    def sum_by_group(values):
+        values = np.where(np.isnan(values), 0.0, values)
+        sums = np.bincount(
+            groups, weights=np.concatenate([values, values]), minlength=(n_dates + 1) * n_sub
+        )
+        return sums.reshape(n_dates + 1, n_sub)[:n_dates]
+
+    weight = np.where(np.isnan(shift_mktcap), 0.0, shift_mktcap)
+    returns = {}
+    for ret_col, suffix in [('ret', 'd'), ('retx', 'x')]:
+        ret = df[ret_col].to_numpy(dtype=float)
+        has_ret = ~np.isnan(ret)
+        usdval = sum_by_group(np.where(has_ret, weight, 0.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns[f'vwret{suffix}'] = sum_by_group(ret * weight) / usdval
+            returns[f'ewret{suffix}'] = sum_by_group(ret) / sum_by_group(has_ret.astype(float))
+        if ret_col == 'ret':
+            returns['usdval'] = usdval
+
+    columns = {
+        f'decret{j + 1}': returns['vwretd'][:, j] for j in range(N_DECILES)
+    }
+    for i, name in enumerate(EXCHANGES.values()):
+        for stat in ['vwretd', 'vwretx', 'ewretd', 'ewretx', 'usdval']:
+            columns[f'{stat}_{name}'] = returns[stat][:, N_DECILES + i]
+    df_sub = pd.DataFrame(columns, index=pd.Index(dates, name='date'))
+    return df_sub
+
+
+def calc_CRSP_sub_indices_merge(df_msf, df_msix, breakpoint_exchcd=(1,)):
+    """
+    Merge the CRSP index file with the decile and exchange sub-indices of
+    `calc_CRSP_sub_indices`. Sub-indices that are in the index file (such
+    as decret1, ..., decret10) get the suffix "_manual".
+    """
+    df_msix = df_msix.rename(columns={"caldt": "date"})
+    df_sub = calc_CRSP_sub_indices(df_msf, breakpoint_exchcd=breakpoint_exchcd)
+    df = df_msix.merge(
+        df_sub.reset_index(),
+        on="date",
+        how="inner",
+        suffixes=("", "_manual"),
+    )
+    df = df.set_index("date")
+    return df
+
+
 def _demo():
     df_msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=DATA_DIR)
     df_msix = load_CRSP_stock.load_CRSP_index_files(data_dir=DATA_DIR)
@@ -92,6 +325,8 @@ def _demo():
     df_vw_idx = calc_CRSP_value_weighted_index(df_msf)
     df_idxs = calc_CRSP_indices_merge(df_msf, df_msix)
     df_idxs.head()
+    df_sub_idxs = calc_CRSP_sub_indices_merge(df_msf, df_msix)
+    df_sub_idxs.head()
 
 
 if __name__ == "__main__":
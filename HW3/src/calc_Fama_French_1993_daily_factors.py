@@ -0,0 +1,192 @@
+"""
+Daily Fama-French 1993 SMB and HML factors from the CRSP daily stock
+file.
+
+The daily factors use the same portfolios as the monthly factors in
+`calc_Fama_French_1993_factors.py`: stocks are sorted on size and
+book-to-market at the end of June and held from July to the next June.
+Within the holding period, each stock's weight starts at its market
+equity at the end of June and drifts with its cumulative return
+(excluding dividends) since then, the daily analog of the monthly
+`wt = mebase * L_cumretx`.
+
+The daily panel is about 20 times larger than the monthly one, so it is
+never loaded at once. It is streamed from the year-partitioned parquet
+written by `load_CRSP_Compustat.pull_CRSP_daily_stock_ciz` in date-range
+chunks (quarters by default). Only the cumulative return of each stock
+held in the current Fama-French year is carried from one chunk to the
+next, so memory is bounded by the chunk size, whatever the length of
+the sample.
+
+>>> ff_daily_factors, ff_daily_nfirms = create_daily_Fama_French_factors()
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import calc_Fama_French_1993_factors
+import config
+import load_CRSP_Compustat
+
+DATA_DIR = config.DATA_DIR
+
+
+def calc_daily_portfolio_base(june, crsp3):
+    """Portfolio (`szport`, `bmport`) and end-of-June market equity
+    (`mebase`) of every stock held in each Fama-French year.
+
+    `june` and `crsp3` are the June portfolio assignments and the monthly
+    panel of the monthly pipeline. As in the monthly portfolios, only
+    stocks with positive book-to-market and a portfolio are held. The
+    end-of-June ME is the July `mebase` of `crsp3`, so stocks without a
+    July record are not held, as in the monthly portfolios.
+    """
+    held = june[(june["posbm"] == 1) & (june["nonmissport"] == 1)]
+    mebase = crsp3.loc[crsp3["ffmonth"] == 1, ["permno", "ffyear", "mebase"]]
+    mebase = mebase[mebase["mebase"] > 0]
+    base = pd.merge(
+        held[["permno", "ffyear", "szport", "bmport"]],
+        mebase,
+        how="inner",
+        on=["permno", "ffyear"],
+    )
+    return base
+
+
+def calc_daily_portfolio_base_from_data(data_dir=DATA_DIR, cache=None):
+    """Run the monthly pipeline up to the June portfolio assignments and
+    return `calc_daily_portfolio_base`. With a `stage_cache.StageCache`,
+    the monthly stages are shared with `create_Fama_French_factors`.
+    """
+    crsp3, ccm_jun, _ = calc_Fama_French_1993_factors.run_prep_stages(
+        data_dir=data_dir, cache=cache
+    )
+    june = calc_Fama_French_1993_factors.calc_june_portfolio_assignments(ccm_jun)
+    return calc_daily_portfolio_base(june, crsp3)
+
+
+def calc_daily_portfolio_returns_chunk(crsp_d, base, carry):
+    """Value-weighted daily returns of the portfolios over one chunk of
+    dates.
+
+    Parameters
+    ----------
+    crsp_d : DataFrame
+        Daily records (`permno`, `dlycaldt`, `dlyret`, `dlyretx`) of a
+        range of dates.
+    base : DataFrame
+        Output of `calc_daily_portfolio_base`.
+    carry : Series
+        Cumulative `1+dlyretx` since the start of the Fama-French year,
+        up to the end of the previous chunk, indexed by
+        (`permno`, `ffyear`). Empty for the first chunk.
+
+    Returns
+    -------
+    portfolios : DataFrame
+        `dlycaldt`, `szport`, `bmport`, `vwret` and `n_firms`.
+    carry : Series
+        `carry` updated to the end of this chunk. Years that ended before
+        this chunk are dropped.
+    """
+    month = crsp_d["dlycaldt"].dt.month
+    year = crsp_d["dlycaldt"].dt.year
+    crsp_d = crsp_d.assign(ffyear=np.where(month >= 7, year, year - 1))
+    crsp_d = pd.merge(crsp_d, base, how="inner", on=["permno", "ffyear"])
+    crsp_d = crsp_d.sort_values(by=["permno", "dlycaldt"], ignore_index=True)
+
+    # Buy-and-hold drift. A missing return leaves the weight unchanged.
+    keys = [crsp_d["permno"], crsp_d["ffyear"]]
+    one_plus_retx = (1 + crsp_d["dlyretx"]).fillna(1.0)
+    cumretx = one_plus_retx.groupby(keys).cumprod()
+    L_cumretx = cumretx.groupby(keys).shift(1).fillna(1.0)
+    prior = carry.reindex(pd.MultiIndex.from_arrays(keys)).fillna(1.0).to_numpy()
+    crsp_d["wt"] = crsp_d["mebase"] * prior * L_cumretx
+
+    # Cumulative return at the end of the chunk, for the next chunk
+    cumretx = cumretx * prior
+    chunk_carry = cumretx.groupby(keys).last()
+    chunk_carry.index.names = ["permno", "ffyear"]
+    if len(carry):
+        carry = carry[carry.index.get_level_values("ffyear") >= crsp_d["ffyear"].min()]
+        carry = pd.concat([carry[~carry.index.isin(chunk_carry.index)], chunk_carry])
+    else:
+        carry = chunk_carry
+
+    crsp_d = crsp_d[crsp_d["wt"] > 0]
+    portfolios = calc_Fama_French_1993_factors.groupby_wavg_and_count(
+        crsp_d, ["dlycaldt", "szport", "bmport"], "dlyret", "wt"
+    ).reset_index()
+    return portfolios, carry
+
+
+def date_chunks(start_date, end_date, chunk_freq="QS"):
+    """Consecutive (start, end) date ranges covering `start_date` to
+    `end_date`, split at the boundaries of `chunk_freq` (e.g., "MS" for
+    months, "QS" for quarters or "YS" for years).
+    """
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    boundaries = pd.date_range(start_date, end_date, freq=chunk_freq)
+    starts = [start_date] + [b for b in boundaries if b > start_date]
+    ends = [s - pd.Timedelta(days=1) for s in starts[1:]] + [end_date]
+    return list(zip(starts, ends))
+
+
+def create_daily_Fama_French_factors(
+    data_dir=DATA_DIR,
+    base=None,
+    start_date=None,
+    end_date=None,
+    chunk_freq="QS",
+    cache=None,
+):
+    """Build the daily Fama-French 1993 portfolios and factors.
+
+    `base` is the output of `calc_daily_portfolio_base`. If None, it is
+    computed from the monthly data with
+    `calc_daily_portfolio_base_from_data` (using `cache` if given). The
+    daily panel is streamed from `start_date` to `end_date` (all saved
+    years by default) in chunks of `chunk_freq`.
+
+    Returns `ff_daily_factors` and `ff_daily_nfirms`, with the same
+    columns as `ff_factors` and `ff_nfirms` of the monthly pipeline and
+    one row per trading day.
+    """
+    if base is None:
+        base = calc_daily_portfolio_base_from_data(data_dir=data_dir, cache=cache)
+    years = load_CRSP_Compustat.CRSP_daily_years(data_dir=data_dir)
+    if start_date is None:
+        start_date = f"{years[0]}-01-01"
+    if end_date is None:
+        end_date = f"{years[-1]}-12-31"
+
+    columns = ["permno", "dlycaldt", "dlyret", "dlyretx"]
+    carry = pd.Series(dtype=float)
+    results = []
+    for chunk_start, chunk_end in date_chunks(start_date, end_date, chunk_freq):
+        crsp_d = load_CRSP_Compustat.load_CRSP_daily_stock_ciz(
+            data_dir=data_dir, start_date=chunk_start, end_date=chunk_end, columns=columns
+        )
+        if crsp_d.empty:
+            continue
+        portfolios, carry = calc_daily_portfolio_returns_chunk(crsp_d, base, carry)
+        results.append(portfolios)
+
+    portfolios = pd.concat(results, ignore_index=True).rename(columns={"dlycaldt": "jdate"})
+    portfolios["sbport"] = portfolios["szport"] + portfolios["bmport"]
+    vwret = portfolios[["jdate", "szport", "bmport", "vwret", "sbport"]]
+    vwret_n = portfolios[["jdate", "szport", "bmport", "n_firms", "sbport"]]
+    return calc_Fama_French_1993_factors.create_factors_from_portfolios(vwret, vwret_n)
+
+
+def _demo():
+    ff_daily_factors, ff_daily_nfirms = create_daily_Fama_French_factors(data_dir=DATA_DIR)
+    print(ff_daily_factors[["date", "WSMB", "WHML"]].describe())
+
+
+if __name__ == "__main__":
+    ff_daily_factors, ff_daily_nfirms = create_daily_Fama_French_factors(data_dir=DATA_DIR)
+    derived = Path(DATA_DIR) / "derived"
+    derived.mkdir(parents=True, exist_ok=True)
+    ff_daily_factors.to_parquet(derived / "FF_1993_daily_factors.parquet")
@@ -25,14 +25,22 @@ from pandas.tseries.offsets import MonthEnd, YearEnd
 import numpy as np
 from scipy import stats
 import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
+import calc_portfolio_sorts
 import load_CRSP_Compustat
+import misc_tools
+import stage_cache
+import stage_profile
 
 import config
 
 DATA_DIR = config.DATA_DIR
 OUTPUT_DIR = config.OUTPUT_DIR
 
+@stage_profile.profile_stage
 def calc_book_equity_and_years_in_compustat(comp):
     """Calculate book equity and number of years in Compustat.
 
@@ -85,6 +93,7 @@ def calc_book_equity_and_years_in_compustat(comp):
     return comp
 
 
+@stage_profile.profile_stage
 def subset_CRSP_to_common_stock_and_exchanges(crsp):
     """Subset to common stock universe and
     stocks traded on NYSE, AMEX and NASDAQ.
@@ -133,16 +142,42 @@ def subset_CRSP_to_common_stock_and_exchanges(crsp):
     return crsp
 
 
-def calculate_market_equity(crsp):
+@stage_profile.profile_stage
+def calculate_market_equity(crsp, vectorized=True):
     """
     'There were cases when the same firm (permco) had two or more securities
     (permno) on the same date. For the purpose of ME for the firm, we
     aggregated all ME for a given permco, date. This aggregated ME was assigned
     to the CRSP permno that has the largest ME.
+
+    With `vectorized=True` (the default), the permco ME and the largest
+    permno ME are computed with `transform('sum')` and `transform('max')`
+    on the same groupby, without merging on the float `me` column.
+    Exactly one permno is kept per permco and date: ties on ME go to the
+    smallest permno, and if ME is missing for every permno of the permco,
+    the smallest permno is kept. With `vectorized=False`, the original
+    merge is used, which keeps every permno that ties for the largest ME.
     """
     ## Calculate Market Equity
     crsp['me'] = crsp['mthprc'] * crsp['shrout']
 
+    if vectorized:
+        # Sorting by permno first makes the first row with the largest ME
+        # of each permco and date the one with the smallest permno.
+        crsp = crsp.sort_values(by=['permno', 'jdate']).reset_index(drop=True)
+        # Missing ME sorts below any ME
+        me_rank = crsp['me'].fillna(-np.inf)
+        grouped = pd.DataFrame({'me': crsp['me'], 'me_rank': me_rank}).groupby(
+            [crsp['permco'], crsp['jdate']], sort=False
+        )
+        sum_me = grouped['me'].transform('sum')
+        is_max = me_rank == grouped['me_rank'].transform('max')
+        # First (smallest permno) of the permnos with the largest ME
+        max_keys = crsp.loc[is_max, ['permco', 'jdate']]
+        largest = max_keys.index[~max_keys.duplicated()]
+        crsp['me'] = sum_me
+        return crsp.take(largest).reset_index(drop=True)
+
     ### Aggregate Market Cap ###
     # sum of me across different permno belonging to same permco a given date
     sum_me = crsp.groupby(['permco', 'jdate'])['me'].sum().reset_index()
@@ -166,31 +201,81 @@ def calculate_market_equity(crsp):
     return crsp
 
 
-def use_dec_market_equity(crsp2):
-    """
-    Finally, ME at June and December
-    were flagged since (1) December ME will be used to create Book-to-Market
-    ratio (BEME) and (2) June ME has to be positive in order to be part of
-    the portfolio.'
-
-    """
-    # THIS CODE IS COMPLETED FOR YOU
-
-    # keep December market cap
-    crsp2["year"] = crsp2["jdate"].dt.year
-    crsp2["month"] = crsp2["jdate"].dt.month
-    decme = crsp2[crsp2["month"] == 12]
-    decme = decme[["permno", "mthcaldt", "jdate", "me", "year"]].rename(
-        columns={"me": "dec_me"}
-    )
+def calc_cumulative_return_weights(permno, ffyear, ffmonth, one_plus_retx, me):
+    """Segment-wise kernel for the buy-and-hold weights of
+    `use_dec_market_equity`.
 
-    ### July to June dates
-    crsp2["ffdate"] = crsp2["jdate"] + MonthEnd(-6)
-    crsp2["ffyear"] = crsp2["ffdate"].dt.year
-    crsp2["ffmonth"] = crsp2["ffdate"].dt.month
-    crsp2["1+retx"] = 1 + crsp2["mthretx"]
-    crsp2 = crsp2.sort_values(by=["permno", "mthcaldt"])
+    The inputs are aligned arrays sorted by permno and date. Instead of
+    groupby objects, each stock (permno) and each stock-year
+    (permno, ffyear) is a contiguous segment found from where the keys
+    change. Returns a dict of arrays aligned with the inputs:
 
+    - `cumretx`: cumulative product of `1+retx` within (permno, ffyear),
+      skipping missing values like `groupby().cumprod()`
+    - `L_cumretx` and `L_me`: `cumretx` and `me` of the previous row of
+      the same permno. For the first row of a permno, `L_me` is
+      `me / (1+retx)`
+    - `count`: position of the row within its permno
+    - `mebase`: `L_me` in July (`ffmonth == 1`) of the stock-year
+    - `wt`: `L_me` in July and `mebase * L_cumretx` otherwise
+    """
+    permno = np.asarray(permno)
+    ffyear = np.asarray(ffyear)
+    ffmonth = np.asarray(ffmonth)
+    x = np.asarray(one_plus_retx, dtype=float)
+    me = np.asarray(me, dtype=float)
+    n = len(x)
+    idx = np.arange(n)
+
+    new_permno = np.ones(n, dtype=bool)
+    new_permno[1:] = permno[1:] != permno[:-1]
+    new_year = new_permno.copy()
+    new_year[1:] |= ffyear[1:] != ffyear[:-1]
+
+    # Position of each row within its permno and within its stock-year
+    count = idx - np.maximum.accumulate(np.where(new_permno, idx, 0))
+    year_pos = idx - np.maximum.accumulate(np.where(new_year, idx, 0))
+
+    # Cumulative product within stock-years. Each pass extends the
+    # products of all stock-years by one month (at most 12 passes with
+    # monthly data), multiplying in the same order as
+    # groupby().cumprod(). A missing return leaves the product unchanged.
+    missing = np.isnan(x)
+    x_filled = np.where(missing, 1.0, x)
+    cumretx = x_filled.copy()
+    for k in range(1, year_pos.max() + 1 if n else 0):
+        rows = np.flatnonzero(year_pos == k)
+        cumretx[rows] = cumretx[rows - 1] * x_filled[rows]
+    cumretx[missing] = np.nan
+
+    L_cumretx = np.roll(cumretx, 1)
+    L_cumretx[new_permno] = np.nan
+    L_me = np.roll(me, 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        L_me[new_permno] = me[new_permno] / x[new_permno]
+
+    # Broadcast L_me of each stock-year's July row to the whole stock-year
+    year_id = np.cumsum(new_year) - 1
+    is_july = ffmonth == 1
+    mebase_by_year = np.full(year_id[-1] + 1 if n else 0, np.nan)
+    mebase_by_year[year_id[is_july]] = L_me[is_july]
+    mebase = mebase_by_year[year_id]
+
+    wt = np.where(is_july, L_me, mebase * L_cumretx)
+    return {
+        "cumretx": cumretx,
+        "L_cumretx": L_cumretx,
+        "L_me": L_me,
+        "count": count,
+        "mebase": mebase,
+        "wt": wt,
+    }
+
+
+def _calc_cumulative_return_weights_groupby(crsp2):
+    """Original groupby and merge version of
+    `calc_cumulative_return_weights`. Returns `crsp3`.
+    """
     # cumret by stock
     crsp2["cumretx"] = crsp2.groupby(["permno", "ffyear"])["1+retx"].cumprod()
 
@@ -216,6 +301,54 @@ def use_dec_market_equity(crsp2):
     crsp3["wt"] = np.where(
         crsp3["ffmonth"] == 1, crsp3["L_me"], crsp3["mebase"] * crsp3["L_cumretx"]
     )
+    return crsp3
+
+
+@stage_profile.profile_stage
+def use_dec_market_equity(crsp2, segment_kernel=True):
+    """
+    Finally, ME at June and December
+    were flagged since (1) December ME will be used to create Book-to-Market
+    ratio (BEME) and (2) June ME has to be positive in order to be part of
+    the portfolio.'
+
+    With `segment_kernel=True` (the default), `cumretx`, `L_cumretx`,
+    `L_me`, `count`, `mebase` and `wt` are computed in one pass over the
+    sorted panel by `calc_cumulative_return_weights`, without groupby
+    objects or merging `mebase` back. With `segment_kernel=False`, the
+    original groupby and merge code is used.
+    """
+    # THIS CODE IS COMPLETED FOR YOU
+
+    # keep December market cap
+    crsp2["year"] = crsp2["jdate"].dt.year
+    crsp2["month"] = crsp2["jdate"].dt.month
+    decme = crsp2[crsp2["month"] == 12]
+    decme = decme[["permno", "mthcaldt", "jdate", "me", "year"]].rename(
+        columns={"me": "dec_me"}
+    )
+
+    ### July to June dates
+    crsp2["ffdate"] = crsp2["jdate"] + MonthEnd(-6)
+    crsp2["ffyear"] = crsp2["ffdate"].dt.year
+    crsp2["ffmonth"] = crsp2["ffdate"].dt.month
+    crsp2["1+retx"] = 1 + crsp2["mthretx"]
+    crsp2 = crsp2.sort_values(by=["permno", "mthcaldt"])
+
+    if segment_kernel:
+        weights = calc_cumulative_return_weights(
+            crsp2["permno"].to_numpy(),
+            crsp2["ffyear"].to_numpy(),
+            crsp2["ffmonth"].to_numpy(),
+            crsp2["1+retx"].to_numpy(),
+            crsp2["me"].to_numpy(),
+        )
+        crsp3 = crsp2.reset_index(drop=True)
+        for col, values in weights.items():
+            crsp3[col] = values
+    else:
+        crsp3 = _calc_cumulative_return_weights_groupby(crsp2)
+
 
     decme["year"] = decme["year"] + 1
     decme = decme[["permno", "year", "dec_me"]]
@@ -275,7 +408,118 @@ def book_to_market_bucket(row):
     return value
 
 
-def merge_CRSP_and_Compustat(crsp_jun, comp, ccm):
+def assign_size_buckets(me, sizemedn):
+    """Vectorized version of `size_bucket`.
+
+    Takes arrays of market equity and the matching NYSE size median and
+    returns an array of "S"/"B" labels. Produces exactly the same labels as
+    `size_bucket`, including the "B" that `size_bucket` assigns when the
+    breakpoint is missing.
+    """
+    me = np.asarray(me, dtype=float)
+    sizemedn = np.asarray(sizemedn, dtype=float)
+    return np.where(me <= sizemedn, "S", "B").astype(object)
+
+
+def assign_book_to_market_buckets(beme, bm30, bm70):
+    """Vectorized version of `book_to_market_bucket`.
+
+    Takes arrays of book-to-market and the matching NYSE 30th and 70th
+    percentile breakpoints and returns an array of "L"/"M"/"H" labels
+    ("" when no bucket applies). The conditions are evaluated in the same
+    order as the if/elif chain in `book_to_market_bucket`.
+    """
+    beme = np.asarray(beme, dtype=float)
+    bm30 = np.asarray(bm30, dtype=float)
+    bm70 = np.asarray(bm70, dtype=float)
+    return np.select(
+        [
+            (beme >= 0) & (beme <= bm30),
+            beme <= bm70,
+            beme > bm70,
+        ],
+        ["L", "M", "H"],
+        default="",
+    ).astype(object)
+
+
+def link_Compustat_to_CRSP(comp, ccm):
+    """Interval join of Compustat records to the CRSP/Compustat link table.
+
+    For every Compustat record, finds the link rows with the same `gvkey`
+    whose link is valid at the record's `jdate`
+    (`linkdt <= jdate <= linkenddt`, with a missing `linkenddt` treated as
+    today). Only index arrays of the candidate (record, link) pairs are
+    created; the output frame is built from the valid matches only, so
+    the full gvkey-level cross product of the two tables is never
+    materialized. The link table is not modified.
+
+    Returns the same rows, in the same order, as the left merge plus
+    filter in `merge_CRSP_and_Compustat(..., interval_join=False)`.
+    """
+    comp = comp[["gvkey", "datadate", "be", "count"]]
+    yearend = comp["datadate"] + YearEnd(0)
+    jdate = (yearend + MonthEnd(6)).to_numpy()
+
+    # Integer codes for gvkey, so the lookups below compare integers
+    # rather than strings. Compustat gvkeys without a link get -1.
+    link_code, link_gvkeys = pd.factorize(ccm["gvkey"])
+    comp_gvkey = comp["gvkey"].to_numpy()
+    comp_code = pd.Index(link_gvkeys).get_indexer(comp_gvkey)
+
+    # The sort is stable, so links keep their original order within a gvkey
+    order = np.argsort(link_code, kind="stable")
+    link_code = link_code[order]
+    ccm = ccm.iloc[order]
+    linkdt = ccm["linkdt"].to_numpy()
+    linkenddt = ccm["linkenddt"].fillna(pd.to_datetime("today")).to_numpy()
+
+    # Range [start, end) of link rows belonging to each Compustat record
+    start = np.searchsorted(link_code, comp_code, side="left")
+    end = np.searchsorted(link_code, comp_code, side="right")
+    n_links = end - start
+
+    # Candidate (record, link) pairs as integer positions
+    comp_pos = np.repeat(np.arange(len(comp)), n_links)
+    first_pair = np.repeat(np.cumsum(n_links) - n_links, n_links)
+    link_pos = np.repeat(start, n_links) + (np.arange(len(comp_pos)) - first_pair)
+
+    pair_jdate = jdate[comp_pos]
+    valid = (pair_jdate >= linkdt[link_pos]) & (pair_jdate <= linkenddt[link_pos])
+    comp_pos = comp_pos[valid]
+    link_pos = link_pos[valid]
+
+    ccm2 = pd.DataFrame(
+        {
+            "gvkey": comp_gvkey[comp_pos],
+            "permno": ccm["permno"].to_numpy()[link_pos],
+            "datadate": comp["datadate"].to_numpy()[comp_pos],
+            "yearend": yearend.to_numpy()[comp_pos],
+            "jdate": pair_jdate[valid],
+            "be": comp["be"].to_numpy()[comp_pos],
+            "count": comp["count"].to_numpy()[comp_pos],
+        }
+    )
+    return ccm2
+
+
+@stage_profile.profile_stage
+def merge_CRSP_and_Compustat(crsp_jun, comp, ccm, interval_join=True):
+    """Link Compustat book equity to the June CRSP records and compute
+    book-to-market.
+
+    With `interval_join=True` (the default), Compustat records are linked
+    to permnos with `link_Compustat_to_CRSP`, which only keeps the valid
+    (gvkey, permno, jdate) matches. With `interval_join=False`, all of
+    Compustat is first merged onto every link row by gvkey and then
+    filtered on the link dates.
+    """
+    if interval_join:
+        ccm2 = link_Compustat_to_CRSP(comp, ccm)
+        ccm_jun = pd.merge(crsp_jun, ccm2, how="inner", on=["permno", "jdate"])
+        ccm_jun["beme"] = ccm_jun["be"] * 1000 / ccm_jun["dec_me"]
+        return ccm_jun
+
     # THIS CODE IS COMPLETED FOR YOU
     # if linkenddt is missing then set to today date
     ccm["linkenddt"] = ccm["linkenddt"].fillna(pd.to_datetime("today"))
@@ -297,7 +541,18 @@ def merge_CRSP_and_Compustat(crsp_jun, comp, ccm):
     return ccm_jun
 
 
-def assign_size_and_bm_portfolios(ccm_jun, crsp3):
+@stage_profile.profile_stage
+def calc_june_portfolio_assignments(ccm_jun, vectorized=True):
+    """Assign stocks to the 2x3 size and book-to-market portfolios as of
+    June using NYSE breakpoints. Returns one row per permno and June with
+    the `szport` and `bmport` labels that hold from July to the next June.
+
+    With `vectorized=True` (the default), the buckets are assigned with
+    array operations (`assign_size_buckets` and
+    `assign_book_to_market_buckets`). With `vectorized=False`, the original
+    row-by-row `size_bucket` and `book_to_market_bucket` functions are
+    used. Both produce identical `szport` and `bmport` labels.
+    """
     # select NYSE stocks for bucket breakdown
     # legacy data format: exchcd = 1 and positive beme and positive me and shrcd 
     # in (10,11) and at least 2 years in compustat
@@ -334,17 +589,26 @@ def assign_size_and_bm_portfolios(ccm_jun, crsp3):
     # join back size and beme breakdown
     ccm1_jun = pd.merge(ccm_jun, nyse_breaks, how="left", on=["jdate"])
 
+    if vectorized:
+        size_labels = assign_size_buckets(ccm1_jun["me"], ccm1_jun["sizemedn"])
+        bm_labels = assign_book_to_market_buckets(
+            ccm1_jun["beme"], ccm1_jun["bm30"], ccm1_jun["bm70"]
+        )
+    else:
+        size_labels = ccm1_jun.apply(size_bucket, axis=1)
+        bm_labels = ccm1_jun.apply(book_to_market_bucket, axis=1)
+
     # assign size portfolio
     ccm1_jun["szport"] = np.where(
         (ccm1_jun["beme"] > 0) & (ccm1_jun["me"] > 0) & (ccm1_jun["count"] >= 1),
-        ccm1_jun.apply(size_bucket, axis=1),
+        size_labels,
         "",
     )
 
     # assign book-to-market portfolio
     ccm1_jun["bmport"] = np.where(
         (ccm1_jun["beme"] > 0) & (ccm1_jun["me"] > 0) & (ccm1_jun["count"] >= 1),
-        ccm1_jun.apply(book_to_market_bucket, axis=1),
+        bm_labels,
         "",
     )
 
@@ -360,7 +624,15 @@ def assign_size_and_bm_portfolios(ccm_jun, crsp3):
         ["permno", "mthcaldt", "jdate", "bmport", "szport", "posbm", "nonmissport"]
     ].copy()
     june["ffyear"] = june["jdate"].dt.year
+    return june
 
+
+@stage_profile.profile_stage
+def merge_june_portfolio_assignments(june, crsp3):
+    """Attach the June portfolio assignments to the monthly records of the
+    following July to June and keep only the records that meet the
+    criteria to be in a portfolio.
+    """
     # merge back with monthly records
     crsp3 = crsp3[
         [
@@ -394,6 +666,18 @@ def assign_size_and_bm_portfolios(ccm_jun, crsp3):
     return ccm4
 
 
+@stage_profile.profile_stage
+def assign_size_and_bm_portfolios(ccm_jun, crsp3, vectorized=True):
+    """Assign stocks to the 2x3 size and book-to-market portfolios using
+    NYSE breakpoints and attach the assignments to the monthly records.
+
+    See `calc_june_portfolio_assignments` for the `vectorized` option.
+    """
+    june = calc_june_portfolio_assignments(ccm_jun, vectorized=vectorized)
+    ccm4 = merge_june_portfolio_assignments(june, crsp3)
+    return ccm4
+
+
 def wavg(group, avg_name, weight_name):
     """function to calculate value weighted return
     """
@@ -404,10 +688,60 @@ def wavg(group, avg_name, weight_name):
     except ZeroDivisionError:
         return np.nan
 
-def create_fama_french_portfolios(ccm4):
+def groupby_wavg_and_count(
+    df, by, avg_name, weight_name, weight_where_notnull=False
+):
+    """Value-weighted average and count of non-missing values per group
+    in a single grouped reduction.
+
+    Computes sum(w * r), sum(w) and count(r) for every group in one
+    `groupby().sum()` and returns a DataFrame indexed by `by` with the
+    columns `vwret` and `n_firms`. By default, the denominator includes
+    the weights of rows with a missing `avg_name`, exactly like `wavg`.
+    Set `weight_where_notnull=True` to only use the weights of rows with a
+    non-missing `avg_name` (as in `misc_tools.groupby_weighted_average`).
+    A zero total weight gives the same NaN (or inf) that `wavg` gives.
+    """
+    d = df[avg_name]
+    w = df[weight_name]
+    notnull = d.notna()
+    sums = (
+        pd.DataFrame(
+            {
+                "_d_times_w": d * w,
+                "_w": w.where(notnull, 0) if weight_where_notnull else w,
+                "n_firms": notnull,
+            }
+        )
+        .groupby([df[col] for col in by])
+        .sum()
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vwret = sums["_d_times_w"].to_numpy() / sums["_w"].to_numpy()
+    return pd.DataFrame(
+        {"vwret": vwret, "n_firms": sums["n_firms"].to_numpy()}, index=sums.index
+    )
+
+
+@stage_profile.profile_stage
+def create_fama_french_portfolios(ccm4, vectorized=True):
     """Create value-weighted Fama-French portfolios
     and provide count of firms in each portfolio.
+
+    With `vectorized=True` (the default), the value-weighted returns and
+    the firm counts are computed together in one grouped reduction
+    (`groupby_wavg_and_count`). With `vectorized=False`, the original
+    `groupby().apply(wavg)` is used, followed by a separate count.
     """
+    if vectorized:
+        portfolios = groupby_wavg_and_count(
+            ccm4, ["jdate", "szport", "bmport"], "mthret", "wt"
+        ).reset_index()
+        portfolios["sbport"] = portfolios["szport"] + portfolios["bmport"]
+        vwret = portfolios[["jdate", "szport", "bmport", "vwret", "sbport"]]
+        vwret_n = portfolios[["jdate", "szport", "bmport", "n_firms", "sbport"]]
+        return vwret, vwret_n
+
     # THIS CODE IS COMPLETED FOR YOU
     # value-weigthed return
     vwret = (
@@ -431,6 +765,98 @@ def create_fama_french_portfolios(ccm4):
     return vwret, vwret_n
 
 
+def _calc_portfolios_for_formation_year(ccm_jun, crsp3):
+    """Portfolio assignments and value-weighted returns of a single
+    Fama-French year. Runs in a worker of
+    `calc_portfolios_by_formation_year`.
+    """
+    june = calc_june_portfolio_assignments(ccm_jun)
+    ccm4 = merge_june_portfolio_assignments(june, crsp3)
+    vwret, vwret_n = create_fama_french_portfolios(ccm4)
+    return june, vwret, vwret_n
+
+
+def _empty_portfolios_by_formation_year():
+    """`june`, `vwret` and `vwret_n` without rows, with the columns and
+    dtypes of the serial stages.
+    """
+    june = pd.DataFrame(
+        {
+            "permno": pd.Series(dtype="int32"),
+            "mthcaldt": pd.Series(dtype="datetime64[ns]"),
+            "jdate": pd.Series(dtype="datetime64[ns]"),
+            "bmport": pd.Series(dtype=object),
+            "szport": pd.Series(dtype=object),
+            "posbm": pd.Series(dtype="int64"),
+            "nonmissport": pd.Series(dtype="int64"),
+            "ffyear": pd.Series(dtype="int32"),
+        }
+    )
+    portfolios = pd.DataFrame(
+        {
+            "jdate": pd.Series(dtype="datetime64[ns]"),
+            "szport": pd.Series(dtype=object),
+            "bmport": pd.Series(dtype=object),
+            "vwret": pd.Series(dtype="float64"),
+            "n_firms": pd.Series(dtype="int64"),
+            "sbport": pd.Series(dtype=object),
+        }
+    )
+    vwret = portfolios[["jdate", "szport", "bmport", "vwret", "sbport"]]
+    vwret_n = portfolios[["jdate", "szport", "bmport", "n_firms", "sbport"]]
+    return june, vwret, vwret_n
+
+
+def calc_portfolios_by_formation_year(ccm_jun, crsp3, n_jobs=None):
+    """Run the sort and weighted-return stages
+    (`calc_june_portfolio_assignments`, `merge_june_portfolio_assignments`
+    and `create_fama_french_portfolios`) separately for every Fama-French
+    year in a `ProcessPoolExecutor`, and concatenate the results.
+
+    The June sort of year `ffyear` only uses that June's breakpoints and
+    is only applied to the July to June months of the same `ffyear`, so
+    the years are independent. Each worker is sent only the rows of its
+    year. `n_jobs` is the number of processes (all cores if None).
+
+    Returns `june`, `vwret` and `vwret_n`. `vwret` and `vwret_n` are
+    identical to the serial results. The rows of `june` are the same, but
+    ordered by year. Without formation years in `ccm_jun`, they are
+    empty.
+    """
+    if n_jobs is not None and n_jobs < 1:
+        raise ValueError(f"n_jobs must be at least 1 (or None), got {n_jobs}")
+    crsp3 = crsp3[
+        [
+            "mthcaldt", "permno", "sharetype", "securitytype", "securitysubtype",
+            "usincflg", "issuertype", "primaryexch", "conditionaltype",
+            "tradingstatusflg", "mthret", "me", "wt", "cumretx", "ffyear", "jdate",
+        ]
+    ]
+    crsp3_by_year = dict(list(crsp3.groupby("ffyear", sort=False)))
+    # Only years with a June sort can have portfolios
+    ccm_jun_by_year = ccm_jun.groupby(ccm_jun["jdate"].dt.year)
+    if ccm_jun_by_year.ngroups == 0:
+        return _empty_portfolios_by_formation_year()
+
+    max_workers = os.cpu_count() if n_jobs is None else n_jobs
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _calc_portfolios_for_formation_year,
+                ccm_jun_year,
+                crsp3_by_year.get(ffyear, crsp3.iloc[:0]),
+            )
+            for ffyear, ccm_jun_year in ccm_jun_by_year
+        ]
+        results = [future.result() for future in futures]
+
+    june, vwret, vwret_n = (
+        pd.concat([result[i] for result in results], ignore_index=True) for i in range(3)
+    )
+    return june, vwret, vwret_n
+
+
+@stage_profile.profile_stage
 def create_factors_from_portfolios(vwret, vwret_n):
 
     # tranpose
@@ -461,44 +887,430 @@ def create_factors_from_portfolios(vwret, vwret_n):
     ff_nfirms = ff_nfirms.rename(columns={"jdate": "date"})
     return ff_factors, ff_nfirms
 
-def create_Fama_French_factors(data_dir=DATA_DIR):
-        
-    ###########################
-    ## Load Data
-    ###########################
-
+def load_and_prep_compustat(data_dir=DATA_DIR):
+    """Load Compustat and calculate book equity (`comp`)."""
     comp = load_CRSP_Compustat.load_compustat(data_dir=data_dir)
-    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=data_dir)
+    return calc_book_equity_and_years_in_compustat(comp)
+
+
+def load_and_prep_CRSP(data_dir=DATA_DIR):
+    """Load the CRSP common stocks and calculate the market equity of
+    each firm (`crsp2`).
+    """
+    # The common stock and exchange filters are applied while reading.
+    # subset_CRSP_to_common_stock_and_exchanges is still applied below.
+    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(
+        data_dir=data_dir, common_stock_only=True
+    )
+    crsp = subset_CRSP_to_common_stock_and_exchanges(crsp)
+    # crsp['mthret']=crsp['mthret'].fillna(0)
+    # crsp['mthretx']=crsp['mthretx'].fillna(0)
+    return calculate_market_equity(crsp)
+
+
+def load_and_merge_CRSP_and_Compustat(crsp_jun, comp, data_dir=DATA_DIR):
+    """Load the CRSP-Compustat link table and merge the June CRSP records
+    with book equity (`ccm_jun`).
+    """
     ccm = load_CRSP_Compustat.load_CRSP_Comp_Link_Table(data_dir=data_dir)
+    return merge_CRSP_and_Compustat(crsp_jun, comp, ccm)
+
+
+def run_prep_stages(data_dir=DATA_DIR, cache=None, state_window=False):
+    """Run the load and prep stages (`comp`, `crsp2`, `crsp3` and
+    `crsp_jun`, and `ccm_jun`) through `cache` (see
+    `stage_cache.run_stage`) and return `crsp3`, `ccm_jun` and, with
+    `state_window=True`, the `calc_market_equity_state_window` of `crsp2`
+    (None otherwise).
+    """
+    pulled = Path(data_dir) / "pulled"
+    comp, comp_key = stage_cache.run_stage(
+        cache, "comp", load_and_prep_compustat, data_dir,
+        input_files=[pulled / "Compustat.parquet"],
+    )
+    crsp2, crsp2_key = stage_cache.run_stage(
+        cache, "crsp2", load_and_prep_CRSP, data_dir,
+        input_files=[pulled / "CRSP_stock_ciz.parquet"],
+    )
+    crsp2_window = None
+    if state_window:
+        # Taken before use_dec_market_equity adds its columns to crsp2
+        crsp2_window = calc_market_equity_state_window(crsp2)
+    (crsp3, crsp_jun), crsp3_key = stage_cache.run_stage(
+        cache, "crsp3", use_dec_market_equity, crsp2, upstream=[crsp2_key]
+    )
+    ccm_jun, _ = stage_cache.run_stage(
+        cache, "ccm_jun", load_and_merge_CRSP_and_Compustat, crsp_jun, comp, data_dir,
+        input_files=[pulled / "CRSP_Comp_Link_Table.parquet"],
+        upstream=[crsp3_key, comp_key],
+    )
+    return crsp3, ccm_jun, crsp2_window
+
+
+def create_Fama_French_factors(
+    data_dir=DATA_DIR,
+    save_state=False,
+    state_dir=None,
+    backend="pandas",
+    n_jobs=1,
+    cache=None,
+):
+    """Build the Fama-French 1993 portfolios and factors from scratch.
+
+    With `save_state=True`, the state needed by `update_Fama_French_factors`
+    to later append new months without a full rebuild is saved to
+    `state_dir` (see `save_Fama_French_state`).
+
+    With `backend="polars"`, the portfolios are built with the lazy polars
+    pipeline in `calc_Fama_French_1993_factors_polars.py` (which requires
+    polars) and returned as pandas DataFrames. Saving the incremental
+    state is only supported by the pandas backend.
+
+    With the pandas backend, `n_jobs` other than 1 runs the sort and
+    weighted-return stages in parallel across Fama-French years with
+    `n_jobs` processes (all cores if None). See
+    `calc_portfolios_by_formation_year`.
+
+    With the pandas backend, `cache` (a `stage_cache.StageCache`) stores
+    the intermediate `comp`, `crsp2`, `crsp3` and `crsp_jun`, and
+    `ccm_jun` stages. A stage is read back instead of recomputed when its
+    input files, upstream stages and code have not changed.
+
+    With `PROFILE_STAGES=True` (see `config.py`), the timing, memory and
+    row counts of the pandas stages are written to a JSON run log (see
+    `stage_profile.py`). Stages run in worker processes (`n_jobs` other
+    than 1) or read from `cache` are not recorded.
+    """
+    if backend == "polars":
+        if save_state:
+            raise ValueError("save_state is only supported with backend='pandas'")
+        import calc_Fama_French_1993_factors_polars
+
+        vwret, vwret_n = calc_Fama_French_1993_factors_polars.create_fama_french_portfolios_polars(
+            data_dir=data_dir
+        )
+        ff_factors, ff_nfirms = create_factors_from_portfolios(vwret, vwret_n)
+        return vwret, vwret_n, ff_factors, ff_nfirms
+    elif backend != "pandas":
+        raise ValueError(f"Unknown backend: {backend}")
+
+    stage_profile.start_run("create_Fama_French_factors")
 
     ###########################
-    ## Prep Data
+    ## Load and Prep Data
     ###########################
     # Prep CRSP and Compustat data according to the Fama-French 1993 
     # methodology described in the document linked in the 
     # module's docstring (at the top of this file).
-    comp = calc_book_equity_and_years_in_compustat(comp)
-    crsp = subset_CRSP_to_common_stock_and_exchanges(crsp)
-    # crsp['mthret']=crsp['mthret'].fillna(0)
-    # crsp['mthretx']=crsp['mthretx'].fillna(0)
-    crsp2 = calculate_market_equity(crsp)
-    crsp3, crsp_jun = use_dec_market_equity(crsp2)
-    ccm_jun = merge_CRSP_and_Compustat(crsp_jun, comp, ccm)
+    crsp3, ccm_jun, crsp2_window = run_prep_stages(
+        data_dir=data_dir, cache=cache, state_window=save_state
+    )
 
     ############################
     ## Form Fama French Factors
     ############################
-    ccm4 = assign_size_and_bm_portfolios(ccm_jun, crsp3)
-    vwret, vwret_n = create_fama_french_portfolios(ccm4)
+    if n_jobs == 1:
+        june = calc_june_portfolio_assignments(ccm_jun)
+        ccm4 = merge_june_portfolio_assignments(june, crsp3)
+        vwret, vwret_n = create_fama_french_portfolios(ccm4)
+    else:
+        june, vwret, vwret_n = calc_portfolios_by_formation_year(
+            ccm_jun, crsp3, n_jobs=n_jobs
+        )
     ff_factors, ff_nfirms = create_factors_from_portfolios(vwret, vwret_n)
+
+    if save_state:
+        save_Fama_French_state(
+            {
+                "crsp2_window": crsp2_window,
+                "june": june,
+                "vwret": vwret,
+                "vwret_n": vwret_n,
+                "ff_factors": ff_factors,
+                "ff_nfirms": ff_nfirms,
+            },
+            state_dir=_state_dir(data_dir, state_dir),
+        )
+    stage_profile.write_run_log()
     return vwret, vwret_n, ff_factors, ff_nfirms
 
 
-def compare_with_Ken_French_data_library(data_dir=DATA_DIR):
+###########################
+## Incremental updates
+###########################
+
+STATE_FILES = ["crsp2_window", "june", "vwret", "vwret_n", "ff_factors", "ff_nfirms"]
+
+
+def _state_dir(data_dir, state_dir=None):
+    if state_dir is None:
+        return Path(data_dir) / "derived" / "FF_1993_state"
+    return Path(state_dir)
+
+
+def calc_market_equity_state_window(crsp2):
+    """Rows of `crsp2` (the output of `calculate_market_equity`) that
+    `use_dec_market_equity` needs to process later months exactly as a
+    full rebuild would.
+
+    These are all rows from the June before the start of the latest
+    Fama-French year (July to June) onward, which cover the cumulative
+    returns, the July baseline market equity and the December market
+    equity of that year, plus the last row of every permno, which is the
+    lag used for a permno's next month.
+    """
+    last_ffyear = (crsp2["jdate"].max() + MonthEnd(-6)).year
+    window_start = pd.Timestamp(year=last_ffyear, month=6, day=30)
+    last_row = ~crsp2.duplicated(subset=["permno"], keep="last")
+    # crsp2 is sorted by permno and jdate by calculate_market_equity
+    return crsp2[(crsp2["jdate"] >= window_start) | last_row].copy()
+
+
+def save_Fama_French_state(state, state_dir):
+    """Save the incremental-update state to parquet files in `state_dir`.
+
+    The state consists of the market equity window
+    (`calc_market_equity_state_window`), the June portfolio assignments
+    (`calc_june_portfolio_assignments`) and the portfolio and factor
+    outputs built so far.
+    """
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    for name in STATE_FILES:
+        state[name].to_parquet(state_dir / f"{name}.parquet")
+
+
+def load_Fama_French_state(state_dir):
+    state_dir = Path(state_dir)
+    return {name: pd.read_parquet(state_dir / f"{name}.parquet") for name in STATE_FILES}
+
+
+def update_Fama_French_factors(data_dir=DATA_DIR, state_dir=None, check_parity=False):
+    """Append the portfolios and factors of months that are new since the
+    last saved state, without rebuilding the full history.
+
+    Only CRSP months after the last month in the saved state are
+    processed. The cumulative-return state and the June portfolio
+    assignments are taken from the saved state, and the new `vwret`,
+    `vwret_n`, `ff_factors` and `ff_nfirms` rows are appended to the
+    saved ones. Revisions to months that were already processed are not
+    picked up; run `create_Fama_French_factors(save_state=True)` to rebuild.
+
+    With `check_parity=True`, the result is compared with a full rebuild
+    and a ValueError is raised if they differ.
+    """
+    state_dir = _state_dir(data_dir, state_dir)
+    state = load_Fama_French_state(state_dir)
+    last_jdate = state["crsp2_window"]["jdate"].max()
+
+    comp = load_CRSP_Compustat.load_compustat(data_dir=data_dir)
+    # Only read the months after the saved state. Since last_jdate is a
+    # month end, mthcaldt > last_jdate is the same as jdate > last_jdate.
+    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(
+        data_dir=data_dir,
+        common_stock_only=True,
+        start_date=last_jdate + pd.Timedelta(days=1),
+    )
+    ccm = load_CRSP_Compustat.load_CRSP_Comp_Link_Table(data_dir=data_dir)
+
+    comp = calc_book_equity_and_years_in_compustat(comp)
+    crsp = subset_CRSP_to_common_stock_and_exchanges(crsp)
+    crsp = crsp[crsp["jdate"] > last_jdate]
+
+    if len(crsp) > 0:
+        # calculate_market_equity only combines records of the same month
+        crsp2_new = calculate_market_equity(crsp)
+        crsp2 = pd.concat([state["crsp2_window"], crsp2_new], ignore_index=True)
+        crsp2 = crsp2.sort_values(by=["permno", "jdate"])
+        crsp2_window = calc_market_equity_state_window(crsp2)
+
+        crsp3, crsp_jun = use_dec_market_equity(crsp2)
+        crsp3 = crsp3[crsp3["jdate"] > last_jdate]
+        crsp_jun = crsp_jun[crsp_jun["jdate"] > last_jdate]
+
+        june = state["june"]
+        if len(crsp_jun) > 0:
+            ccm_jun = merge_CRSP_and_Compustat(crsp_jun, comp, ccm)
+            june = pd.concat(
+                [june, calc_june_portfolio_assignments(ccm_jun)], ignore_index=True
+            )
+
+        ccm4 = merge_june_portfolio_assignments(june, crsp3)
+        vwret, vwret_n = create_fama_french_portfolios(ccm4)
+        ff_factors, ff_nfirms = create_factors_from_portfolios(vwret, vwret_n)
+
+        state = {
+            "crsp2_window": crsp2_window,
+            "june": june,
+            "vwret": pd.concat([state["vwret"], vwret], ignore_index=True),
+            "vwret_n": pd.concat([state["vwret_n"], vwret_n], ignore_index=True),
+            "ff_factors": pd.concat([state["ff_factors"], ff_factors], ignore_index=True),
+            "ff_nfirms": pd.concat([state["ff_nfirms"], ff_nfirms], ignore_index=True),
+        }
+        save_Fama_French_state(state, state_dir)
+
+    outputs = (state["vwret"], state["vwret_n"], state["ff_factors"], state["ff_nfirms"])
+
+    if check_parity:
+        rebuilt = create_Fama_French_factors(data_dir=data_dir)
+        names = ["vwret", "vwret_n", "ff_factors", "ff_nfirms"]
+        for name, output, expected in zip(names, outputs, rebuilt):
+            if not output.equals(expected):
+                raise ValueError(f"Updated {name} differs from a full rebuild")
+    return outputs
+
+
+###########################
+## Momentum (UMD)
+###########################
+
+
+def calc_prior_returns(crsp2, first_lag=2, last_lag=12, ret_col="mthret", date_col="jdate"):
+    """Cumulative return of every stock from month t-`last_lag` to month
+    t-`first_lag` (by default t-12 to t-2), aligned with the rows of
+    `crsp2`.
+
+    The window is a grouped rolling sum of log(1+ret) over the month
+    ordinal of each permno rather than over rows, so a missing month
+    (a gap in a stock's records) is not skipped over. The rolling sums are
+    differences of per-permno cumulative sums, looked up by
+    (permno, month) with `searchsorted`, without per-permno loops. The
+    prior return is missing unless all months of the window have a
+    return. `crsp2` must have at most one row per permno and month.
+    """
+    codes, _ = pd.factorize(crsp2["permno"])
+    month = misc_tools.calc_month_ordinal(crsp2[date_col])
+    logret = np.log1p(crsp2[ret_col].to_numpy(dtype=float))
+
+    # Sort by permno and month. Each permno's months are spread on a
+    # key line that leaves room for the lags below its first month.
+    span = month.max() - month.min() + last_lag + 2
+    key = codes.astype(np.int64) * span + (month - month.min() + last_lag + 1)
+    order = np.argsort(key, kind="stable")
+    key_sorted = key[order]
+    has_ret = ~np.isnan(logret[order])
+    cum_logret = np.concatenate([[0.0], np.cumsum(np.where(has_ret, logret[order], 0.0))])
+    cum_count = np.concatenate([[0], np.cumsum(has_ret)])
+
+    def cumulative_at(lag):
+        # Cumulative sums up to the last record of the same permno on or
+        # before month t - lag. The permno's first row is at
+        # start_of_permno, so earlier rows belong to another permno.
+        pos = np.searchsorted(key_sorted, key - lag, side="right")
+        start_of_permno = np.searchsorted(key_sorted, codes.astype(np.int64) * span, side="left")
+        pos = np.maximum(pos, start_of_permno)
+        return (
+            cum_logret[pos] - cum_logret[start_of_permno],
+            cum_count[pos] - cum_count[start_of_permno],
+        )
+
+    sum_end, count_end = cumulative_at(first_lag)
+    sum_start, count_start = cumulative_at(last_lag + 1)
+    n_months = last_lag - first_lag + 1
+    full_window = (count_end - count_start) == n_months
+    prior = np.where(full_window, np.expm1(sum_end - sum_start), np.nan)
+    return pd.Series(prior, index=crsp2.index, name="prior_ret")
+
+
+def calc_lagged_value(crsp2, col, lag=1, date_col="jdate"):
+    """Value of `col` for the same permno `lag` months earlier, aligned
+    with the rows of `crsp2`. Missing if the stock has no record for that
+    month. `crsp2` must have at most one row per permno and month.
+    """
+    lagged = misc_tools.lag_by_month_ordinal(
+        crsp2["permno"].to_numpy(),
+        misc_tools.calc_month_ordinal(crsp2[date_col]),
+        crsp2[col].to_numpy(dtype=float),
+        lag=lag,
+    )
+    return pd.Series(lagged, index=crsp2.index, name=f"L{lag}_{col}")
+
+
+def assign_momentum_portfolios(crsp2):
+    """Assign stocks every month to the 2x3 size and prior (t-12 to t-2)
+    return portfolios using NYSE breakpoints.
+
+    The portfolios for month t are formed at the end of month t-1 from
+    the ME at the end of t-1 (`me_lag`) and the prior return, and the
+    month t return is weighted by `me_lag`. Stocks need a positive
+    `me_lag` and a prior return. Size is split at the NYSE median and
+    the prior return at the NYSE 30th and 70th percentiles into Low (L),
+    Medium (M) and High (H).
+    """
+    mom = crsp2[["permno", "jdate", "primaryexch", "mthret"]].copy()
+    mom["me_lag"] = calc_lagged_value(crsp2, "me").to_numpy()
+    mom["prior_ret"] = calc_prior_returns(crsp2).to_numpy()
+
+    eligible = (mom["me_lag"] > 0) & mom["prior_ret"].notna()
+    ports = calc_portfolio_sorts.sort_portfolios(
+        mom,
+        sorts={"me_lag": [0.5], "prior_ret": [0.3, 0.7]},
+        universe=eligible & (mom["primaryexch"] == "N"),
+        eligible=eligible,
+        labels={"me_lag": ["S", "B"], "prior_ret": ["L", "M", "H"]},
+    )
+    mom["szport"] = np.array(["", "S", "B"], dtype=object)[ports["me_lag_port"]]
+    mom["momport"] = np.array(["", "L", "M", "H"], dtype=object)[ports["prior_ret_port"]]
+    return mom[(mom["szport"] != "") & (mom["momport"] != "")]
+
+
+def create_momentum_portfolios(mom):
+    """Value-weighted returns and firm counts of the 2x3 size and prior
+    return portfolios.
+    """
+    portfolios = groupby_wavg_and_count(
+        mom, ["jdate", "szport", "momport"], "mthret", "me_lag"
+    ).reset_index()
+    portfolios["smport"] = portfolios["szport"] + portfolios["momport"]
+    vwret = portfolios[["jdate", "szport", "momport", "vwret", "smport"]]
+    vwret_n = portfolios[["jdate", "szport", "momport", "n_firms", "smport"]]
+    return vwret, vwret_n
+
+
+def create_momentum_factor_from_portfolios(vwret, vwret_n):
+    """UMD = 1/2 (Small High + Big High) - 1/2 (Small Low + Big Low)."""
+    umd_factors = vwret.pivot(index="jdate", columns="smport", values="vwret").reset_index()
+    umd_nfirms = vwret_n.pivot(index="jdate", columns="smport", values="n_firms").reset_index()
+
+    umd_factors["WH"] = (umd_factors["BH"] + umd_factors["SH"]) / 2
+    umd_factors["WL"] = (umd_factors["BL"] + umd_factors["SL"]) / 2
+    umd_factors["WUMD"] = umd_factors["WH"] - umd_factors["WL"]
+    umd_factors = umd_factors.rename(columns={"jdate": "date"})
+
+    umd_nfirms["H"] = umd_nfirms["SH"] + umd_nfirms["BH"]
+    umd_nfirms["L"] = umd_nfirms["SL"] + umd_nfirms["BL"]
+    umd_nfirms["UMD"] = umd_nfirms["H"] + umd_nfirms["L"]
+    umd_nfirms = umd_nfirms.rename(columns={"jdate": "date"})
+    return umd_factors, umd_nfirms
+
+
+def create_momentum_factor(data_dir=DATA_DIR, crsp2=None, cache=None):
+    """Build the momentum (UMD) portfolios and factor from the panel
+    produced by `calculate_market_equity` (`crsp2`, loaded and prepared
+    with `load_and_prep_CRSP` if not given). With a
+    `stage_cache.StageCache`, `crsp2` is shared with
+    `create_Fama_French_factors`.
+
+    Returns `vwret`, `vwret_n`, `umd_factors` and `umd_nfirms`.
+    """
+    if crsp2 is None:
+        crsp2, _ = stage_cache.run_stage(
+            cache, "crsp2", load_and_prep_CRSP, data_dir,
+            input_files=[Path(data_dir) / "pulled" / "CRSP_stock_ciz.parquet"],
+        )
+    mom = assign_momentum_portfolios(crsp2)
+    vwret, vwret_n = create_momentum_portfolios(mom)
+    umd_factors, umd_nfirms = create_momentum_factor_from_portfolios(vwret, vwret_n)
+    return vwret, vwret_n, umd_factors, umd_nfirms
+
+
+def compare_with_Ken_French_data_library(data_dir=DATA_DIR, ff_factors=None):
     ######################################################
     # Compare With FF provided by Ken French Data Library 
     ######################################################
-    actual_ff = load_CRSP_Compustat.load_Fama_French_factors(data_dir=DATA_DIR)
+    if ff_factors is None:
+        ff_factors = pd.read_parquet(Path(data_dir) / "pulled" / "FF_1993_factors.parquet")
+    actual_ff = load_CRSP_Compustat.load_Fama_French_factors(data_dir=data_dir)
     actual_ff = actual_ff[["date", "smb", "hml"]]
 
     ff_compare = pd.merge(actual_ff, ff_factors[["date", "WSMB", "WHML"]], how="inner", on="date")
@@ -518,6 +1330,114 @@ def compare_with_Ken_French_data_library(data_dir=DATA_DIR):
     return ff_compare, ff_compare_post_1970
 
 
+# Columns of FF_FACTORS.parquet and their names in `ff_factors`
+# (and `umd_factors` of `create_momentum_factor`)
+KEN_FRENCH_FACTOR_COLUMNS = {"smb": "WSMB", "hml": "WHML", "umd": "WUMD"}
+
+
+def calc_parity_report(actual, manual, window=None, n_worst=5):
+    """Compare the columns of `manual` with the same columns of `actual`.
+
+    `actual` and `manual` are wide DataFrames indexed by date. Only the
+    dates and columns in both are compared, and within a column only the
+    dates where both values are present. All statistics are computed on
+    whole arrays, without a loop over columns.
+
+    Returns
+    -------
+    summary : DataFrame
+        One row per column with the number of observations, the
+        correlation, the tracking error (standard deviation of
+        `manual - actual`, per period), the mean and maximum absolute
+        deviation.
+    worst : DataFrame
+        The `n_worst` dates with the largest absolute deviation of each
+        column, with `actual`, `manual` and `diff`.
+    rolling_corr : DataFrame or None
+        Correlations over rolling windows of `window` periods (None if
+        `window` is None).
+    """
+    columns = actual.columns.intersection(manual.columns)
+    actual, manual = actual[columns].align(manual[columns], join="inner", axis=0)
+    both = actual.notna() & manual.notna()
+    actual, manual = actual.where(both), manual.where(both)
+    diff = manual - actual
+
+    summary = pd.DataFrame(
+        {
+            "n_obs": both.sum(),
+            "corr": actual.corrwith(manual),
+            "tracking_error": diff.std(),
+            "mean_diff": diff.mean(),
+            "max_abs_diff": diff.abs().max(),
+        }
+    )
+    summary.index.name = "column"
+
+    # Rows of the largest absolute deviations, column by column
+    abs_diff = diff.abs().fillna(-np.inf).to_numpy()
+    n_worst = min(n_worst, len(diff))
+    rows = np.argsort(-abs_diff, axis=0, kind="stable")[:n_worst].T
+    cols = np.broadcast_to(np.arange(len(columns))[:, None], rows.shape)
+    worst = pd.DataFrame(
+        {
+            "column": columns[cols.ravel()],
+            "rank": np.tile(np.arange(1, n_worst + 1), len(columns)),
+            "date": diff.index[rows.ravel()],
+            "actual": actual.to_numpy()[rows, cols].ravel(),
+            "manual": manual.to_numpy()[rows, cols].ravel(),
+            "diff": diff.to_numpy()[rows, cols].ravel(),
+        }
+    )
+    # Columns with fewer than n_worst observations
+    worst = worst.dropna(subset=["diff"]).reset_index(drop=True)
+
+    rolling_corr = None
+    if window is not None:
+        rolling_corr = actual.rolling(window, min_periods=window).corr(manual)
+    return summary, worst, rolling_corr
+
+
+def compare_with_Ken_French_report(
+    ff_factors,
+    vwret=None,
+    umd_factors=None,
+    data_dir=DATA_DIR,
+    start_date="1970-01-01",
+    window=60,
+    n_worst=5,
+):
+    """Parity report of the replicated factors (and, with `vwret`, the
+    six portfolios) against local copies of the Ken French data library
+    files in `data_dir / "pulled"`. Nothing is downloaded.
+
+    Factors are compared with FF_FACTORS.parquet (`smb`, `hml` and, with
+    `umd_factors` from `create_momentum_factor`, `umd`). The six
+    portfolios in `vwret` are compared with "6_Portfolios_2x3.CSV"
+    (see `load_CRSP_Compustat.load_Fama_French_6_portfolios`). Only dates
+    from `start_date` are used.
+
+    Returns `summary`, `worst` and `rolling_corr` of `calc_parity_report`.
+    """
+    manual = ff_factors.set_index("date")
+    if umd_factors is not None:
+        manual = manual.join(umd_factors.set_index("date")[["WUMD"]], how="outer")
+    manual = manual.rename(columns={v: k for k, v in KEN_FRENCH_FACTOR_COLUMNS.items()})
+    manual = manual[manual.columns.intersection(list(KEN_FRENCH_FACTOR_COLUMNS))]
+    actual = load_CRSP_Compustat.load_Fama_French_factors(data_dir=data_dir).set_index("date")
+    actual = actual[actual.columns.intersection(list(KEN_FRENCH_FACTOR_COLUMNS))]
+
+    if vwret is not None:
+        portfolios = vwret.pivot(index="jdate", columns="sbport", values="vwret")
+        manual = manual.join(portfolios, how="outer")
+        actual_portfolios = load_CRSP_Compustat.load_Fama_French_6_portfolios(data_dir=data_dir)
+        actual = actual.join(actual_portfolios.set_index("date"), how="outer")
+
+    manual = manual[manual.index >= start_date]
+    actual = actual[actual.index >= start_date]
+    return calc_parity_report(actual, manual, window=window, n_worst=n_worst)
+
+
 def demo():
     ff_compare, ff_compare_post_1970 = compare_with_Ken_French_data_library(data_dir=DATA_DIR)
     
@@ -535,7 +1455,9 @@ if __name__ == "__main__":
     ff_factors.to_parquet(DATA_DIR / "pulled" / "FF_1993_factors.parquet")
     ff_nfirms.to_parquet(DATA_DIR / "pulled" / "FF_1993_nfirms.parquet")
 
-    ff_compare, ff_compare_post_1970 = compare_with_Ken_French_data_library(data_dir=DATA_DIR)
+    ff_compare, ff_compare_post_1970 = compare_with_Ken_French_data_library(
+        data_dir=DATA_DIR, ff_factors=ff_factors
+    )
 
     ## Plot Comparison
     plt.figure(figsize=(16, 12))
@@ -0,0 +1,289 @@
+"""
+Polars implementation of the Fama-French 1993 factor pipeline in
+`calc_Fama_French_1993_factors.py`.
+
+Each step mirrors the pandas function of the same name, but works on a
+polars LazyFrame. The full pipeline is built as a single lazy query plan
+and is only executed at the end, which lets polars push down filters and
+projections into the parquet scans and run the plan on all cores.
+
+Use it through
+
+>>> create_Fama_French_factors(data_dir=DATA_DIR, backend="polars")
+
+in `calc_Fama_French_1993_factors.py`, which returns the same `vwret`,
+`vwret_n`, `ff_factors` and `ff_nfirms` DataFrames (as pandas) as the
+default pandas backend.
+"""
+import datetime
+from pathlib import Path
+
+import polars as pl
+
+import config
+
+DATA_DIR = config.DATA_DIR
+
+CRSP_FLAG_COLUMNS = [
+    "sharetype",
+    "securitytype",
+    "securitysubtype",
+    "usincflg",
+    "issuertype",
+    "primaryexch",
+    "conditionaltype",
+    "tradingstatusflg",
+]
+
+
+def scan_parquet_file_or_dataset(path):
+    """Scan the parquet file at `path`, or the dataset partitioned by year
+    at `path` (see `misc_tools.write_parquet_dataset_by_year`), whose
+    files do not hold the partition column `year`.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return pl.scan_parquet(path / "year=*" / "*.parquet")
+    return pl.scan_parquet(path)
+
+
+def scan_compustat(data_dir=DATA_DIR):
+    path = Path(data_dir) / "pulled" / "Compustat.parquet"
+    # `year` is the partition column of a dataset
+    return scan_parquet_file_or_dataset(path).with_columns(
+        year=pl.col("datadate").dt.year().cast(pl.Int32)
+    )
+
+
+def scan_CRSP_stock_ciz(data_dir=DATA_DIR):
+    path = Path(data_dir) / "pulled" / "CRSP_stock_ciz.parquet"
+    # The flags may be stored as dictionaries (pandas categoricals)
+    return scan_parquet_file_or_dataset(path).with_columns(
+        pl.col(CRSP_FLAG_COLUMNS).cast(pl.Utf8),
+        pl.col("permno", "permco").cast(pl.Int64),
+        pl.col("jdate").cast(pl.Date),
+    )
+
+
+def scan_CRSP_Comp_Link_Table(data_dir=DATA_DIR):
+    path = Path(data_dir) / "pulled" / "CRSP_Comp_Link_Table.parquet"
+    return scan_parquet_file_or_dataset(path).with_columns(pl.col("permno").cast(pl.Int64))
+
+
+def calc_book_equity_and_years_in_compustat(comp):
+    """See `calc_Fama_French_1993_factors.calc_book_equity_and_years_in_compustat`"""
+    ps = pl.coalesce("pstkrv", "pstkl", "pstk", pl.lit(0.0))
+    be = pl.col("seq") + pl.col("txditc").fill_null(0.0) - ps
+    return (
+        comp.with_columns(be=pl.when(be > 0).then(be).otherwise(None))
+        .sort(["gvkey", "datadate"])
+        .with_columns(count=pl.col("datadate").cumcount().over("gvkey").cast(pl.Int64))
+        .select(["gvkey", "datadate", "year", "be", "count"])
+    )
+
+
+def subset_CRSP_to_common_stock_and_exchanges(crsp):
+    """See `calc_Fama_French_1993_factors.subset_CRSP_to_common_stock_and_exchanges`"""
+    return crsp.filter(
+        (pl.col("sharetype") == "NS")
+        & (pl.col("securitytype") == "EQTY")
+        & (pl.col("securitysubtype") == "COM")
+        & (pl.col("usincflg") == "Y")
+        & pl.col("issuertype").is_in(["ACOR", "CORP"])
+        & pl.col("primaryexch").is_in(["N", "A", "Q"])
+        & (pl.col("conditionaltype") == "RW")
+        & (pl.col("tradingstatusflg") == "A")
+    )
+
+
+def calculate_market_equity(crsp):
+    """See `calc_Fama_French_1993_factors.calculate_market_equity`.
+
+    As in the pandas version, exactly one permno is kept per permco and
+    date: the one with the largest ME, with ties (or an ME missing for
+    every permno) going to the smallest permno.
+    """
+    me = pl.col("mthprc") * pl.col("shrout")
+    by = ["permco", "jdate"]
+    largest_permno = (
+        pl.col("permno")
+        .sort_by([pl.col("me").fill_null(float("-inf")), pl.col("permno")], descending=[True, False])
+        .first()
+        .over(by)
+    )
+    return (
+        crsp.with_columns(me=me)
+        .with_columns(largest_permno=largest_permno, sum_me=pl.col("me").sum().over(by))
+        .filter(pl.col("permno") == pl.col("largest_permno"))
+        .with_columns(me=pl.col("sum_me"))
+        .drop(["largest_permno", "sum_me"])
+        .sort(["permno", "jdate"])
+    )
+
+
+def use_dec_market_equity(crsp2):
+    """See `calc_Fama_French_1993_factors.use_dec_market_equity`"""
+    crsp2 = crsp2.with_columns(
+        year=pl.col("jdate").dt.year(),
+        month=pl.col("jdate").dt.month(),
+    )
+    decme = crsp2.filter(pl.col("month") == 12).select(
+        "permno", year=pl.col("year") + 1, dec_me=pl.col("me")
+    )
+
+    # July to June dates. Shifting a month end six month ends back gives
+    # the same month and year as the rules below.
+    crsp2 = crsp2.with_columns(
+        ffyear=pl.when(pl.col("month") >= 7).then(pl.col("year")).otherwise(pl.col("year") - 1),
+        ffmonth=(pl.col("month") + 5) % 12 + 1,
+        one_plus_retx=1 + pl.col("mthretx"),
+    ).sort(["permno", "mthcaldt"])
+
+    crsp2 = crsp2.with_columns(
+        cumretx=pl.col("one_plus_retx").cumprod().over(["permno", "ffyear"]),
+    ).with_columns(
+        L_cumretx=pl.col("cumretx").shift(1).over("permno"),
+        L_me=pl.col("me").shift(1).over("permno"),
+        count=pl.col("permno").cumcount().over("permno"),
+    ).with_columns(
+        L_me=pl.when(pl.col("count") == 0)
+        .then(pl.col("me") / pl.col("one_plus_retx"))
+        .otherwise(pl.col("L_me"))
+    )
+
+    mebase = crsp2.filter(pl.col("ffmonth") == 1).select(
+        "permno", "ffyear", mebase=pl.col("L_me")
+    )
+    crsp3 = crsp2.join(mebase, on=["permno", "ffyear"], how="left").with_columns(
+        wt=pl.when(pl.col("ffmonth") == 1)
+        .then(pl.col("L_me"))
+        .otherwise(pl.col("mebase") * pl.col("L_cumretx"))
+    )
+
+    crsp_jun = (
+        crsp3.filter(pl.col("month") == 6)
+        .join(decme, on=["permno", "year"], how="inner")
+        .select(
+            "permno", "mthcaldt", "jdate", *CRSP_FLAG_COLUMNS,
+            "mthret", "me", "wt", "cumretx", "mebase", "L_me", "dec_me",
+        )
+        .sort(["permno", "jdate"])
+        .unique(maintain_order=True)
+    )
+    return crsp3, crsp_jun
+
+
+def merge_CRSP_and_Compustat(crsp_jun, comp, ccm):
+    """See `calc_Fama_French_1993_factors.merge_CRSP_and_Compustat`"""
+    today = pl.lit(datetime.datetime.now())
+    ccm = ccm.with_columns(linkenddt=pl.col("linkenddt").fill_null(today))
+
+    # datadate + YearEnd(0) + MonthEnd(6) is June 30 of the following year
+    ccm2 = (
+        comp.select("gvkey", "datadate", "be", "count")
+        .join(ccm, on="gvkey", how="inner")
+        .with_columns(
+            jdate=pl.date(pl.col("datadate").dt.year() + 1, 6, 30),
+        )
+        .filter(
+            (pl.col("jdate").cast(pl.Datetime) >= pl.col("linkdt"))
+            & (pl.col("jdate").cast(pl.Datetime) <= pl.col("linkenddt"))
+        )
+        .select("gvkey", "permno", "datadate", "jdate", "be", "count")
+    )
+    ccm_jun = crsp_jun.join(ccm2, on=["permno", "jdate"], how="inner").with_columns(
+        beme=pl.col("be") * 1000 / pl.col("dec_me")
+    )
+    return ccm_jun
+
+
+def assign_size_and_bm_portfolios(ccm_jun, crsp3):
+    """See `calc_Fama_French_1993_factors.assign_size_and_bm_portfolios`"""
+    eligible = (pl.col("beme") > 0) & (pl.col("me") > 0) & (pl.col("count") >= 1)
+
+    nyse_breaks = (
+        ccm_jun.filter(eligible & (pl.col("primaryexch") == "N"))
+        .group_by("jdate")
+        .agg(
+            sizemedn=pl.col("me").median(),
+            bm30=pl.col("beme").quantile(0.3, interpolation="linear"),
+            bm70=pl.col("beme").quantile(0.7, interpolation="linear"),
+        )
+    )
+
+    # Same conditions as size_bucket and book_to_market_bucket. As there,
+    # a missing size breakpoint gives "B" and missing book-to-market
+    # breakpoints give "".
+    szport = pl.when(pl.col("me") <= pl.col("sizemedn")).then(pl.lit("S")).otherwise(pl.lit("B"))
+    bmport = (
+        pl.when((pl.col("beme") >= 0) & (pl.col("beme") <= pl.col("bm30"))).then(pl.lit("L"))
+        .when(pl.col("beme") <= pl.col("bm70")).then(pl.lit("M"))
+        .when(pl.col("beme") > pl.col("bm70")).then(pl.lit("H"))
+        .otherwise(pl.lit(""))
+    )
+    june = (
+        ccm_jun.join(nyse_breaks, on="jdate", how="left")
+        .with_columns(
+            szport=pl.when(eligible.fill_null(False)).then(szport).otherwise(pl.lit("")),
+            bmport=pl.when(eligible.fill_null(False)).then(bmport).otherwise(pl.lit("")),
+            posbm=pl.when(eligible.fill_null(False)).then(1).otherwise(0),
+        )
+        .with_columns(
+            nonmissport=pl.when(pl.col("bmport") != "").then(1).otherwise(0),
+            ffyear=pl.col("jdate").dt.year(),
+        )
+        .select("permno", "ffyear", "szport", "bmport", "posbm", "nonmissport")
+    )
+
+    ccm4 = crsp3.select(
+        "mthcaldt", "permno", *CRSP_FLAG_COLUMNS,
+        "mthret", "me", "wt", "cumretx", "ffyear", "jdate",
+    ).join(june, on=["permno", "ffyear"], how="left").filter(
+        (pl.col("wt") > 0) & (pl.col("posbm") == 1) & (pl.col("nonmissport") == 1)
+    )
+    return ccm4
+
+
+def create_fama_french_portfolios(ccm4):
+    """See `calc_Fama_French_1993_factors.create_fama_french_portfolios`.
+
+    As in `wavg`, the weights of missing returns are part of the
+    denominator.
+    """
+    return (
+        ccm4.group_by(["jdate", "szport", "bmport"])
+        .agg(
+            vwret=(pl.col("mthret") * pl.col("wt")).sum() / pl.col("wt").sum(),
+            n_firms=pl.col("mthret").is_not_null().sum().cast(pl.Int64),
+        )
+        .with_columns(
+            sbport=pl.col("szport") + pl.col("bmport"),
+            jdate=pl.col("jdate").cast(pl.Datetime("ns")),
+        )
+        .sort(["jdate", "szport", "bmport"])
+    )
+
+
+def create_Fama_French_factors_lazy(data_dir=DATA_DIR):
+    """Build the full pipeline as a single LazyFrame whose rows are the
+    value-weighted returns and firm counts of the portfolios.
+    """
+    comp = calc_book_equity_and_years_in_compustat(scan_compustat(data_dir=data_dir))
+    crsp = subset_CRSP_to_common_stock_and_exchanges(scan_CRSP_stock_ciz(data_dir=data_dir))
+    ccm = scan_CRSP_Comp_Link_Table(data_dir=data_dir)
+
+    crsp2 = calculate_market_equity(crsp)
+    crsp3, crsp_jun = use_dec_market_equity(crsp2)
+    ccm_jun = merge_CRSP_and_Compustat(crsp_jun, comp, ccm)
+    ccm4 = assign_size_and_bm_portfolios(ccm_jun, crsp3)
+    return create_fama_french_portfolios(ccm4)
+
+
+def create_fama_french_portfolios_polars(data_dir=DATA_DIR):
+    """Execute the lazy pipeline and return `vwret` and `vwret_n` as
+    pandas DataFrames with the same layout as the pandas backend.
+    """
+    portfolios = create_Fama_French_factors_lazy(data_dir=data_dir).collect().to_pandas()
+    vwret = portfolios[["jdate", "szport", "bmport", "vwret", "sbport"]]
+    vwret_n = portfolios[["jdate", "szport", "bmport", "n_firms", "sbport"]]
+    return vwret, vwret_n
@@ -0,0 +1,184 @@
+"""
+General characteristic-sorted portfolio engine.
+
+`calc_Fama_French_1993_factors.py` sorts stocks into 2x3 portfolios on
+size and book-to-market using NYSE breakpoints. The functions here
+generalize that step so that any characteristic (or set of
+characteristics) can be sorted on any set of breakpoint quantiles
+(e.g., quintiles, deciles, 5x5) using any breakpoint universe
+(e.g., NYSE stocks only or all exchanges).
+
+Breakpoints for all formation dates are computed in one grouped quantile
+pass, and buckets are assigned with array operations rather than
+row-by-row. As in the Fama-French 1993 code, a stock whose characteristic
+is exactly equal to a breakpoint is placed in the lower bucket.
+
+Example: Fama-French 2x3 size and book-to-market sort
+
+>>> eligible = (ccm_jun["beme"] > 0) & (ccm_jun["me"] > 0) & (ccm_jun["count"] >= 1)
+>>> ports = sort_portfolios(
+...     ccm_jun,
+...     sorts={"me": [0.5], "beme": [0.3, 0.7]},
+...     universe=eligible & (ccm_jun["primaryexch"] == "N"),
+...     eligible=eligible,
+...     labels={"me": ["S", "B"], "beme": ["L", "M", "H"]},
+...     sep="",
+... )
+
+Example: 5x5 size and book-to-market sort using NYSE breakpoints
+
+>>> quintiles = [0.2, 0.4, 0.6, 0.8]
+>>> ports = sort_portfolios(
+...     ccm_jun,
+...     sorts={"me": quintiles, "beme": quintiles},
+...     universe=eligible & (ccm_jun["primaryexch"] == "N"),
+...     eligible=eligible,
+... )
+"""
+import numpy as np
+import pandas as pd
+
+
+QUINTILES = [0.2, 0.4, 0.6, 0.8]
+DECILES = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+
+def calc_breakpoints(df, sorts, date_col="jdate", universe=None):
+    """Calculate breakpoints for every characteristic and every date in
+    one grouped quantile pass.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Panel with one row per stock and formation date.
+    sorts : dict
+        Maps each characteristic column to its list of breakpoint
+        quantiles, e.g., `{"me": [0.5], "beme": [0.3, 0.7]}`.
+    date_col : str
+        Column holding the formation date.
+    universe : array-like of bool, optional
+        Rows used to compute the breakpoints (e.g., NYSE stocks only).
+        All rows are used if None.
+
+    Returns
+    -------
+    dict
+        Maps each characteristic to a DataFrame indexed by date, with
+        one column per quantile.
+    """
+    if universe is not None:
+        df = df[np.asarray(universe, dtype=bool)]
+
+    all_quantiles = sorted({q for quantiles in sorts.values() for q in quantiles})
+    columns = list(sorts.keys())
+    # Quantiles of every characteristic at every date in a single pass.
+    # The result has a (date, quantile) MultiIndex.
+    bps = df.groupby(date_col)[columns].quantile(all_quantiles)
+
+    breakpoints = {}
+    for col, quantiles in sorts.items():
+        breakpoints[col] = bps[col].unstack()[list(quantiles)]
+    return breakpoints
+
+
+def assign_buckets(values, dates, breakpoints):
+    """Assign each value to a bucket given per-date breakpoints.
+
+    Buckets are numbered 1, ..., len(breakpoints.columns) + 1. A value
+    equal to a breakpoint goes into the lower bucket. Values that are
+    missing, or whose date has no (or missing) breakpoints, get 0.
+
+    Parameters
+    ----------
+    values : array-like
+        Characteristic values, one per row.
+    dates : array-like
+        Formation date of each row.
+    breakpoints : DataFrame
+        Indexed by date with one column per breakpoint, as returned by
+        `calc_breakpoints`.
+    """
+    values = np.asarray(values, dtype=float)
+    bp = breakpoints.to_numpy(dtype=float)
+
+    pos = breakpoints.index.get_indexer(pd.Index(dates))
+    has_bp = pos >= 0
+    row_bp = bp[np.where(has_bp, pos, 0)]
+
+    buckets = (values[:, None] > row_bp).sum(axis=1) + 1
+    valid = has_bp & ~np.isnan(values) & ~np.isnan(row_bp).any(axis=1)
+    return np.where(valid, buckets, 0)
+
+
+def sort_portfolios(
+    df,
+    sorts,
+    date_col="jdate",
+    universe=None,
+    eligible=None,
+    labels=None,
+    sep="_",
+):
+    """Independent sort of stocks into portfolios on one or more
+    characteristics.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Panel with one row per stock and formation date.
+    sorts : dict
+        Maps each characteristic column to its list of breakpoint
+        quantiles. A characteristic with k quantiles is split into
+        k + 1 buckets.
+    date_col : str
+        Column holding the formation date.
+    universe : array-like of bool, optional
+        Rows used to compute the breakpoints (e.g., NYSE stocks only).
+        All rows are used if None.
+    eligible : array-like of bool, optional
+        Rows that may be assigned to a portfolio. Ineligible rows get
+        bucket 0 and an empty portfolio label. All rows are eligible
+        if None.
+    labels : dict, optional
+        Maps a characteristic to the list of labels of its buckets,
+        e.g., `{"me": ["S", "B"]}`. Defaults to "1", "2", ....
+    sep : str
+        Separator used when combining the labels of each characteristic
+        into the `port` column.
+
+    Returns
+    -------
+    DataFrame
+        Aligned with `df`, with an integer bucket column `{col}_port` for
+        every characteristic and a `port` column with the combined label
+        (empty if the stock is not in every sort).
+    """
+    breakpoints = calc_breakpoints(df, sorts, date_col=date_col, universe=universe)
+    dates = df[date_col].to_numpy()
+    labels = {} if labels is None else labels
+
+    if eligible is None:
+        eligible = np.ones(len(df), dtype=bool)
+    else:
+        eligible = np.asarray(eligible, dtype=bool)
+
+    out = pd.DataFrame(index=df.index)
+    port = None
+    in_all_sorts = eligible.copy()
+    for col, quantiles in sorts.items():
+        buckets = assign_buckets(df[col], dates, breakpoints[col])
+        buckets = np.where(eligible, buckets, 0)
+        out[f"{col}_port"] = buckets
+        in_all_sorts &= buckets > 0
+
+        col_labels = labels.get(col, [str(i) for i in range(1, len(quantiles) + 2)])
+        if len(col_labels) != len(quantiles) + 1:
+            raise ValueError(
+                f"Expected {len(quantiles) + 1} labels for '{col}', got {len(col_labels)}"
+            )
+        # Index 0 (unassigned) maps to the empty label
+        col_labels = np.array([""] + list(col_labels), dtype=object)[buckets]
+        port = col_labels if port is None else port + sep + col_labels
+
+    out["port"] = np.where(in_all_sorts, port, "")
+    return out
@@ -25,10 +25,23 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 DATA_DIR = config('DATA_DIR', default=(BASE_DIR / 'data'), cast=Path)
 OUTPUT_DIR = config('OUTPUT_DIR', default=(BASE_DIR / 'output'), cast=Path)
 WRDS_USERNAME = config("WRDS_USERNAME", default="")
+# Connections opened at a time by concurrent pulls (see wrds_pool.py)
+WRDS_MAX_CONNECTIONS = config("WRDS_MAX_CONNECTIONS", default=4, cast=int)
+# Months before the latest stored date that incremental pulls query
+# again, to pick up restated rows
+RESTATEMENT_LOOKBACK_MONTHS = config("RESTATEMENT_LOOKBACK_MONTHS", default=12, cast=int)
+# Whether the pull scripts and doit tasks only pull the rows that are new
+# or restated since the stored data (see misc_tools.incremental_since)
+INCREMENTAL_PULLS = config("INCREMENTAL_PULLS", default=False, cast=bool)
 
 START_DATE = config("START_DATE", default="2017-01-01")
 END_DATE = config("END_DATE", default="2022-12-31")
 
+# Per-stage timing and memory of the factor pipeline, written to a JSON
+# run log in PROFILE_DIR (see stage_profile.py)
+PROFILE_STAGES = config("PROFILE_STAGES", default=False, cast=bool)
+PROFILE_DIR = config("PROFILE_DIR", default=(OUTPUT_DIR / "stage_profiles"), cast=Path)
+
 if __name__ == "__main__":
     
     ## If they don't exist, create the data and output directories
@@ -0,0 +1,781 @@
+"""
+Generate synthetic versions of the files pulled from WRDS, so that the
+factor and index pipelines can be run, benchmarked and regression-tested
+without WRDS credentials.
+
+The following files are written to `data_dir / "pulled"`, with the same
+columns and dtypes as the files saved by the pull functions:
+
+ - CRSP_stock_ciz.parquet (`load_CRSP_Compustat.pull_CRSP_stock_ciz`)
+ - Compustat.parquet (`load_CRSP_Compustat.pull_compustat`)
+ - CRSP_Comp_Link_Table.parquet (`load_CRSP_Compustat.pull_CRSP_Comp_Link_Table`)
+ - CRSP_MSF_INDEX_INPUTS.parquet (`load_CRSP_stock.pull_CRSP_monthly_file`)
+ - CRSP_MSIX.parquet (`load_CRSP_stock.pull_CRSP_index_files`)
+
+The panel is a one-factor model: each month, a stock returns
+`beta * market + sigma * noise`. Stocks list at random dates (a quarter
+of them are listed at the start of the sample) and delist at a constant
+rate per year, with CRSP-style delisting codes and returns, some of
+them missing. A small share of the firms have two share classes under
+the same PERMCO and GVKEY, some firms move from NASDAQ to NYSE, and
+a few records are ADRs, foreign or when-issued, so that the common stock
+filters have something to remove. Book equity is drawn from a
+book-to-market ratio applied to the market equity at the fiscal year
+end. With `link_churn`, a share of the CCM links is split in two, with a
+change of link type, sometimes a gap, and, for firms with two share
+classes, a change of primary PERMNO.
+
+The CRSP panels are generated and written in blocks of firms, so that
+memory is bounded by `block_size` whatever the number of firms. The
+index file is accumulated block by block and follows the CRSP index
+methodology on the synthetic monthly file (value weights are the market
+equity of the previous month). Its capitalization decile returns
+(`decret1`, ..., `decret10`) use NYSE breakpoints of the previous
+month's market equity and take a second pass over the blocks.
+
+>>> write_synthetic_data(data_dir=DATA_DIR, n_firms=40_000, start_year=1959, end_year=2022)
+
+`write_sqlite_stand_in` loads the synthetic files into SQLite databases
+that stand in for the WRDS tables the pull functions query, so that the
+pulls themselves can be tested locally.
+"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+import wrds
+from pandas.tseries.offsets import BMonthEnd, MonthEnd
+
+import config
+import load_CRSP_Compustat
+import load_CRSP_stock
+import misc_tools
+
+DATA_DIR = Path(config.DATA_DIR)
+
+# Delisting codes: mergers, exchanges, liquidations and the performance
+# codes that `load_CRSP_stock.apply_delisting_returns` sets to -30%.
+DELISTING_CODES = [231, 241, 331, 450, 500, 520, 551, 552, 560, 574, 580, 584]
+DELISTING_CODE_PROBS = [0.3, 0.1, 0.1, 0.1, 0.1, 0.05, 0.05, 0.05, 0.05, 0.04, 0.03, 0.03]
+
+EXCHANGES = np.array(["N", "A", "Q"])
+EXCHCD = {"N": 1, "A": 2, "Q": 3}
+
+
+def simulate_firms(
+    n_firms=1000,
+    start_year=1990,
+    end_year=2022,
+    delisting_rate=0.05,
+    share_class_rate=0.03,
+    seed=0,
+):
+    """Draw the characteristics of `n_firms` securities (one row per
+    PERMNO) listed between `start_year` and `end_year`.
+
+    `first_month` and `last_month` are positions in the months of the
+    sample. `delisted` is True if the security delists before the end of
+    the sample, at the annual rate `delisting_rate`. With probability
+    `share_class_rate`, a security is another share class of the
+    company of the previous one, with the same listing period.
+    """
+    rng = np.random.default_rng([seed, 0])
+    n_months = 12 * (end_year - start_year + 1)
+
+    first_month = rng.integers(0, max(n_months - 12, 1), n_firms)
+    first_month[rng.random(n_firms) < 0.25] = 0
+    life = rng.geometric(1 - (1 - delisting_rate) ** (1 / 12), n_firms)
+    last_month = np.minimum(first_month + life - 1, n_months - 1)
+    delisted = first_month + life - 1 < n_months - 1
+
+    second_class = rng.random(n_firms) < share_class_rate
+    second_class[0] = False
+    company = np.cumsum(~second_class) - 1
+    # Second share classes share the listing period of the first class
+    primary = np.flatnonzero(~second_class)[company]
+    first_month, last_month, delisted = (
+        first_month[primary],
+        last_month[primary],
+        delisted[primary],
+    )
+
+    firms = pd.DataFrame(
+        {
+            "permno": 10000 + np.arange(n_firms),
+            "permco": 50000 + company,
+            "gvkey": [f"{1000 + c:06d}" for c in company],
+            "company": company,
+            "first_month": first_month,
+            "last_month": last_month,
+            "delisted": delisted,
+            "dlstcd": np.where(
+                delisted, rng.choice(DELISTING_CODES, n_firms, p=DELISTING_CODE_PROBS), np.nan
+            ),
+            "primaryexch": rng.choice(EXCHANGES, n_firms, p=[0.35, 0.1, 0.55]),
+            # Month of a move from NASDAQ to NYSE (-1 if none)
+            "exch_switch_month": np.where(
+                rng.random(n_firms) < 0.05,
+                rng.integers(first_month, last_month + 1),
+                -1,
+            ),
+            "sharetype": rng.choice(["NS", "AD"], n_firms, p=[0.97, 0.03]),
+            "usincflg": rng.choice(["Y", "N"], n_firms, p=[0.96, 0.04]),
+            "issuertype": rng.choice(["CORP", "ACOR"], n_firms, p=[0.9, 0.1]),
+            "beta": rng.normal(1.0, 0.3, n_firms),
+            "sigma": rng.uniform(0.04, 0.12, n_firms),
+            "div_yield": np.where(rng.random(n_firms) < 0.4, rng.uniform(0.001, 0.004, n_firms), 0.0),
+            "price0": rng.lognormal(3.0, 0.5, n_firms),
+            "shrout0": np.round(rng.lognormal(9.0, 1.0, n_firms)) + 100,
+            "shares_growth": rng.normal(0.01, 0.03, n_firms),
+            "bm": rng.lognormal(-0.4, 0.6, n_firms),
+            "fyr": rng.choice([12, 6, 9, 3], n_firms, p=[0.7, 0.1, 0.1, 0.1]),
+            "siccd": rng.integers(1000, 9999, n_firms),
+        }
+    )
+    # Share classes of a company are A, B, ...
+    class_rank = firms.groupby("company").cumcount()
+    n_classes = firms.groupby("company")["permno"].transform("size")
+    firms["share_class"] = np.where(
+        n_classes > 1, (class_rank + ord("A")).map(chr), None
+    )
+    firms.loc[firms["primaryexch"] != "Q", "exch_switch_month"] = -1
+    firms["naics"] = (firms["siccd"] * 100 + 11).astype(str)
+    return firms
+
+
+def simulate_market_returns(n_months, seed=0):
+    """Monthly market returns of the one-factor model."""
+    rng = np.random.default_rng([seed, 1])
+    return rng.normal(0.008, 0.045, n_months)
+
+
+def simulate_monthly_panel(firms, market, months, seed=0, block=0):
+    """Monthly records of the securities in `firms`, one row per PERMNO
+    and month listed. Returns (with and without dividends) include the
+    delisting return in the delisting month, as in the CIZ format; the
+    delisting return itself is in `dlret`.
+    """
+    rng = np.random.default_rng([seed, 2, block])
+    n_obs = (firms["last_month"] - firms["first_month"] + 1).to_numpy()
+    firm = np.repeat(np.arange(len(firms)), n_obs)
+    starts = np.cumsum(n_obs) - n_obs
+    month = firms["first_month"].to_numpy()[firm] + np.arange(n_obs.sum()) - starts[firm]
+    get = lambda col: firms[col].to_numpy()[firm]
+
+    noise = rng.standard_normal(len(firm))
+    ret = np.maximum(get("beta") * market[month] + get("sigma") * noise, -0.95)
+    retx = ret - get("div_yield")
+    # Prices follow the returns without dividends
+    log_retx = np.log1p(retx)
+    log_retx[starts] = 0.0
+    cum = np.cumsum(log_retx)
+    prc = get("price0") * np.exp(cum - cum[starts][firm])
+    years_listed = (month - get("first_month")) // 12
+    shrout = np.round(get("shrout0") * np.exp(get("shares_growth") * years_listed))
+
+    # The first month of a security has no return
+    ret[starts] = np.nan
+    retx[starts] = np.nan
+
+    # Delisting returns, in the last month of delisted securities
+    last = starts + n_obs - 1
+    delisted = firms["delisted"].to_numpy()
+    dlstcd = np.full(len(firm), np.nan)
+    dlstcd[last[delisted]] = firms["dlstcd"].to_numpy()[delisted]
+    dlret = np.full(len(firm), np.nan)
+    codes = dlstcd[last[delisted]]
+    performance = codes >= 500
+    delist_ret = np.where(
+        performance,
+        rng.uniform(-0.8, 0.0, len(codes)),
+        rng.normal(0.02, 0.1, len(codes)),
+    )
+    # Performance delisting returns are often missing
+    delist_ret[performance & (rng.random(len(codes)) < 0.4)] = np.nan
+    dlret[last[delisted]] = delist_ret
+
+    exch = get("primaryexch").copy()
+    switch = get("exch_switch_month")
+    exch[(switch >= 0) & (month >= switch)] = "N"
+    conditionaltype = np.where(rng.random(len(firm)) < 0.005, "NW", "RW")
+
+    panel = pd.DataFrame(
+        {
+            "permno": get("permno"),
+            "permco": get("permco"),
+            "month": month,
+            "mthcaldt": months["mthcaldt"].to_numpy()[month],
+            "ret": ret,
+            "retx": retx,
+            "dlret": dlret,
+            "dlstcd": dlstcd,
+            "prc": prc,
+            "shrout": shrout,
+            "primaryexch": exch,
+            "conditionaltype": conditionaltype,
+        }
+    )
+    for col in ["sharetype", "usincflg", "issuertype", "share_class", "company", "siccd", "naics"]:
+        panel[col] = get(col)
+    return panel
+
+
+def to_CRSP_stock_ciz(panel):
+    """Monthly panel in the format of `pull_CRSP_stock_ciz`."""
+    has_dlret = panel["dlret"].notna()
+    crsp = pd.DataFrame(
+        {
+            "permno": panel["permno"],
+            "permco": panel["permco"],
+            "mthcaldt": panel["mthcaldt"],
+            "issuertype": panel["issuertype"],
+            "securitytype": "EQTY",
+            "securitysubtype": "COM",
+            "sharetype": panel["sharetype"],
+            "usincflg": panel["usincflg"],
+            "primaryexch": panel["primaryexch"],
+            "conditionaltype": panel["conditionaltype"],
+            "tradingstatusflg": "A",
+            "mthret": panel["ret"].where(~has_dlret, (1 + panel["ret"]) * (1 + panel["dlret"]) - 1),
+            "mthretx": panel["retx"].where(~has_dlret, (1 + panel["retx"]) * (1 + panel["dlret"]) - 1),
+            "shrout": panel["shrout"],
+            "mthprc": panel["prc"],
+        }
+    )
+    crsp = misc_tools.apply_dtype_schema(crsp, load_CRSP_Compustat.schema_crsp)
+    crsp["jdate"] = crsp["mthcaldt"] + MonthEnd(0)
+    return crsp
+
+
+def to_CRSP_MSF_INDEX_INPUTS(panel, seed=0, block=0):
+    """Monthly panel in the (SIZ) format of `pull_CRSP_monthly_file`,
+    after its share code filter and `apply_delisting_returns`.
+    """
+    rng = np.random.default_rng([seed, 3, block])
+    shrcd = np.select(
+        [panel["sharetype"] == "AD", panel["usincflg"] == "N", panel["share_class"].notna()],
+        [31, 12, 10],
+        default=11,
+    )
+    # Bid/ask averages (no trade during the month) have negative prices.
+    # Securities that delist have no month-end price in their last month.
+    prc = np.where(rng.random(len(panel)) < 0.03, -panel["prc"], panel["prc"])
+    delisting = panel["dlstcd"].notna().to_numpy()
+    prc[delisting] = np.nan
+    msf = pd.DataFrame(
+        {
+            "date": panel["mthcaldt"],
+            "permno": panel["permno"],
+            "permco": panel["permco"],
+            "shrcd": shrcd,
+            "exchcd": panel["primaryexch"].map(EXCHCD),
+            "comnam": "SYNTHETIC COMPANY " + panel["company"].astype(str),
+            "shrcls": panel["share_class"],
+            "ret": panel["ret"],
+            "retx": panel["retx"],
+            "dlret": panel["dlret"],
+            "dlretx": panel["dlret"],
+            "dlstcd": panel["dlstcd"],
+            "prc": prc,
+            "altprc": np.abs(prc),
+            "vol": np.round(panel["shrout"] * rng.uniform(0.01, 0.2, len(panel))),
+            "shrout": panel["shrout"] * 1000,
+            "cfacshr": 1.0,
+            "cfacpr": 1.0,
+            "naics": panel["naics"],
+            "siccd": panel["siccd"],
+        }
+    )
+    msf = msf[np.isin(shrcd, [10, 11, 20, 21, 40, 41, 70, 71, 73])]
+    msf = load_CRSP_stock.apply_delisting_returns(msf.reset_index(drop=True))
+    msf = misc_tools.apply_dtype_schema(msf, load_CRSP_stock.schema_msf)
+    return msf
+
+
+def calc_lagged_cap(msf, month):
+    """Market equity of the records of `msf` (sorted by PERMNO and date)
+    and of the same PERMNO in the previous month, missing after a gap.
+    `month` is the position of each record in the months of the sample.
+    """
+    cap = (msf["altprc"] * msf["shrout"]).to_numpy()
+    same_permno = np.r_[False, msf["permno"].to_numpy()[1:] == msf["permno"].to_numpy()[:-1]]
+    consecutive = same_permno & (np.r_[-2, month[:-1]] == month - 1)
+    lag_cap = np.where(consecutive, np.r_[np.nan, cap[:-1]], np.nan)
+    return cap, lag_cap
+
+
+def calc_index_sums(msf, months):
+    """Per-month sums over the records of `msf` that the CRSP index
+    returns are made of. Sums of different blocks of PERMNOs add up, and
+    `sums_to_CRSP_MSIX` turns the total into the index file.
+    """
+    n_months = len(months)
+    month = months["mthcaldt"].searchsorted(msf["date"]).astype(int)
+    # Value weights are last month's market equity of the same PERMNO
+    cap, lag_cap = calc_lagged_cap(msf, month)
+    ret, retx = msf["ret"].to_numpy(), msf["retx"].to_numpy()
+    used = ~np.isnan(lag_cap) & ~np.isnan(ret) & ~np.isnan(retx)
+    has_ret = ~np.isnan(ret) & ~np.isnan(retx)
+
+    def month_sum(values, mask):
+        return np.bincount(month[mask], weights=values[mask], minlength=n_months)
+
+    return pd.DataFrame(
+        {
+            "vw_ret": month_sum(lag_cap * ret, used),
+            "vw_retx": month_sum(lag_cap * retx, used),
+            "usdval": month_sum(lag_cap, used),
+            "usdcnt": month_sum(np.ones(len(msf)), used),
+            "ew_ret": month_sum(ret, has_ret),
+            "ew_retx": month_sum(retx, has_ret),
+            "ew_cnt": month_sum(np.ones(len(msf)), has_ret),
+            "totval": month_sum(cap, ~np.isnan(cap)),
+            # Every record of the month, delisting records without a price too
+            "totcnt": np.bincount(month, minlength=n_months),
+        }
+    )
+
+
+def calc_breakpoint_caps(msf, months):
+    """Month and previous month's market equity of the NYSE records of
+    `msf`, from which `calc_decile_breakpoints` computes the breakpoints
+    of the capitalization deciles.
+    """
+    month = months["mthcaldt"].searchsorted(msf["date"]).astype(int)
+    _, lag_cap = calc_lagged_cap(msf, month)
+    nyse = (msf["exchcd"].to_numpy() == 1) & ~np.isnan(lag_cap)
+    return pd.DataFrame({"month": month[nyse], "lag_cap": lag_cap[nyse]})
+
+
+def calc_decile_breakpoints(breakpoint_caps, months):
+    """Capitalization decile breakpoints of every month (one row per
+    month, one column per decile 1-9 upper bound): percentiles of the
+    previous month's market equity of NYSE stocks.
+    """
+    breakpoints = (
+        breakpoint_caps.groupby("month")["lag_cap"]
+        .quantile(np.arange(1, 10) / 10)
+        .unstack()
+    )
+    return breakpoints.reindex(range(len(months)))
+
+
+def calc_decile_sums(msf, months, breakpoints):
+    """Per-month and decile sums over the records of `msf` that the
+    decile returns (`decret1`, ..., `decret10`, decile 1 holding the
+    smallest stocks) are made of. Stocks are assigned to deciles by their
+    previous month's market equity, which is also their value weight.
+    Sums of different blocks of PERMNOs add up.
+    """
+    n_months = len(months)
+    month = months["mthcaldt"].searchsorted(msf["date"]).astype(int)
+    _, lag_cap = calc_lagged_cap(msf, month)
+    month_breakpoints = breakpoints.to_numpy()[month]
+    decile = (lag_cap[:, None] > month_breakpoints).sum(axis=1)
+    ret = msf["ret"].to_numpy()
+    used = ~np.isnan(lag_cap) & ~np.isnan(ret) & ~np.isnan(month_breakpoints[:, 0])
+    group = month[used] * 10 + decile[used]
+
+    def group_sum(values):
+        sums = np.bincount(group, weights=values[used], minlength=n_months * 10)
+        return sums.reshape(n_months, 10)
+
+    return {"dec_ret": group_sum(lag_cap * ret), "dec_val": group_sum(lag_cap)}
+
+
+def sums_to_CRSP_MSIX(sums, months, decile_sums=None):
+    """Index file (`caldt`, value- and equal-weighted returns with and
+    without dividends, total and used values and counts) from the
+    per-month sums of `calc_index_sums`, with the decile returns of the
+    per-month and decile sums of `calc_decile_sums`, if given.
+    """
+    msix = pd.DataFrame(
+        {
+            "caldt": months["mthcaldt"],
+            "vwretd": sums["vw_ret"] / sums["usdval"],
+            "vwretx": sums["vw_retx"] / sums["usdval"],
+            "ewretd": sums["ew_ret"] / sums["ew_cnt"],
+            "ewretx": sums["ew_retx"] / sums["ew_cnt"],
+            "totval": sums["totval"] / 1000,
+            "totcnt": sums["totcnt"].astype(int),
+            "usdval": sums["usdval"] / 1000,
+            "usdcnt": sums["usdcnt"].astype(int),
+        }
+    )
+    if decile_sums is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            decret = decile_sums["dec_ret"] / decile_sums["dec_val"]
+        for j in range(10):
+            msix[f"decret{j + 1}"] = decret[:, j]
+    return msix[msix["usdcnt"] > 0].reset_index(drop=True)
+
+
+def simulate_compustat(firms, panel, months, seed=0, block=0):
+    """Annual Compustat records of the companies in `firms` (one GVKEY
+    per company, from its first share class), in the format of
+    `pull_compustat`. Coverage starts up to 4 years before the CRSP
+    listing and ends with the last fiscal year before delisting.
+
+    Book equity is the firm's book-to-market ratio times the market
+    equity at the fiscal year end, and is split into `seq`, `txditc`
+    and the preferred stock items so that
+    `calc_book_equity_and_years_in_compustat` recovers it.
+    """
+    rng = np.random.default_rng([seed, 4, block])
+    firms = firms.reset_index(drop=True)
+    first_class = firms.drop_duplicates("company")
+    positions = first_class.index.to_numpy()
+
+    start_years = months["year"].to_numpy()[first_class["first_month"]] - rng.integers(0, 5, len(first_class))
+    end_years = months["year"].to_numpy()[first_class["last_month"]]
+    n_years = end_years - start_years + 1
+    rows = np.repeat(np.arange(len(first_class)), n_years)
+    year = start_years[rows] + np.arange(n_years.sum()) - np.repeat(np.cumsum(n_years) - n_years, n_years)
+    fyr = first_class["fyr"].to_numpy()[rows]
+    datadate = pd.to_datetime(
+        pd.DataFrame({"year": year, "month": fyr, "day": 1})
+    ) + MonthEnd(0)
+
+    # Market equity (millions) at the fiscal year end, or at the closest
+    # listed month
+    month = np.clip(
+        (year - months["year"].iloc[0]) * 12 + fyr - 1,
+        first_class["first_month"].to_numpy()[rows],
+        first_class["last_month"].to_numpy()[rows],
+    )
+    n_obs = (firms["last_month"] - firms["first_month"] + 1).to_numpy()
+    offsets = (np.cumsum(n_obs) - n_obs)[positions]
+    panel_row = offsets[rows] + month - first_class["first_month"].to_numpy()[rows]
+    me = (panel["prc"] * panel["shrout"]).to_numpy()[panel_row] / 1000
+
+    be = first_class["bm"].to_numpy()[rows] * rng.lognormal(0, 0.2, len(rows)) * me
+    be[rng.random(len(rows)) < 0.03] *= -0.2
+    txditc = np.where(rng.random(len(rows)) < 0.6, 0.05 * np.abs(be), np.nan)
+    pstkrv = np.where(rng.random(len(rows)) < 0.2, 0.02 * np.abs(be), np.nan)
+    pstkl = np.where(rng.random(len(rows)) < 0.3, 0.02 * np.abs(be), np.nan)
+    pstk = np.where(rng.random(len(rows)) < 0.4, 0.02 * np.abs(be), np.nan)
+    ps = np.nan_to_num(pd.Series(pstkrv).fillna(pd.Series(pstkl)).fillna(pd.Series(pstk)).to_numpy())
+    seq = be - np.nan_to_num(txditc) + ps
+    seq[rng.random(len(rows)) < 0.02] = np.nan
+
+    comp = pd.DataFrame(
+        {
+            "gvkey": first_class["gvkey"].to_numpy()[rows],
+            "datadate": datadate,
+            "at": np.abs(be) * rng.uniform(1.5, 4.0, len(rows)),
+            "pstkl": pstkl,
+            "txditc": txditc,
+            "pstkrv": pstkrv,
+            "seq": seq,
+            "pstk": pstk,
+        }
+    )
+    comp["year"] = comp["datadate"].dt.year
+    comp = misc_tools.apply_dtype_schema(comp, load_CRSP_Compustat.schema_compustat)
+    return comp
+
+
+def simulate_link_table(firms, months, link_churn=0.1, seed=0, block=0):
+    """CCM links of the companies in `firms`, in the format of
+    `pull_CRSP_Comp_Link_Table`.
+
+    Each company is linked to its first share class from before its
+    first CRSP month until it delists (`linkenddt` is missing for active
+    links). With probability `link_churn`, the link is split at a random
+    month into two rows with different link types; 30% of the split
+    links have a gap of 1 to 6 months without a link, and companies with
+    two share classes move the primary link to the second class.
+    """
+    rng = np.random.default_rng([seed, 5, block])
+    first_class = firms.drop_duplicates("company")
+    second_class = firms[firms["share_class"] == "B"].set_index("company")["permno"]
+    n = len(first_class)
+    month_ends = months["month_end"]
+
+    first, last = first_class["first_month"].to_numpy(), first_class["last_month"].to_numpy()
+    linkdt = month_ends.to_numpy()[first] - pd.to_timedelta(
+        rng.integers(0, 28, n) + 31 * rng.integers(0, 24, n), unit="D"
+    )
+    linkenddt = np.where(
+        first_class["delisted"], month_ends.to_numpy()[last], np.datetime64("NaT")
+    )
+    links = pd.DataFrame(
+        {
+            "gvkey": first_class["gvkey"].to_numpy(),
+            "permno": first_class["permno"].to_numpy(),
+            "linktype": rng.choice(["LC", "LU", "LS"], n, p=[0.7, 0.27, 0.03]),
+            "linkprim": rng.choice(["P", "C"], n, p=[0.9, 0.1]),
+            "linkdt": linkdt,
+            "linkenddt": pd.to_datetime(linkenddt),
+            "company": first_class["company"].to_numpy(),
+        }
+    )
+
+    churn = (rng.random(n) < link_churn) & (last - first >= 3)
+    first, last = first[churn], last[churn]
+    split = rng.integers(first + 1, last - 1)
+    gap = np.where(rng.random(len(split)) < 0.3, rng.integers(1, 7, len(split)), 0)
+    before = links[churn].copy()
+    after = links[churn].copy()
+    before["linkenddt"] = month_ends.to_numpy()[split - 1]
+    before["linktype"] = "LU"
+    after["linkdt"] = (month_ends.iloc[np.minimum(split + gap, last)] - pd.offsets.MonthBegin(1)).to_numpy()
+    after["linktype"] = "LC"
+    after["permno"] = after["company"].map(second_class).fillna(after["permno"]).to_numpy()
+
+    links = pd.concat([links[~churn], before, after]).drop(columns="company")
+    links = links.sort_values(["gvkey", "linkdt"], ignore_index=True)
+    links = misc_tools.apply_dtype_schema(links, load_CRSP_Compustat.schema_crsp_comp_link)
+    return links
+
+
+def sample_months(start_year, end_year):
+    """Months of the sample, with their month end, last trading day
+    (`mthcaldt`) and year.
+    """
+    month_end = pd.date_range(f"{start_year}-01-31", f"{end_year}-12-31", freq="M")
+    return pd.DataFrame(
+        {
+            "month_end": month_end,
+            "mthcaldt": pd.date_range(month_end[0] - BMonthEnd(1), month_end[-1], freq="BM")[-len(month_end):],
+            "year": month_end.year,
+        }
+    )
+
+
+def write_synthetic_data(
+    data_dir=DATA_DIR,
+    n_firms=1000,
+    start_year=1990,
+    end_year=2022,
+    link_churn=0.1,
+    delisting_rate=0.05,
+    block_size=5000,
+    seed=0,
+):
+    """Write the synthetic CRSP, Compustat and CCM files to
+    `data_dir / "pulled"` and return their paths.
+
+    Parameters
+    ----------
+    n_firms : int
+        Number of securities (PERMNOs) over the whole sample.
+    start_year, end_year : int
+        First and last calendar year of the monthly files.
+    link_churn : float
+        Share of the CCM links that are split in two (see
+        `simulate_link_table`).
+    delisting_rate : float
+        Annual probability that a listed security delists.
+    block_size : int
+        Number of securities generated and written at a time.
+    seed : int
+        Seed of the random number generators. The same arguments always
+        give the same files.
+    """
+    pulled = Path(data_dir) / "pulled"
+    pulled.mkdir(parents=True, exist_ok=True)
+    paths = {
+        name: pulled / f"{name}.parquet"
+        for name in [
+            "CRSP_stock_ciz",
+            "Compustat",
+            "CRSP_Comp_Link_Table",
+            "CRSP_MSF_INDEX_INPUTS",
+            "CRSP_MSIX",
+        ]
+    }
+
+    months = sample_months(start_year, end_year)
+    market = simulate_market_returns(len(months), seed=seed)
+    firms = simulate_firms(
+        n_firms, start_year, end_year, delisting_rate=delisting_rate, seed=seed
+    )
+    # Blocks never split the share classes of a company
+    company = firms["company"].to_numpy()
+    block_of = np.searchsorted(
+        company[np.arange(0, n_firms, block_size)], company, side="right"
+    ) - 1
+
+    writers = {}
+    comps, links, breakpoint_caps = [], [], []
+    index_sums = 0
+    for block in range(block_of.max() + 1):
+        block_firms = firms[block_of == block]
+        panel = simulate_monthly_panel(block_firms, market, months, seed=seed, block=block)
+        for name, df in [
+            ("CRSP_stock_ciz", to_CRSP_stock_ciz(panel)),
+            ("CRSP_MSF_INDEX_INPUTS", to_CRSP_MSF_INDEX_INPUTS(panel, seed=seed, block=block)),
+        ]:
+            if name not in writers:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                writers[name] = pq.ParquetWriter(paths[name], table.schema)
+            else:
+                table = pa.Table.from_pandas(
+                    df, schema=writers[name].schema, preserve_index=False
+                )
+            # One row group per block, read back block by block below
+            writers[name].write_table(table, row_group_size=max(len(df), 1))
+            if name == "CRSP_MSF_INDEX_INPUTS":
+                index_sums = index_sums + calc_index_sums(df, months)
+                breakpoint_caps.append(calc_breakpoint_caps(df, months))
+        comps.append(simulate_compustat(block_firms, panel, months, seed=seed, block=block))
+        links.append(simulate_link_table(block_firms, months, link_churn, seed=seed, block=block))
+    for writer in writers.values():
+        writer.close()
+
+    comp = pd.concat(comps, ignore_index=True)
+    comp = misc_tools.apply_dtype_schema(comp, load_CRSP_Compustat.schema_compustat)
+    comp.to_parquet(paths["Compustat"])
+    ccm = pd.concat(links, ignore_index=True)
+    ccm = misc_tools.apply_dtype_schema(ccm, load_CRSP_Compustat.schema_crsp_comp_link)
+    ccm.to_parquet(paths["CRSP_Comp_Link_Table"])
+
+    # The decile breakpoints need the whole cross section, so the decile
+    # sums take a second pass over the blocks of the monthly file
+    breakpoints = calc_decile_breakpoints(pd.concat(breakpoint_caps), months)
+    msf_file = pq.ParquetFile(paths["CRSP_MSF_INDEX_INPUTS"])
+    decile_sums = {"dec_ret": 0, "dec_val": 0}
+    for i in range(msf_file.num_row_groups):
+        msf = msf_file.read_row_group(
+            i, columns=["date", "permno", "exchcd", "ret", "altprc", "shrout"]
+        ).to_pandas()
+        for key, value in calc_decile_sums(msf, months, breakpoints).items():
+            decile_sums[key] = decile_sums[key] + value
+    msix = sums_to_CRSP_MSIX(index_sums, months, decile_sums)
+    msix.to_parquet(paths["CRSP_MSIX"])
+    return paths
+
+
+def write_sqlite_stand_in(data_dir=DATA_DIR, db_dir=None):
+    """Load the synthetic files in `data_dir / "pulled"` into SQLite
+    databases in `db_dir` (by default, `data_dir / "sqlite"`), one per WRDS
+    library, and return the directory.
+
+    The tables have the names and columns that the pull functions query:
+
+     - comp.funda (`load_CRSP_Compustat.pull_compustat`)
+     - crsp.msf_v2 (`load_CRSP_Compustat.pull_CRSP_stock_ciz`)
+     - crsp.msf, crsp.msenames and crsp.msedelist
+       (`load_CRSP_stock.pull_CRSP_monthly_file`), with one name record
+       per monthly record and the delisting records of the delisting
+       months
+     - crsp.ccmxpf_linktable (`load_CRSP_Compustat.pull_CRSP_Comp_Link_Table`)
+     - crsp_a_indexes.msix (`load_CRSP_stock.pull_CRSP_index_files`)
+     - ff.factors_monthly (`load_CRSP_Compustat.pull_Fama_French_factors`),
+       placeholder factors on the dates of the index file
+
+    Dates are stored as "YYYY-MM-DD" text, so that comparisons with date
+    literals work as in PostgreSQL. The files are read in memory, so this
+    is meant for test-sized samples.
+    """
+    pulled = Path(data_dir) / "pulled"
+    db_dir = Path(data_dir) / "sqlite" if db_dir is None else Path(db_dir)
+    db_dir.mkdir(parents=True, exist_ok=True)
+
+    comp = pd.read_parquet(pulled / "Compustat.parquet").drop(columns="year")
+    comp = comp.assign(indfmt="INDL", datafmt="STD", popsrc="D", consol="C")
+    crsp = pd.read_parquet(pulled / "CRSP_stock_ciz.parquet").drop(columns="jdate")
+    ccm = pd.read_parquet(pulled / "CRSP_Comp_Link_Table.parquet")
+    ccm = ccm.rename(columns={"permno": "lpermno"})
+    msf = pd.read_parquet(pulled / "CRSP_MSF_INDEX_INPUTS.parquet")
+    msf = msf.drop(columns="year", errors="ignore")
+    name_columns = ["shrcd", "exchcd", "comnam", "shrcls", "naics", "siccd"]
+    delist_columns = ["dlret", "dlretx", "dlstcd"]
+    msenames = msf[["permno", "date"] + name_columns].rename(columns={"date": "namedt"})
+    msenames["nameendt"] = msenames["namedt"]
+    msedelist = msf.loc[msf["dlstcd"].notna(), ["permno", "date"] + delist_columns]
+    msedelist = msedelist.rename(columns={"date": "dlstdt"})
+    # Shares are pulled in thousands
+    msf = msf.drop(columns=name_columns + delist_columns).assign(shrout=msf["shrout"] / 1000)
+    msix = pd.read_parquet(pulled / "CRSP_MSIX.parquet")
+    rf = 0.003
+    ff = pd.DataFrame(
+        {
+            "date": msix["caldt"],
+            "mktrf": msix["vwretd"] - rf,
+            "smb": msix["decret1"] - msix["decret10"],
+            "hml": 0.0,
+            "rf": rf,
+            "umd": 0.0,
+        }
+    )
+    tables = {
+        "comp": {"funda": comp},
+        "crsp": {
+            "msf_v2": crsp,
+            "ccmxpf_linktable": ccm,
+            "msf": msf,
+            "msenames": msenames,
+            "msedelist": msedelist,
+        },
+        "crsp_a_indexes": {"msix": msix},
+        "ff": {"factors_monthly": ff},
+    }
+    for library, library_tables in tables.items():
+        engine = sa.create_engine(f"sqlite:///{db_dir / library}.db")
+        with engine.begin() as connection:
+            for name, df in library_tables.items():
+                df = df.copy()
+                for col in df.select_dtypes("datetime").columns:
+                    df[col] = df[col].dt.strftime("%Y-%m-%d")
+                df.to_sql(name, connection, if_exists="replace", index=False)
+        engine.dispose()
+    return db_dir
+
+
+def sqlite_stand_in_engine(db_dir):
+    """SQLAlchemy engine of the stand-in written by `write_sqlite_stand_in`.
+    Each connection attaches the databases of `db_dir` under their
+    library name, so that queries such as `SELECT ... FROM comp.funda`
+    run unchanged. The PostgreSQL date functions of the queries
+    (`date_trunc('month', ...)` and `::date` casts) are translated. As
+    with PostgreSQL, connections are pooled and can be used from any
+    thread (see `wrds_pool.ConnectionPool`).
+    """
+    engine = sa.create_engine(
+        "sqlite://",
+        poolclass=sa.pool.QueuePool,
+        connect_args={"check_same_thread": False},
+    )
+
+    @sa.event.listens_for(engine, "connect")
+    def attach_libraries(dbapi_connection, connection_record):
+        for path in sorted(Path(db_dir).glob("*.db")):
+            dbapi_connection.execute(f"ATTACH DATABASE '{path}' AS {path.stem}")
+        dbapi_connection.create_function("date_trunc", 2, _sqlite_date_trunc)
+
+    @sa.event.listens_for(engine, "before_cursor_execute", retval=True)
+    def drop_date_casts(conn, cursor, statement, parameters, context, executemany):
+        # Dates are already "YYYY-MM-DD" text
+        return statement.replace("::date", ""), parameters
+
+    return engine
+
+
+def _sqlite_date_trunc(unit, value):
+    """`date_trunc` of PostgreSQL for "YYYY-MM-DD" text dates."""
+    if value is None:
+        return None
+    if unit == "month":
+        return value[:7] + "-01"
+    if unit == "year":
+        return value[:4] + "-01-01"
+    raise ValueError(f"Unknown unit: {unit}")
+
+
+def connect_sqlite_stand_in(db_dir):
+    """A `wrds.Connection` to the stand-in written by
+    `write_sqlite_stand_in`, to pass as `db` to the pull functions.
+    """
+    db = wrds.Connection(autoconnect=False)
+    db.engine = sqlite_stand_in_engine(db_dir)
+    db.connection = db.engine.connect()
+    return db
+
+
+if __name__ == "__main__":
+    write_synthetic_data(data_dir=DATA_DIR)
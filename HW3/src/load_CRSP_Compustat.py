@@ -29,16 +29,19 @@ import pandas as pd
 from pandas.tseries.offsets import MonthEnd, YearEnd
 
 import numpy as np
-import wrds
 
 import config
+import misc_tools
+import wrds_pool
 from pathlib import Path
 
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
+RESTATEMENT_LOOKBACK_MONTHS = config.RESTATEMENT_LOOKBACK_MONTHS
+INCREMENTAL_PULLS = config.INCREMENTAL_PULLS
 # START_DATE = config.START_DATE
-# END_DATE = config.END_DATE
+END_DATE = config.END_DATE
 
 
 description_compustat = {
@@ -60,9 +63,42 @@ description_compustat = {
 }
 
 
-def pull_compustat(wrds_username=WRDS_USERNAME):
+# Compact dtypes applied when pulling and loading. The special dtype
+# "float" is float64 unless float32=True is requested when loading.
+# gvkey is kept as a string, since it is the join key with the link table.
+schema_compustat = {
+    "year": "int32",
+}
+
+
+def pull_compustat(
+    wrds_username=WRDS_USERNAME,
+    db=None,
+    output_path=None,
+    chunksize=500_000,
+    incremental=False,
+    lookback_months=RESTATEMENT_LOOKBACK_MONTHS,
+):
     """
     See description_compustat for a description of the variables.
+
+    With `output_path`, the query is streamed from the server in chunks of
+    `chunksize` rows (ordered by `datadate`), that are written to a
+    parquet dataset at `output_path` partitioned by year (see
+    `misc_tools.write_parquet_dataset_by_year`), and `output_path` is
+    returned. Memory is then bounded by the chunk size.
+
+    With `incremental=True`, only the rows dated from `lookback_months`
+    months before the latest `datadate` stored at `output_path` are
+    pulled, and they replace those rows of the stored dataset (see
+    `misc_tools.incremental_since`). The lookback picks up the records
+    restated since the last pull. Without stored data, everything is
+    pulled.
+
+    `db` is a `wrds_pool.ConnectionPool` or an open `wrds.Connection`
+    to use (e.g., to a local stand-in database, see
+    `generate_synthetic_data.sqlite_stand_in_engine`); by default, a
+    connection is opened and closed (see `wrds_pool.connect`).
     """
     sql_query = """
         SELECT 
@@ -75,15 +111,28 @@ def pull_compustat(wrds_username=WRDS_USERNAME):
             datafmt='STD' AND -- only standardized records
             popsrc='D' AND -- only from primary sources
             consol='C' AND -- consolidated financial statements
-            datadate >= '01/01/1959'
+            datadate >= '1959-01-01'
         """
-    # with wrds.Connection(wrds_username=wrds_username) as db:
-    #     comp = db.raw_sql(sql_query, date_cols=["datadate"])
-    db = wrds.Connection(wrds_username=wrds_username)
-    comp = db.raw_sql(sql_query, date_cols=["datadate"])
-    db.close()
-
+    since = None
+    if incremental:
+        since = misc_tools.incremental_since(output_path, "datadate", lookback_months)
+    if since is not None:
+        sql_query += f"AND datadate >= '{since:%Y-%m-%d}'\n"
+    with wrds_pool.connect(db, wrds_username) as db:
+        if output_path is not None:
+            chunks = misc_tools.read_sql_chunks(
+                sql_query + "ORDER BY datadate", db.connection, chunksize, ["datadate"]
+            )
+            return misc_tools.write_parquet_dataset_by_year(
+                map(_clean_compustat, chunks), output_path, "datadate", since=since
+            )
+        comp = db.raw_sql(sql_query, date_cols=["datadate"])
+    return _clean_compustat(comp)
+
+
+def _clean_compustat(comp):
     comp["year"] = comp["datadate"].dt.year
+    comp = misc_tools.apply_dtype_schema(comp, schema_compustat)
     return comp
 
 
@@ -106,9 +155,43 @@ description_crsp = {
 }
 
 
-def pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME):
+schema_crsp = {
+    "permno": "int32",
+    "permco": "int32",
+    "issuertype": "category",
+    "securitytype": "category",
+    "securitysubtype": "category",
+    "sharetype": "category",
+    "usincflg": "category",
+    "primaryexch": "category",
+    "conditionaltype": "category",
+    "tradingstatusflg": "category",
+    "shrout": "float",
+    "mthprc": "float",
+}
+
+
+def pull_CRSP_stock_ciz(
+    wrds_username=WRDS_USERNAME,
+    db=None,
+    output_path=None,
+    chunksize=500_000,
+    incremental=False,
+    lookback_months=RESTATEMENT_LOOKBACK_MONTHS,
+    end_date=None,
+):
     """Pull necessary CRSP monthly stock data to
     compute Fama-French factors. Use the new CIZ format.
+
+    With `output_path`, the query is streamed to a parquet dataset
+    partitioned by year, as in `pull_compustat` (ordered by `mthcaldt`),
+    and `incremental=True` only pulls the rows from `lookback_months`
+    months before the latest `mthcaldt` stored.
+
+    The rows are pulled up to `end_date`. By default, that is
+    `config.END_DATE` for a full pull, while an incremental pull has no
+    upper bound, so that it picks up the months published since the
+    stored data was pulled.
     """
     sql_query = """
         SELECT 
@@ -120,15 +203,32 @@ def pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME):
         FROM 
             crsp.msf_v2 AS a
         WHERE 
-            a.mthcaldt BETWEEN '01/01/1959' AND '12/31/2022'
+            a.mthcaldt >= '1959-01-01'
         """
-
-    db = wrds.Connection(wrds_username=wrds_username)
-    crsp_m = db.raw_sql(sql_query, date_cols=["mthcaldt"])
-    db.close()
-
-    # change variable format to int
-    crsp_m[['permco','permno']]=crsp_m[['permco','permno']].astype(int)
+    if end_date is None and not incremental:
+        end_date = END_DATE
+    if end_date is not None:
+        sql_query += f"AND a.mthcaldt <= '{pd.Timestamp(end_date):%Y-%m-%d}'\n"
+    since = None
+    if incremental:
+        since = misc_tools.incremental_since(output_path, "mthcaldt", lookback_months)
+    if since is not None:
+        sql_query += f"AND a.mthcaldt >= '{since:%Y-%m-%d}'\n"
+    with wrds_pool.connect(db, wrds_username) as db:
+        if output_path is not None:
+            chunks = misc_tools.read_sql_chunks(
+                sql_query + "ORDER BY a.mthcaldt", db.connection, chunksize, ["mthcaldt"]
+            )
+            return misc_tools.write_parquet_dataset_by_year(
+                map(_clean_CRSP_stock_ciz, chunks), output_path, "mthcaldt", since=since
+            )
+        crsp_m = db.raw_sql(sql_query, date_cols=["mthcaldt"])
+    return _clean_CRSP_stock_ciz(crsp_m)
+
+
+def _clean_CRSP_stock_ciz(crsp_m):
+    # change variable format to int (int32) and flags to categoricals
+    crsp_m = misc_tools.apply_dtype_schema(crsp_m, schema_crsp)
 
     # Line up date to be end of month
     crsp_m['jdate']=crsp_m['mthcaldt']+MonthEnd(0)
@@ -136,6 +236,89 @@ def pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME):
     return crsp_m
 
 
+description_crsp_daily = {
+    "permno": "Permanent Number - A unique identifier assigned by CRSP to each security.",
+    "dlycaldt": "Calendar Date - The date for the daily data observation.",
+    "dlyret": "Daily Return - The total return of the security for the day, including dividends.",
+    "dlyretx": "Daily Return Excluding Dividends - The return of the security for the day, excluding dividends.",
+    "dlyprc": "Daily Price - The price of the security at the end of the day.",
+    "shrout": "Shares Outstanding - The number of outstanding shares of the security.",
+}
+
+
+schema_crsp_daily = {
+    "permno": "int32",
+    "dlyprc": "float",
+    "shrout": "float",
+}
+
+
+CRSP_DAILY_DIR = "CRSP_stock_ciz_daily"
+
+
+def pull_CRSP_daily_stock_ciz(
+    data_dir=DATA_DIR,
+    start_year=1959,
+    end_year=None,
+    wrds_username=WRDS_USERNAME,
+    db=None,
+    incremental=False,
+    lookback_months=RESTATEMENT_LOOKBACK_MONTHS,
+):
+    """Pull the CRSP daily stock file (CIZ format) for the common stocks
+    on NYSE, AMEX and NASDAQ, one year at a time, and save it as parquet
+    partitioned by year in `data_dir / "pulled" / CRSP_DAILY_DIR`
+    (`year=YYYY/part-0.parquet`).
+
+    The daily file is about 20 times larger than the monthly file, so a
+    single year is held in memory at a time.
+
+    With `incremental=True`, the pull starts at the year of the date
+    `lookback_months` months before the latest `dlycaldt` stored (see
+    `misc_tools.incremental_since`), and the partitions of the years
+    pulled are replaced.
+
+    By default, `end_year` is the year of `config.END_DATE` for a full
+    pull and the current year for an incremental pull.
+    """
+    output_dir = Path(data_dir) / "pulled" / CRSP_DAILY_DIR
+    if end_year is None:
+        end_year = pd.Timestamp.today().year if incremental else pd.Timestamp(END_DATE).year
+    if incremental:
+        since = misc_tools.incremental_since(output_dir, "dlycaldt", lookback_months)
+        if since is not None:
+            start_year = max(start_year, since.year)
+    with wrds_pool.connect(db, wrds_username) as db:
+        for year in range(start_year, end_year + 1):
+            sql_query = f"""
+                SELECT 
+                    a.permno, a.dlycaldt, a.dlyret, a.dlyretx, a.dlyprc, a.shrout
+                FROM 
+                    crsp.dsf_v2 AS a
+                WHERE 
+                    a.dlycaldt BETWEEN '01/01/{year}' AND '12/31/{year}' AND
+                    a.sharetype = 'NS' AND
+                    a.securitytype = 'EQTY' AND
+                    a.securitysubtype = 'COM' AND
+                    a.usincflg = 'Y' AND
+                    a.issuertype IN ('ACOR', 'CORP') AND
+                    a.primaryexch IN ('N', 'A', 'Q') AND
+                    a.conditionaltype = 'RW' AND
+                    a.tradingstatusflg = 'A'
+                """
+            crsp_d = db.raw_sql(sql_query, date_cols=["dlycaldt"])
+            crsp_d = misc_tools.apply_dtype_schema(crsp_d, schema_crsp_daily)
+            save_CRSP_daily_partition(crsp_d, year, data_dir=data_dir)
+    return output_dir
+
+
+def save_CRSP_daily_partition(crsp_d, year, data_dir=DATA_DIR):
+    """Save the daily records of one year as the `year=YYYY` partition."""
+    partition = Path(data_dir) / "pulled" / CRSP_DAILY_DIR / f"year={year}"
+    partition.mkdir(parents=True, exist_ok=True)
+    crsp_d.to_parquet(partition / "part-0.parquet", index=False)
+
+
 description_crsp_comp_link = {
     "gvkey": "Global Company Key - A unique identifier for companies in the Compustat database.",
     "permno": "Permanent Number - A unique stock identifier assigned by CRSP to each security.",
@@ -146,7 +329,14 @@ description_crsp_comp_link = {
 }
 
 
-def pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME):
+schema_crsp_comp_link = {
+    "permno": "int32",
+    "linktype": "category",
+    "linkprim": "category",
+}
+
+
+def pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME, db=None):
     sql_query = """
         SELECT 
             gvkey, lpermno AS permno, linktype, linkprim, linkdt, linkenddt
@@ -156,16 +346,17 @@ def pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME):
             substr(linktype,1,1)='L' AND 
             (linkprim ='C' OR linkprim='P')
         """
-    db = wrds.Connection(wrds_username=wrds_username)
-    ccm = db.raw_sql(sql_query, date_cols=["linkdt", "linkenddt"])
-    db.close()
+    with wrds_pool.connect(db, wrds_username) as db:
+        ccm = db.raw_sql(sql_query, date_cols=["linkdt", "linkenddt"])
+    ccm = misc_tools.apply_dtype_schema(ccm, schema_crsp_comp_link)
     return ccm
 
 
-def pull_Fama_French_factors(wrds_username=WRDS_USERNAME):
-    conn = wrds.Connection(wrds_username=config.WRDS_USERNAME)
-    ff = conn.get_table(library="ff", table="factors_monthly")
-    conn.close()
+def pull_Fama_French_factors(wrds_username=WRDS_USERNAME, db=None):
+    # The query of `db.get_table(library="ff", table="factors_monthly")`,
+    # which needs the library list that only `wrds.Connection()` loads
+    with wrds_pool.connect(db, wrds_username) as db:
+        ff = db.raw_sql("SELECT * FROM ff.factors_monthly")
     ff[["smb", "hml"]] = ff[["smb", "hml"]].astype(float)
     
     ff["date"] = pd.to_datetime(ff["date"])
@@ -174,21 +365,167 @@ def pull_Fama_French_factors(wrds_username=WRDS_USERNAME):
     return ff
 
 
+def pull_CRSP_Compustat(
+    data_dir=DATA_DIR,
+    wrds_username=WRDS_USERNAME,
+    db=None,
+    max_workers=wrds_pool.WRDS_MAX_CONNECTIONS,
+    incremental=False,
+):
+    """Pull Compustat, the CRSP monthly stock file, the CRSP-Compustat
+    link table and the Fama-French factors, and save them to
+    `data_dir / "pulled"`, as in `task_pull_CRSP_Compustat`.
+
+    The four queries are independent, so they run at the same time, each
+    on its own connection of the `wrds_pool.ConnectionPool` `db` (by
+    default, a pool is opened and closed), see
+    `wrds_pool.pull_concurrently`. Compustat and CRSP are streamed to
+    year-partitioned datasets, and with `incremental=True`, only their
+    new and recently restated rows are pulled (see `pull_compustat`).
+    The link table and the factors are small, and always pulled whole.
+    Returns the paths of the saved files.
+    """
+    pulled = Path(data_dir) / "pulled"
+    pulled.mkdir(parents=True, exist_ok=True)
+    paths = {
+        "comp": pulled / "Compustat.parquet",
+        "crsp": pulled / "CRSP_stock_ciz.parquet",
+        "ccm": pulled / "CRSP_Comp_Link_Table.parquet",
+        "ff": pulled / "FF_FACTORS.parquet",
+    }
+    pool = wrds_pool.ConnectionPool(wrds_username=wrds_username) if db is None else db
+    try:
+        results = wrds_pool.pull_concurrently(
+            {
+                "comp": (
+                    pull_compustat,
+                    {"output_path": paths["comp"], "incremental": incremental},
+                ),
+                "crsp": (
+                    pull_CRSP_stock_ciz,
+                    {"output_path": paths["crsp"], "incremental": incremental},
+                ),
+                "ccm": (pull_CRSP_Comp_Link_Table, {}),
+                "ff": (pull_Fama_French_factors, {}),
+            },
+            db=pool,
+            max_workers=max_workers,
+        )
+    finally:
+        if db is None:
+            pool.close()
+    results["ccm"].to_parquet(paths["ccm"])
+    results["ff"].to_parquet(paths["ff"])
+    return paths
+
+
 def load_compustat(data_dir=DATA_DIR):
     path = Path(data_dir) / "pulled" / "Compustat.parquet"
     comp = pd.read_parquet(path)
+    comp = misc_tools.apply_dtype_schema(comp, schema_compustat)
     return comp
 
 
-def load_CRSP_stock_ciz(data_dir=DATA_DIR):
+# Same universe as calc_Fama_French_1993_factors.subset_CRSP_to_common_stock_and_exchanges,
+# written as pyarrow filters so that they can be applied while reading.
+COMMON_STOCK_AND_EXCHANGE_FILTERS = [
+    ("sharetype", "==", "NS"),
+    ("securitytype", "==", "EQTY"),
+    ("securitysubtype", "==", "COM"),
+    ("usincflg", "==", "Y"),
+    ("issuertype", "in", ["ACOR", "CORP"]),
+    ("primaryexch", "in", ["N", "A", "Q"]),
+    ("conditionaltype", "==", "RW"),
+    ("tradingstatusflg", "==", "A"),
+]
+
+
+def load_CRSP_stock_ciz(
+    data_dir=DATA_DIR,
+    columns=None,
+    common_stock_only=False,
+    start_date=None,
+    end_date=None,
+    float32=False,
+    memory_map=False,
+):
+    """Load the CRSP monthly stock file (CIZ format).
+
+    The columns are cast to the compact dtypes in `schema_crsp`: int32
+    identifiers and categorical flags. With `float32=True`, the price and
+    shares outstanding columns are loaded as float32.
+
+    The column projection (`columns`), the common stock and exchange
+    filters (`common_stock_only`, see `COMMON_STOCK_AND_EXCHANGE_FILTERS`)
+    and the `mthcaldt` date range (`start_date` and `end_date`, both
+    inclusive) are pushed down to pyarrow. Row groups whose statistics
+    rule them out are skipped, and the remaining rows are filtered in
+    Arrow before the conversion to pandas, so dropped rows never become
+    part of the DataFrame.
+
+    With `memory_map=True`, the file is read from an uncompressed Arrow
+    IPC copy of the parquet file (written on first use) that is opened
+    memory-mapped, so that processes loading the panel share one copy of
+    its numeric columns (see `misc_tools.load_arrow_ipc`). Those columns
+    are read-only. Filters still apply, but copy the selected rows.
+    """
+    filters = []
+    if common_stock_only:
+        filters += COMMON_STOCK_AND_EXCHANGE_FILTERS
+    if start_date is not None:
+        filters.append(("mthcaldt", ">=", pd.Timestamp(start_date)))
+    if end_date is not None:
+        filters.append(("mthcaldt", "<=", pd.Timestamp(end_date)))
+
     path = Path(data_dir) / "pulled" / "CRSP_stock_ciz.parquet"
-    crsp = pd.read_parquet(path)
+    if memory_map:
+        crsp = misc_tools.load_arrow_ipc(
+            misc_tools.arrow_ipc_copy(path), columns=columns, filters=filters
+        )
+    else:
+        crsp = pd.read_parquet(path, columns=columns, filters=filters or None)
+    # The hive partition column, if the file was pulled with `output_path`
+    crsp = crsp.drop(columns="year", errors="ignore")
+    crsp = misc_tools.apply_dtype_schema(crsp, schema_crsp, float32=float32)
     return crsp
 
 
+def CRSP_daily_years(data_dir=DATA_DIR):
+    """Years saved in the partitioned CRSP daily stock file."""
+    daily_dir = Path(data_dir) / "pulled" / CRSP_DAILY_DIR
+    return sorted(int(p.name.split("=")[1]) for p in daily_dir.glob("year=*"))
+
+
+def load_CRSP_daily_stock_ciz(
+    data_dir=DATA_DIR, start_date=None, end_date=None, columns=None, float32=False
+):
+    """Load the records of the partitioned CRSP daily stock file between
+    `start_date` and `end_date` (both inclusive).
+
+    Only the year partitions that overlap the date range are read, and
+    the date range and column projection are pushed down to pyarrow, so
+    a range of a few months only reads those months.
+    """
+    filters = []
+    if start_date is not None:
+        start_date = pd.Timestamp(start_date)
+        filters += [("year", ">=", start_date.year), ("dlycaldt", ">=", start_date)]
+    if end_date is not None:
+        end_date = pd.Timestamp(end_date)
+        filters += [("year", "<=", end_date.year), ("dlycaldt", "<=", end_date)]
+
+    path = Path(data_dir) / "pulled" / CRSP_DAILY_DIR
+    crsp_d = pd.read_parquet(path, columns=columns, filters=filters or None)
+    # The hive partition column
+    crsp_d = crsp_d.drop(columns="year", errors="ignore")
+    crsp_d = misc_tools.apply_dtype_schema(crsp_d, schema_crsp_daily, float32=float32)
+    return crsp_d
+
+
 def load_CRSP_Comp_Link_Table(data_dir=DATA_DIR):
     path = Path(data_dir) / "pulled" / "CRSP_Comp_Link_Table.parquet"
     ccm = pd.read_parquet(path)
+    ccm = misc_tools.apply_dtype_schema(ccm, schema_crsp_comp_link)
     return ccm
 
 
@@ -197,6 +534,49 @@ def load_Fama_French_factors(data_dir=DATA_DIR):
     ff = pd.read_parquet(path)
     return ff
 
+# Columns of the first table of "6_Portfolios_2x3.CSV" in the Ken French
+# data library, in file order, and their names in
+# calc_Fama_French_1993_factors.
+FF_6_PORTFOLIOS_COLUMNS = ["SL", "SM", "SH", "BL", "BM", "BH"]
+
+
+def read_Ken_French_library_csv(path):
+    """Read the first table of a CSV file downloaded from the Ken French
+    data library (e.g., "6_Portfolios_2x3.CSV"), which holds the monthly
+    value-weighted returns.
+
+    The file starts with a few lines of text, then the header of the
+    table and rows of `yyyymm` followed by returns in percent. The table
+    ends at the first blank line. Returns are converted to decimals and
+    dates to month ends. Missing values (-99.99) are NaN.
+    """
+    with open(path) as f:
+        lines = f.read().splitlines()
+    start = next(i for i, line in enumerate(lines) if line[:7].strip(" ,").isdigit()) - 1
+    end = next(
+        (i for i in range(start + 1, len(lines)) if not lines[i].strip(" ,")), len(lines)
+    )
+    header = [c.strip() for c in lines[start].split(",")]
+    rows = [line.split(",") for line in lines[start + 1 : end]]
+    df = pd.DataFrame(rows, columns=["date"] + header[1:])
+    df["date"] = pd.to_datetime(df["date"].str.strip(), format="%Y%m") + MonthEnd(0)
+    returns = df.columns[1:]
+    df[returns] = df[returns].astype(float).replace(-99.99, np.nan) / 100
+    return df
+
+
+def load_Fama_French_6_portfolios(data_dir=DATA_DIR):
+    """Monthly value-weighted returns of the six size and book-to-market
+    portfolios from a local copy of "6_Portfolios_2x3.CSV" in
+    `data_dir / "pulled"`, with columns `date` and
+    `FF_6_PORTFOLIOS_COLUMNS`.
+    """
+    path = Path(data_dir) / "pulled" / "6_Portfolios_2x3.CSV"
+    df = read_Ken_French_library_csv(path)
+    df.columns = ["date"] + FF_6_PORTFOLIOS_COLUMNS
+    return df
+
+
 def _demo():
     comp = load_compustat(data_dir=DATA_DIR)
     crsp = load_CRSP_stock_ciz(data_dir=DATA_DIR)
@@ -205,14 +585,5 @@ def _demo():
 
 
 if __name__ == "__main__":
-    comp = pull_compustat(wrds_username=WRDS_USERNAME)
-    comp.to_parquet(DATA_DIR / "pulled" / "Compustat.parquet")
-
-    crsp = pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME)
-    crsp.to_parquet(DATA_DIR / "pulled" / "CRSP_stock_ciz.parquet")
-
-    ccm = pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME)
-    ccm.to_parquet(DATA_DIR / "pulled" / "CRSP_Comp_Link_Table.parquet")
-
-    ff = pull_Fama_French_factors(wrds_username=WRDS_USERNAME)
-    ff.to_parquet(DATA_DIR / "pulled" / "FF_FACTORS.parquet")
+    with wrds_pool.ConnectionPool(wrds_username=WRDS_USERNAME) as pool:
+        pull_CRSP_Compustat(data_dir=DATA_DIR, db=pool, incremental=INCREMENTAL_PULLS)
@@ -23,18 +23,46 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import wrds
 
 import config
+import misc_tools
+import wrds_pool
 
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
 START_DATE = config.START_DATE
 END_DATE = config.END_DATE
+INCREMENTAL_PULLS = config.INCREMENTAL_PULLS
+RESTATEMENT_LOOKBACK_MONTHS = config.RESTATEMENT_LOOKBACK_MONTHS
+
+
+# Compact dtypes applied when pulling and loading. The special dtype
+# "float" is float64 unless float32=True is requested when loading.
+schema_msf = {
+    "permno": "int32",
+    "permco": "int32",
+    "comnam": "category",
+    "shrcls": "category",
+    "naics": "category",
+    "prc": "float",
+    "altprc": "float",
+    "vol": "float",
+    "shrout": "float",
+    "cfacshr": "float",
+    "cfacpr": "float",
+}
 
 
 def pull_CRSP_monthly_file(
-    start_date=START_DATE, end_date=END_DATE, wrds_username=WRDS_USERNAME
+    start_date=START_DATE,
+    end_date=None,
+    wrds_username=WRDS_USERNAME,
+    delisting_convention="bem",
+    db=None,
+    output_path=None,
+    chunksize=500_000,
+    incremental=False,
+    lookback_months=RESTATEMENT_LOOKBACK_MONTHS,
 ):
     """
     Pulls monthly CRSP stock data from a specified start date to end date.
@@ -43,12 +71,45 @@ def pull_CRSP_monthly_file(
     follows the guidelines that CRSP uses for inclusion, with the exception
     of code 73, which is foreign companies -- without including this, the universe
     of securities is roughly half of what it should be.
+
+    Delisting returns are included with `apply_delisting_returns`, using
+    `delisting_convention` ("bem" or "alt").
+
+    With `output_path`, the query is streamed from the server in chunks of
+    `chunksize` rows (ordered by date), that are written to a parquet
+    dataset at `output_path` partitioned by year (see
+    `misc_tools.write_parquet_dataset_by_year`), and `output_path` is
+    returned. `db` is a `wrds_pool.ConnectionPool` or an open
+    `wrds.Connection` to use; by default, a connection is opened and
+    closed (see `wrds_pool.connect`).
+
+    With `incremental=True`, the pull starts `lookback_months` months
+    before the latest date stored at `output_path` (or at `start_date`,
+    if later), to pick up restated returns and delistings, and the
+    rows pulled replace those of the stored dataset (see
+    `misc_tools.incremental_since`).
+
+    The rows are pulled up to `end_date`. By default, that is
+    `config.END_DATE` for a full pull, while an incremental pull has no
+    upper bound, so that it picks up the months published since the
+    stored data was pulled.
     """
     # Not a perfect solution, but since value requires t-1 period market cap,
     # we need to pull one extra month of data. This is hidden from the user.
     start_date = datetime.strptime(start_date, "%Y-%m-%d")
     start_date = start_date - relativedelta(months=1)
     start_date = start_date.strftime("%Y-%m-%d")
+    since = None
+    if incremental:
+        since = misc_tools.incremental_since(output_path, "date", lookback_months)
+    if since is not None:
+        since = max(since, pd.Timestamp(start_date))
+        start_date = since.strftime("%Y-%m-%d")
+    if end_date is None and not incremental:
+        end_date = END_DATE
+    date_filter = f"msf.date >= '{start_date}'"
+    if end_date is not None:
+        date_filter = f"msf.date BETWEEN '{start_date}' AND '{end_date}'"
 
     query = f"""
     SELECT 
@@ -71,78 +132,108 @@ def pull_CRSP_monthly_file(
         date_trunc('month', msf.date)::date =
         date_trunc('month', msedelist.dlstdt)::date
     WHERE 
-        msf.date BETWEEN '{start_date}' AND '{end_date}' AND 
+        {date_filter} AND 
         msenames.shrcd IN (10, 11, 20, 21, 40, 41, 70, 71, 73)
     """
     # with wrds.Connection(wrds_username=wrds_username) as db:
     #     df = db.raw_sql(
     #         query, date_cols=["date", "namedt", "nameendt", "dlstdt"]
     #     )
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(
-        query, date_cols=["date", "namedt", "nameendt", "dlstdt"]
-    )
-    db.close()
-
+    date_cols = ["date", "namedt", "nameendt", "dlstdt"]
+    with wrds_pool.connect(db, wrds_username) as db:
+        if output_path is not None:
+            chunks = misc_tools.read_sql_chunks(
+                query + "ORDER BY msf.date", db.connection, chunksize, date_cols
+            )
+            chunks = (_clean_CRSP_monthly_file(df, delisting_convention) for df in chunks)
+            return misc_tools.write_parquet_dataset_by_year(
+                chunks, output_path, "date", since=since
+            )
+        df = db.raw_sql(query, date_cols=date_cols)
+    return _clean_CRSP_monthly_file(df, delisting_convention)
+
+
+def _clean_CRSP_monthly_file(df, delisting_convention="bem"):
     df = df.loc[:, ~df.columns.duplicated()]
     df["shrout"] = df["shrout"] * 1000
     # Deal with delisting returns
-    df = apply_delisting_returns(df)
+    df = apply_delisting_returns(df, convention=delisting_convention)
+    df = misc_tools.apply_dtype_schema(df, schema_msf)
 
     return df
 
 
-def apply_delisting_returns(df):
-    """
-    Use instructions for handling delisting returns from: Chapter 7 of 
-    Bali, Engle, Murray --
-    Empirical asset pricing-the cross section of stock returns (2016)
-    
-    First change dlret column. 
-    If dlret is NA and dlstcd is not NA, then:
-    if dlstcd is 500, 520, 551-574, 580, or 584, then dlret = -0.3
-    if dlret is NA but dlstcd is not one of the above, then dlret = -1
+# Delisting return used when `dlret` (`dlretx`) is missing, by delisting
+# code `dlstcd` (Bali, Engle and Murray, 2016, Chapter 7): -30% for the
+# performance-related delisting codes, -100% for the other delisting
+# codes (200 and above) and none for active securities (code 100).
+PERFORMANCE_DELISTING_CODES = [500, 520, 580, 584] + list(range(551, 575))
+MISSING_DLRET_BY_CODE = np.full(1000, np.nan)
+MISSING_DLRET_BY_CODE[200:] = -1.0
+MISSING_DLRET_BY_CODE[PERFORMANCE_DELISTING_CODES] = -0.3
+
+
+def apply_delisting_returns(df, convention="bem"):
     """
+    Include the delisting returns in the monthly returns, for `ret`
+    (with `dlret`) and `retx` (with `dlretx`) together.
+
+    With `convention="bem"` (the default), the instructions for handling
+    delisting returns from Chapter 7 of Bali, Engle, Murray --
+    Empirical asset pricing-the cross section of stock returns (2016):
+
+    A missing delisting return is replaced by the value of its delisting
+    code in the lookup array `MISSING_DLRET_BY_CODE`:
+    if dlstcd is 500, 520, 551-574, 580, or 584, then dlret = -0.3;
+    if dlstcd is any other code of 200 or above, then dlret = -1.
+    The return is then replaced by the delisting return, if there is one.
 
+    With `convention="alt"`, the delisting return (0 if missing) is added
+    to the return, or replaces it if the return is missing.
 
-    df["dlret"] = np.select(
-        [
-            df["dlstcd"].isin([500, 520, 580, 584] + list(range(551, 575)))
-            & df["dlret"].isna(),
-            df["dlret"].isna() & df["dlstcd"].notna() & df["dlstcd"] >= 200,
-            True,
-        ],
-        [-0.3, -1, df["dlret"]],
-        default=df["dlret"],
-    )
-
-    df["dlretx"] = np.select(
-        [
-            df["dlstcd"].isin([500, 520, 580, 584] + list(range(551, 575)))
-            & df["dlretx"].isna(),
-            df["dlretx"].isna() & df["dlstcd"].notna() & df["dlstcd"] >= 200,
-            True,
-        ],
-        [-0.3, -1, df["dlretx"]],
-        default=df["dlretx"],
-    )
-
-    df.loc[df["dlret"].notna(), "ret"] = df["dlret"]
-    df.loc[df["dlretx"].notna(), "retx"] = df["dlretx"]
+    The delisting codes are looked up, and the returns changed, only for
+    the rows with a delisting code or return. Returns a new DataFrame;
+    `df` is not modified.
+    """
+    dlstcd = df["dlstcd"].to_numpy(dtype=float)
+    dlret = df[["dlret", "dlretx"]].to_numpy(dtype=float)
+    # Only the rows with a delisting code or return can change
+    rows = np.flatnonzero(~np.isnan(dlstcd) | ~np.isnan(dlret).all(axis=1))
+    # NaN codes fail both comparisons
+    code = dlstcd[rows]
+    has_code = (code >= 0) & (code < len(MISSING_DLRET_BY_CODE))
+    missing_dlret = np.full(len(rows), np.nan)
+    missing_dlret[has_code] = MISSING_DLRET_BY_CODE[code[has_code].astype(int)]
+
+    ret = df[["ret", "retx"]].to_numpy(dtype=float)
+    if convention == "bem":
+        row_dlret = dlret[rows]
+        row_dlret = np.where(np.isnan(row_dlret), missing_dlret[:, None], row_dlret)
+        dlret[rows] = row_dlret
+        ret[rows] = np.where(np.isnan(row_dlret), ret[rows], row_dlret)
+    elif convention == "alt":
+        row_dlret = np.where(np.isnan(dlret[rows]), 0.0, dlret[rows])
+        dlret[:] = 0.0
+        dlret[rows] = row_dlret
+        row_ret = ret[rows]
+        ret[rows] = np.where(
+            np.isnan(row_ret) & (row_dlret != 0), row_dlret, row_ret + row_dlret
+        )
+    else:
+        raise ValueError(f"Unknown delisting return convention: {convention}")
+
+    df = df.copy(deep=False)
+    df["ret"], df["retx"] = ret[:, 0], ret[:, 1]
+    df["dlret"], df["dlretx"] = dlret[:, 0], dlret[:, 1]
     return df
 
 
 def apply_delisting_returns_alt(df):
-    df["dlret"] = df["dlret"].fillna(0)
-    df["ret"] = df["ret"] + df["dlret"]
-    df["ret"] = np.where(
-        (df["ret"].isna()) & (df["dlret"] != 0), df["dlret"], df["ret"]
-    )
-    return df
+    return apply_delisting_returns(df, convention="alt")
 
 
 def pull_CRSP_index_files(
-    start_date=START_DATE, end_date=END_DATE, wrds_username=WRDS_USERNAME
+    start_date=START_DATE, end_date=END_DATE, wrds_username=WRDS_USERNAME, db=None
 ):
     # Pull index files
     query = f"""
@@ -152,15 +243,31 @@ def pull_CRSP_index_files(
     """
     # with wrds.Connection(wrds_username=wrds_username) as db:
     #     df = db.raw_sql(query, date_cols=["month", "caldt"])
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(query, date_cols=["caldt"])
-    db.close()
+    with wrds_pool.connect(db, wrds_username) as db:
+        df = db.raw_sql(query, date_cols=["caldt"])
     return df
 
 
-def load_CRSP_monthly_file(data_dir=DATA_DIR):
+def load_CRSP_monthly_file(data_dir=DATA_DIR, float32=False, memory_map=False):
+    """Load the CRSP monthly stock file used to build the indices.
+
+    The columns are cast to the compact dtypes in `schema_msf`. With
+    `float32=True`, the price, volume and share columns are loaded as float32.
+
+    With `memory_map=True`, the file is read from an uncompressed Arrow
+    IPC copy of the parquet file (written on first use) that is opened
+    memory-mapped, so that processes loading the panel share one copy of
+    its numeric columns (see `misc_tools.load_arrow_ipc`). Those columns
+    are read-only; `float32=True` copies the cast columns.
+    """
     path = Path(data_dir) / "pulled" / "CRSP_MSF_INDEX_INPUTS.parquet"
-    df = pd.read_parquet(path)
+    if memory_map:
+        df = misc_tools.load_arrow_ipc(misc_tools.arrow_ipc_copy(path))
+    else:
+        df = pd.read_parquet(path)
+    # The hive partition column, if the file was pulled with `output_path`
+    df = df.drop(columns="year", errors="ignore")
+    df = misc_tools.apply_dtype_schema(df, schema_msf, float32=float32)
     return df
 
 
@@ -177,10 +284,15 @@ def _demo():
 
 if __name__ == "__main__":
 
-    df_msf = pull_CRSP_monthly_file(start_date=START_DATE, end_date=END_DATE)
-    path = Path(DATA_DIR) / "pulled" / "CRSP_MSF_INDEX_INPUTS.parquet"
-    df_msf.to_parquet(path)
-
-    df_msix = pull_CRSP_index_files(start_date=START_DATE, end_date=END_DATE)
-    path = Path(DATA_DIR) / "pulled" / f"CRSP_MSIX.parquet"
-    df_msix.to_parquet(path)
+    with wrds_pool.ConnectionPool(wrds_username=WRDS_USERNAME) as pool:
+        path = Path(DATA_DIR) / "pulled" / "CRSP_MSF_INDEX_INPUTS.parquet"
+        pull_CRSP_monthly_file(
+            start_date=START_DATE,
+            db=pool,
+            output_path=path,
+            incremental=INCREMENTAL_PULLS,
+        )
+
+        df_msix = pull_CRSP_index_files(start_date=START_DATE, end_date=END_DATE, db=pool)
+        path = Path(DATA_DIR) / "pulled" / f"CRSP_MSIX.parquet"
+        df_msix.to_parquet(path)
@@ -9,8 +9,16 @@ import matplotlib.dates as mdates
 from dateutil.relativedelta import relativedelta
 from datetime import date
 import datetime 
+import itertools
+import os
+import shutil
 from pathlib import Path
 
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
 import pandas_market_calendars
 
 ########################################################################################
@@ -427,6 +435,76 @@ def with_lagged_columns(data=None, columns_to_lag=None, id_columns=None, lags=1,
     return w_data_lag
 
 
+def calc_month_ordinal(dates):
+    """Number of months since year 0 of each date, e.g., to find the
+    previous month of a stock without assuming that its records have no
+    gaps. Missing dates give -1. The months are computed once per unique
+    date.
+    """
+    codes, uniques = pd.factorize(pd.DatetimeIndex(dates))
+    month = np.asarray(uniques.year * 12 + uniques.month - 1, dtype=np.int64)
+    # Code -1 (a missing date) picks the -1 appended at the end
+    return np.append(month, -1)[codes]
+
+
+def lag_by_month_ordinal(ids, month, values, lag=1):
+    """Value of `values` for the same id `lag` calendar months earlier,
+    aligned with the rows. Missing if the id has no record for that month
+    (a gap), rather than the value of the id's previous record as with
+    `groupby(ids).shift(lag)`, and independent of the order of the rows.
+
+    `month` is an integer month index, such as `calc_month_ordinal`.
+    The rows are sorted by (id, month) keys, unless they are already in
+    that order, and each key is compared with the keys of the `lag` rows
+    before it, so no search or merge is needed. Each id must have at most
+    one record per month. Rows with a missing id or month (-1 from
+    `calc_month_ordinal`) get NaN.
+
+    >>> ids = np.array([1, 1, 1, 2, 2])
+    >>> month = np.array([0, 1, 3, 0, 1])
+    >>> lag_by_month_ordinal(ids, month, np.array([1.0, 2.0, 3.0, 4.0, 5.0]))
+    array([nan,  1., nan, nan,  4.])
+    """
+    ids = np.asarray(ids)
+    if np.issubdtype(ids.dtype, np.integer):
+        # Integer ids (e.g., permnos) are their own codes
+        id_codes = ids.astype(np.int64) - ids.min(initial=0)
+    else:
+        id_codes, _ = pd.factorize(ids)
+    month = np.asarray(month, dtype=np.int64)
+    values = np.asarray(values, dtype=float)
+    # Room for `lag` months before the first and after the last month of
+    # each id. Rows with a missing id or month get key -1 and are never
+    # found.
+    span = month.max(initial=0) + 2 * abs(lag) + 1
+    key = id_codes * span + month + abs(lag)
+    has_missing = id_codes.min(initial=0) < 0 or month.min(initial=0) < 0
+    if has_missing:
+        key[(id_codes < 0) | (month < 0)] = -1
+    if np.all(key[1:] >= key[:-1]):
+        order = None
+    else:
+        order = np.argsort(key, kind="stable")
+        key, values = key[order], values[order]
+
+    # With one record per id and month, the record `lag` months earlier
+    # is at most `lag` rows before in the sorted rows (after for a lead)
+    lagged = np.where(key >= 0, values, np.nan) if lag == 0 else np.full(len(key), np.nan)
+    for k in range(1, abs(lag) + 1):
+        later, earlier = (slice(k, None), slice(None, -k))
+        if lag < 0:
+            later, earlier = earlier, later
+        found = key[later] - key[earlier] == lag
+        if has_missing:
+            found &= key[later] >= 0
+        np.copyto(lagged[later], values[earlier], where=found)
+    if order is None:
+        return lagged
+    result = np.empty_like(lagged)
+    result[order] = lagged
+    return result
+
+
 def leave_one_out_sums(df, groupby=[], summed_col=''):
     """
     Compute leave-one-out sums, x_i = \sum_{\ell'\neq\ell} w_{i, \ell'}
@@ -459,6 +537,248 @@ def leave_one_out_sums(df, groupby=[], summed_col=''):
     return s
 
 
+def apply_dtype_schema(df, schema, float32=False):
+    """Cast columns of `df` to the dtypes declared in `schema`.
+
+    `schema` maps column names to dtypes, e.g., `"int32"` or `"category"`.
+    The special dtype `"float"` is cast to float32 if `float32=True` and
+    to float64 otherwise. Columns that are not in `df` are skipped, and
+    columns that are not in `schema` or already have their dtype are left
+    unchanged and not copied (e.g., memory-mapped columns, see
+    `load_arrow_ipc`).
+
+    >>> df = pd.DataFrame({'id': [1, 2], 'flag': ['A', 'A'], 'price': [1.5, 2.5]})
+    >>> schema = {'id': 'int32', 'flag': 'category', 'price': 'float'}
+    >>> apply_dtype_schema(df, schema, float32=True).dtypes.tolist()
+    [dtype('int32'), CategoricalDtype(categories=['A'], ordered=False, categories_dtype=object), dtype('float32')]
+    """
+    dtypes = {}
+    for col, dtype in schema.items():
+        if col not in df.columns:
+            continue
+        if dtype == "float":
+            dtype = "float32" if float32 else "float64"
+        if df[col].dtype != dtype:
+            dtypes[col] = dtype
+    return df.astype(dtypes, copy=False)
+
+
+def save_arrow_ipc(df, path):
+    """Save `df` as an uncompressed Arrow IPC (Feather V2) file that
+    `load_arrow_ipc` can memory-map.
+
+    Missing float values are stored as NaN rather than as Arrow nulls, so
+    that float columns can be read back without a copy. The file is
+    written to a temporary file first and then renamed, so processes
+    that open it never see a partial file.
+    """
+    path = Path(path)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, name in enumerate(table.column_names):
+        if pd.api.types.is_float_dtype(df[name]):
+            values = pa.array(df[name].to_numpy(), from_pandas=False)
+            table = table.set_column(i, name, values)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    # A single record batch, so that columns are contiguous in the file
+    feather.write_feather(
+        table.combine_chunks(), tmp, compression="uncompressed", chunksize=max(len(df), 1)
+    )
+    os.replace(tmp, path)
+    return path
+
+
+def load_arrow_ipc(path, columns=None, filters=None):
+    """Open an Arrow IPC file written by `save_arrow_ipc` memory-mapped
+    and return it as a DataFrame.
+
+    Nothing is read when the file is opened. Numeric and date columns
+    without nulls are zero-copy, read-only views of the file: their pages
+    are loaded on first access and live in the OS page cache, so every
+    process that opens the file shares one physical copy. Other columns
+    (strings, categoricals, columns with nulls) are converted to pandas
+    and use memory in each process.
+
+    `columns` selects columns without reading the others. `filters` are
+    pyarrow filters in the format of `pd.read_parquet`; the rows they
+    select are copied.
+    """
+    source = pa.memory_map(str(path), "r")
+    table = pa.ipc.open_file(source).read_all()
+    if filters:
+        table = table.filter(pq.filters_to_expression(filters))
+    if columns is not None:
+        table = table.select(columns)
+    return table.to_pandas(split_blocks=True)
+
+
+def arrow_ipc_copy(parquet_path):
+    """Path of an Arrow IPC copy of the parquet file at `parquet_path`
+    (same name, with the ".arrow" suffix), for `load_arrow_ipc`. The copy
+    is written by `save_arrow_ipc` if it does not exist or is older than
+    the parquet file.
+    """
+    parquet_path = Path(parquet_path)
+    arrow_path = parquet_path.with_suffix(".arrow")
+    if (
+        not arrow_path.exists()
+        or arrow_path.stat().st_mtime < parquet_path.stat().st_mtime
+    ):
+        save_arrow_ipc(pd.read_parquet(parquet_path), arrow_path)
+    return arrow_path
+
+
+def read_sql_chunks(sql, connection, chunksize=500_000, date_cols=None):
+    """Run the query `sql` on the SQLAlchemy `connection` (e.g., the
+    `connection` of a `wrds.Connection`) and return an iterator over its
+    results, in DataFrames of `chunksize` rows.
+
+    The query runs with a server-side cursor (`stream_results`), so rows
+    are fetched from the server as the chunks are consumed instead of all
+    at once. Databases without server-side cursors (e.g., SQLite) ignore
+    the option.
+    """
+    connection = connection.execution_options(stream_results=True)
+    return pd.read_sql_query(
+        sql, connection, parse_dates=date_cols, chunksize=chunksize
+    )
+
+
+def write_parquet_dataset_by_year(chunks, path, date_col, since=None):
+    """Write the DataFrames of the iterable `chunks` to a parquet dataset
+    at `path`, partitioned by the year of `date_col`
+    (`year=YYYY/part-N.parquet`, one file per chunk and year), and return
+    `path`. A single chunk is held in memory at a time.
+
+    `pd.read_parquet(path)` reads the dataset back, with the partition
+    column `year` last (a `year` column of the chunks is not written,
+    since it is the partition). Categorical columns are written as their
+    values, since their categories differ from chunk to chunk. A column
+    that is all missing in a chunk, or integer in a chunk and float in
+    another, takes the type of the other chunks: the few files written
+    before its type was known are rewritten at the end.
+
+    The dataset is written to a temporary directory that replaces `path`
+    (a file or a dataset) once complete.
+
+    With `since` (see `incremental_since`), the chunks hold the rows
+    dated `since` or later, and replace those rows of the dataset at
+    `path` (an upsert of the dates from `since`, that also removes the
+    rows no longer returned). Only the partitions of the years from
+    `since` are rewritten (written to the temporary directory, then
+    swapped in one by one); the earlier ones are left as they are. A
+    single file at `path` is rewritten as a dataset.
+    """
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    tmp.mkdir(parents=True)
+
+    schema = None
+    update = since is not None and path.is_dir()
+    if since is not None and path.is_file():
+        # A single file (e.g., from a pull in memory) becomes a dataset
+        kept = pd.read_parquet(path)
+        chunks = itertools.chain([kept[~(kept[date_col] >= pd.Timestamp(since))]], chunks)
+    if update:
+        since = pd.Timestamp(since)
+        stored_files = sorted(path.glob("year=*/*.parquet"))
+        schema = pq.read_schema(stored_files[0]) if stored_files else None
+        # The stored rows of the first year before `since` are kept
+        first_year = path / f"year={since.year}"
+        if first_year.exists():
+            kept = pd.read_parquet(first_year)
+            chunks = itertools.chain([kept[~(kept[date_col] >= since)]], chunks)
+
+    files = []
+    for i, chunk in enumerate(chunks):
+        categories = chunk.select_dtypes("category").columns
+        chunk = chunk.astype({col: chunk[col].cat.categories.dtype for col in categories})
+        years = chunk[date_col].dt.year
+        chunk = chunk.drop(columns="year", errors="ignore")
+        for year, part in chunk.groupby(years):
+            table = pa.Table.from_pandas(part, preserve_index=False)
+            if schema is None:
+                schema = table.schema
+            elif table.schema != schema:
+                schema = pa.unify_schemas(
+                    [schema, table.schema], promote_options="permissive"
+                )
+                table = table.cast(schema)
+            file = tmp / f"year={year}" / f"part-{i}.parquet"
+            file.parent.mkdir(exist_ok=True)
+            pq.write_table(table, file)
+            files.append((file, table.schema))
+
+    for file, file_schema in files:
+        if file_schema != schema:
+            pq.write_table(pq.read_table(file).cast(schema), file)
+
+    if update:
+        for partition in path.glob("year=*"):
+            if int(partition.name.split("=")[1]) >= since.year:
+                shutil.rmtree(partition)
+        for partition in tmp.iterdir():
+            os.replace(partition, path / partition.name)
+        tmp.rmdir()
+        return path
+
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+    os.replace(tmp, path)
+    return path
+
+
+def incremental_since(path, date_col, lookback_months=0):
+    """Start date of an incremental update of the parquet file or dataset
+    at `path` (see `write_parquet_dataset_by_year`): the latest `date_col` stored (the watermark),
+    less `lookback_months` months, so that recently restated rows are
+    pulled again. None if nothing is stored, for a full pull.
+
+    Only the last year partition of a dataset is read, and only its
+    `date_col` column.
+    """
+    if path is None:
+        raise ValueError("Incremental updates need the path of the stored data")
+    path = Path(path)
+    if path.is_dir():
+        partitions = sorted(path.glob("year=*"), key=lambda p: int(p.name.split("=")[1]))
+        if not partitions:
+            return None
+        path = partitions[-1]
+    elif not path.exists():
+        return None
+    latest = pc.max(pq.read_table(path, columns=[date_col])[date_col]).as_py()
+    if latest is None:
+        return None
+    return pd.Timestamp(latest) - pd.DateOffset(months=lookback_months)
+
+
+def memory_usage_report(dfs):
+    """Memory used by each DataFrame in the dictionary `dfs`, in MB.
+
+    >>> df = pd.DataFrame({'x': range(1000)})
+    >>> memory_usage_report({'df': df, 'head': df.head()})
+          rows  columns        MB
+    df    1000        1  0.008132
+    head     5        1  0.000172
+    """
+    report = pd.DataFrame.from_dict(
+        {
+            name: {
+                "rows": len(df),
+                "columns": df.shape[1],
+                "MB": df.memory_usage(deep=True).sum() / 1e6,
+            }
+            for name, df in dfs.items()
+        },
+        orient="index",
+    )
+    return report
+
+
 def get_most_recent_quarter_end(d):
     """
     Take a datetime and find the most recent quarter end date
@@ -0,0 +1,308 @@
+"""
+Content-addressed cache for the intermediate stages of a pipeline, such
+as `comp`, `crsp2`, `crsp3`, `crsp_jun` and `ccm_jun` in
+`calc_Fama_French_1993_factors.py`.
+
+Each stage result (a DataFrame or a tuple of DataFrames) is stored as
+parquet under a key that hashes
+
+- the contents of the input files (or year-partitioned datasets) of the
+  stage,
+- the keys of the upstream stages whose results it takes as input,
+- its keyword parameters, and
+- the source code of the stage function and of the functions of this
+  repository it calls, directly or indirectly, with the module-level
+  constants they refer to.
+
+When the key of a stage matches an entry in the cache, the stage is
+skipped and its result is read back from disk. Changing a late stage
+(e.g., the breakpoints) therefore reuses every earlier stage, while
+changing an input file or the code of a stage recomputes that stage and
+everything downstream of it.
+
+The cache is bounded in size: after every write, the least recently used
+entries are removed until the total size is at most `max_bytes`.
+
+>>> cache = StageCache(DATA_DIR / "derived" / "stage_cache", max_bytes=2**30)
+>>> create_Fama_French_factors(cache=cache)
+>>> cache.inspect()
+>>> cache.clear()
+"""
+import ast
+import functools
+import hashlib
+import inspect
+import json
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+import config
+
+DATA_DIR = config.DATA_DIR
+DEFAULT_CACHE_DIR = DATA_DIR / "derived" / "stage_cache"
+DEFAULT_MAX_BYTES = 10 * 2**30
+
+# File hashes by (path, size, modification time), so that large input
+# files are only read once per process.
+_file_hashes = {}
+
+
+def hash_file(path, chunk_size=2**24):
+    """SHA-256 of the contents of the file at `path`, or of a parquet
+    dataset partitioned by year at `path` (see
+    `misc_tools.write_parquet_dataset_by_year`): the relative paths and
+    contents of its `year=*/*.parquet` files, in sorted order.
+    """
+    path = Path(path).resolve()
+    if path.is_dir():
+        digest = hashlib.sha256()
+        for file in sorted(path.glob("year=*/*.parquet")):
+            digest.update(file.relative_to(path).as_posix().encode())
+            digest.update(hash_file(file, chunk_size).encode())
+        return digest.hexdigest()
+    stat = path.stat()
+    memo_key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+        _file_hashes[memo_key] = digest.hexdigest()
+    return _file_hashes[memo_key]
+
+
+# Modules of this repository, whose functions `function_sources` follows
+SRC_DIR = Path(__file__).resolve().parent
+
+
+def _in_repository(obj):
+    """Whether `obj` is defined in a module of this repository (and not in
+    the standard library or a third-party package such as pandas).
+    """
+    path = getattr(inspect.getmodule(obj), "__file__", None)
+    return path is not None and Path(path).resolve().parent == SRC_DIR
+
+
+@functools.lru_cache(maxsize=None)
+def _module_assignments(module):
+    """Source of the module-level assignments of `module`, by name."""
+    source = inspect.getsource(module)
+    assignments = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, ast.AnnAssign):
+            targets = [node.target]
+        else:
+            continue
+        for target in targets:
+            for name in ast.walk(target):
+                if isinstance(name, ast.Name):
+                    assignments.setdefault(name.id, []).append(
+                        ast.get_source_segment(source, node)
+                    )
+    return assignments
+
+
+def _code_names(code):
+    """Global and attribute names used by `code` and the functions,
+    lambdas and comprehensions defined in it.
+    """
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names += _code_names(const)
+    return names
+
+
+def _referenced_globals(func):
+    """Module, name and value of the module-level objects that `func`
+    refers to, either by name or as an attribute of a module of this
+    repository (e.g., `misc_tools.func`).
+    """
+    names = list(dict.fromkeys(_code_names(func.__code__)))
+    namespace = func.__globals__
+    module = inspect.getmodule(func)
+    modules = [
+        namespace[n] for n in names
+        if inspect.ismodule(namespace.get(n)) and _in_repository(namespace[n])
+    ]
+    for name in names:
+        if name in namespace:
+            yield module, name, namespace[name]
+        for other in modules:
+            if hasattr(other, name):
+                yield other, name, getattr(other, name)
+
+
+def function_sources(func):
+    """Source code of `func` and of the functions and classes of this
+    repository that it calls, directly or through other functions, and
+    of the module-level assignments of the constants they refer to (e.g.,
+    dtype schemas and filters). Functions of third-party packages, such
+    as pandas, are not followed.
+    """
+    # Look through wrappers such as stage_profile.profile_stage
+    func = inspect.unwrap(func)
+    sources = [inspect.getsource(func)]
+    if not _in_repository(func):
+        return sources
+    seen = {func}
+    stack = [func]
+    while stack:
+        for module, name, obj in _referenced_globals(stack.pop()):
+            if inspect.isfunction(obj):
+                obj = inspect.unwrap(obj)
+            if inspect.ismodule(obj):
+                continue
+            if inspect.isfunction(obj) or inspect.isclass(obj):
+                if obj in seen or not _in_repository(obj):
+                    continue
+                seen.add(obj)
+                sources.append(inspect.getsource(obj))
+                if inspect.isfunction(obj):
+                    stack.append(obj)
+            elif (module, name) not in seen:
+                seen.add((module, name))
+                sources += _module_assignments(module).get(name, [])
+    return sources
+
+
+class StageCache:
+    """Cache of stage results stored as parquet in `cache_dir`, one
+    directory per key holding the result and a `meta.json` file.
+
+    Parameters
+    ----------
+    cache_dir : Path
+        Directory holding the cache. Created if needed.
+    max_bytes : int
+        Size bound. After every write, least recently used entries are
+        evicted until the cache is at most this size.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def stage_key(self, name, func, input_files=(), upstream=(), params=None):
+        """Key of stage `name` computed by `func`. See the module docstring."""
+        description = {
+            "name": name,
+            "sources": function_sources(func),
+            "input_files": [hash_file(path) for path in input_files],
+            "upstream": list(upstream),
+            "params": {k: repr(v) for k, v in sorted((params or {}).items())},
+        }
+        encoded = json.dumps(description, sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def run(self, name, func, *args, input_files=(), upstream=(), **params):
+        """Return `func(*args, **params)` and the key of the stage.
+
+        Positional `args` are the data the stage works on (e.g., the
+        results of upstream stages) and are not hashed. Their identity is
+        given by `input_files` (paths of files the stage reads) and
+        `upstream` (keys of the stages that produced them). Keyword
+        `params` are passed to `func` and hashed.
+        """
+        key = self.stage_key(name, func, input_files, upstream, params)
+        entry = self.cache_dir / key
+        if (entry / "meta.json").exists():
+            return self._read(entry), key
+
+        result = func(*args, **params)
+        self._write(entry, name, result)
+        self.evict()
+        return result, key
+
+    def _read(self, entry):
+        meta_path = entry / "meta.json"
+        meta = json.loads(meta_path.read_text())
+        outputs = [pd.read_parquet(entry / f"{i}.parquet") for i in range(meta["n_outputs"])]
+        meta["last_used"] = time.time()
+        meta_path.write_text(json.dumps(meta))
+        return tuple(outputs) if meta["is_tuple"] else outputs[0]
+
+    def _write(self, entry, name, result):
+        outputs = result if isinstance(result, tuple) else (result,)
+        # Write to a temporary directory first so that an interrupted
+        # write never leaves a partial entry behind.
+        tmp = self.cache_dir / f".tmp-{uuid.uuid4().hex}"
+        tmp.mkdir(parents=True)
+        for i, df in enumerate(outputs):
+            df.to_parquet(tmp / f"{i}.parquet")
+        now = time.time()
+        meta = {
+            "name": name,
+            "n_outputs": len(outputs),
+            "is_tuple": isinstance(result, tuple),
+            "created": now,
+            "last_used": now,
+            "n_bytes": sum(f.stat().st_size for f in tmp.iterdir()),
+        }
+        (tmp / "meta.json").write_text(json.dumps(meta))
+        if entry.exists():
+            shutil.rmtree(entry)
+        tmp.rename(entry)
+
+    def inspect(self):
+        """DataFrame with one row per cache entry (key, stage name, size,
+        creation and last use time), most recently used first.
+        """
+        rows = []
+        if self.cache_dir.exists():
+            for meta_path in self.cache_dir.glob("*/meta.json"):
+                meta = json.loads(meta_path.read_text())
+                rows.append(
+                    {
+                        "key": meta_path.parent.name,
+                        "name": meta["name"],
+                        "n_bytes": meta["n_bytes"],
+                        "created": pd.to_datetime(meta["created"], unit="s"),
+                        "last_used": pd.to_datetime(meta["last_used"], unit="s"),
+                    }
+                )
+        columns = ["key", "name", "n_bytes", "created", "last_used"]
+        df = pd.DataFrame(rows, columns=columns)
+        return df.sort_values("last_used", ascending=False, ignore_index=True)
+
+    def evict(self):
+        """Remove least recently used entries until the cache is at most
+        `max_bytes`. Returns the keys of the removed entries.
+        """
+        entries = self.inspect()
+        total = entries["n_bytes"].sum()
+        removed = []
+        # inspect lists the least recently used entries last
+        for key, n_bytes in zip(entries["key"][::-1], entries["n_bytes"][::-1]):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self.cache_dir / key)
+            total -= n_bytes
+            removed.append(key)
+        return removed
+
+    def clear(self, name=None):
+        """Remove every entry, or only the entries of stage `name`."""
+        entries = self.inspect()
+        if name is not None:
+            entries = entries[entries["name"] == name]
+        for key in entries["key"]:
+            shutil.rmtree(self.cache_dir / key)
+
+
+def run_stage(cache, name, func, *args, input_files=(), upstream=(), **params):
+    """Run a stage through `cache` (a `StageCache`), or directly if
+    `cache` is None. Returns the result and the key of the stage (None
+    without a cache).
+    """
+    if cache is None:
+        return func(*args, **params), None
+    return cache.run(
+        name, func, *args, input_files=input_files, upstream=upstream, **params
+    )
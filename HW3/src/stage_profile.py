@@ -0,0 +1,177 @@
+"""
+Per-stage timing and memory instrumentation for pipelines such as
+`create_Fama_French_factors` in `calc_Fama_French_1993_factors.py`.
+
+Stage functions are wrapped with `profile_stage`. When profiling is
+enabled (`PROFILE_STAGES=True` in the environment or `.env` file, see
+`config.py`), every call of a stage records
+
+- the wall time and the CPU time of the process,
+- the resident set size (RSS) before the call and the peak RSS above it
+  during the call, sampled in a background thread, and
+- the number of rows of the DataFrames it takes and returns.
+
+`start_run` clears the records and `write_run_log` writes them to a JSON
+file in `config.PROFILE_DIR`, one file per run, so that two runs can be
+compared with `diff_run_logs`. When profiling is disabled, a stage is
+only a call through a wrapper that checks `ENABLED`.
+
+>>> path = write_run_log()
+>>> diff_run_logs(previous_path, path)
+"""
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+import pandas as pd
+
+import config
+
+ENABLED = config.PROFILE_STAGES
+PROFILE_DIR = Path(config.PROFILE_DIR)
+
+_run = {"name": None, "started": None, "stages": []}
+
+
+def current_rss():
+    """Resident set size of this process, in bytes. Falls back to the
+    peak RSS of the process where /proc is not available, and is NaN
+    where neither is (on Windows).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        if resource is None:
+            return math.nan
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes on Linux
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class _PeakRSS:
+    """Highest RSS seen by a thread that samples it every `interval`
+    seconds while the block runs.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def count_rows(obj):
+    """Number of rows of each DataFrame or Series in `obj` (a DataFrame,
+    a Series or a tuple/list of them).
+    """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return [len(obj)]
+    if isinstance(obj, (tuple, list)):
+        return [n for item in obj for n in count_rows(item)]
+    return []
+
+
+def profile_stage(func):
+    """Record the timing, memory and row counts of every call of `func`
+    while profiling is enabled.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return func(*args, **kwargs)
+        rows_in = count_rows(list(args) + list(kwargs.values()))
+        rss_before = current_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        with _PeakRSS() as peak:
+            result = func(*args, **kwargs)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        _run["stages"].append(
+            {
+                "stage": func.__name__,
+                "call": sum(s["stage"] == func.__name__ for s in _run["stages"]),
+                "wall_s": round(wall, 4),
+                "cpu_s": round(cpu, 4),
+                "rss_before_mb": round(rss_before / 2**20, 1),
+                "peak_rss_delta_mb": round(max(peak.peak - rss_before, 0) / 2**20, 1),
+                "rows_in": rows_in,
+                "rows_out": count_rows(result),
+            }
+        )
+        return result
+
+    return wrapper
+
+
+def start_run(name):
+    """Clear the records and start the run log of run `name`. Does
+    nothing when profiling is disabled.
+    """
+    if ENABLED:
+        _run.update(name=name, started=pd.Timestamp.now().isoformat(), stages=[])
+
+
+def stage_records():
+    """DataFrame of the stage calls recorded since `start_run`."""
+    columns = [
+        "stage", "call", "wall_s", "cpu_s", "rss_before_mb",
+        "peak_rss_delta_mb", "rows_in", "rows_out",
+    ]
+    return pd.DataFrame(_run["stages"], columns=columns)
+
+
+def write_run_log(profile_dir=None):
+    """Write the records of the current run to
+    `profile_dir / "<name>_<start time>.json"` (`PROFILE_DIR` by default)
+    and return the path (None when profiling is disabled).
+    """
+    if not ENABLED:
+        return None
+    profile_dir = Path(profile_dir or PROFILE_DIR)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    started = pd.Timestamp(_run["started"])
+    path = profile_dir / f"{_run['name']}_{started:%Y%m%dT%H%M%S}.json"
+    path.write_text(json.dumps(_run, indent=2))
+    return path
+
+
+def read_run_log(path):
+    """Stage records of a run log written by `write_run_log`."""
+    return pd.DataFrame(json.loads(Path(path).read_text())["stages"])
+
+
+def diff_run_logs(old_path, new_path):
+    """Compare two run logs stage by stage (matched on `stage` and
+    `call`): wall time, CPU time and peak RSS delta of both runs, and the
+    ratio of the new to the old wall time.
+    """
+    metrics = ["wall_s", "cpu_s", "peak_rss_delta_mb"]
+    old = read_run_log(old_path).set_index(["stage", "call"])[metrics]
+    new = read_run_log(new_path).set_index(["stage", "call"])[metrics]
+    diff = old.join(new, how="outer", lsuffix="_old", rsuffix="_new")
+    diff["wall_ratio"] = diff["wall_s_new"] / diff["wall_s_old"]
+    return diff
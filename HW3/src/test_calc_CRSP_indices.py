@@ -1,7 +1,10 @@
+import numpy as np
 import pandas as pd
+import pytest
 from pandas.testing import assert_frame_equal
 
 import calc_CRSP_indices
+import generate_synthetic_data
 import load_CRSP_stock
 
 import config
@@ -176,6 +179,135 @@ def test_calc_CRSP_indices_merge():
     )
 
 
+def test_calc_CRSP_indices_single_pass():
+    input = pd.DataFrame(
+        data={
+            "permno": [1, 2, 1, 2, 1, 2, 3],
+            "date": pd.to_datetime(
+                [
+                    "2020-01-01",
+                    "2020-01-01",
+                    "2020-02-01",
+                    "2020-02-01",
+                    "2020-03-01",
+                    "2020-03-01",
+                    "2020-03-01",
+                ]
+            ),
+            "altprc": [1, 2, 0.5, 2.2, 1, 2.42, 5],
+            "ret": [0, 0, -0.5, 0.1, 1, 0.1, None],
+            "retx": [0, 0, -0.5, 0.1, 1, 0.1, 0.2],
+            "shrout": [100, 200, 100, 200, 100, 200, 10],
+        }
+    )
+    before = input.copy()
+
+    output = calc_CRSP_indices.calc_CRSP_indices(input)
+    assert_frame_equal(input, before)
+    assert list(output.columns) == ["vwretd", "vwretx", "totval", "ewretd", "ewretx", "totcnt"]
+    assert output[["vwretd", "vwretx"]].iloc[0].isna().all()
+    assert_frame_equal(
+        output.iloc[1:][["vwretd", "vwretx", "totval"]],
+        calc_CRSP_indices.calc_CRSP_value_weighted_index(input.copy()),
+    )
+    assert_frame_equal(
+        output[["ewretd", "ewretx", "totcnt"]],
+        calc_CRSP_indices.calc_equal_weighted_index(input.copy()),
+    )
+
+
+def test_calc_CRSP_indices_merge_single_pass_matches(tmp_path):
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=300, start_year=2000, end_year=2005
+    )
+    df_msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path)
+    df_msix = load_CRSP_stock.load_CRSP_index_files(data_dir=tmp_path)
+    before = df_msf.copy()
+    output = calc_CRSP_indices.calc_CRSP_indices_merge(df_msf, df_msix)
+    assert_frame_equal(df_msf, before)
+    assert_frame_equal(
+        output,
+        calc_CRSP_indices.calc_CRSP_indices_merge(df_msf, df_msix, single_pass=False),
+    )
+
+
+def test_value_weights_skip_missing_months():
+    # Permno 1 has no record in February, so its March return has no
+    # value weight (rather than its January market cap)
+    input = pd.DataFrame(
+        data={
+            "permno": [1, 2, 2, 1, 2],
+            "date": pd.to_datetime(
+                ["2020-01-31", "2020-01-31", "2020-02-29", "2020-03-31", "2020-03-31"]
+            ),
+            "altprc": [1, 2, 2.2, 1, 2.42],
+            "ret": [0, 0, 0.1, 1, 0.1],
+            "retx": [0, 0, 0.1, 1, 0.1],
+            "shrout": [100, 200, 200, 100, 200],
+        }
+    )
+    output = calc_CRSP_indices.calc_CRSP_indices(input)
+    assert output.loc["2020-03-31", "vwretd"] == pytest.approx(440 * 0.1 / 440)
+    assert_frame_equal(
+        output.iloc[1:][["vwretd", "vwretx", "totval"]],
+        calc_CRSP_indices.calc_CRSP_value_weighted_index(input.copy()),
+    )
+
+
+def test_calc_CRSP_sub_indices_deciles():
+    # 20 stocks with caps 1, ..., 20 in January: the breakpoints of all
+    # stocks put two stocks in each decile in February
+    input = pd.DataFrame(
+        data={
+            "permno": np.tile(np.arange(1, 21), 2),
+            "date": pd.to_datetime(["2020-01-31"] * 20 + ["2020-02-29"] * 20),
+            "exchcd": np.tile([1, 2, 3, 3], 10),
+            "altprc": np.tile(np.arange(1.0, 21.0), 2),
+            "shrout": 1.0,
+            "ret": np.r_[np.zeros(20), np.arange(1, 21) / 1000],
+            "retx": np.r_[np.zeros(20), np.arange(1, 21) / 1000],
+        }
+    )
+    before = input.copy()
+    output = calc_CRSP_indices.calc_CRSP_sub_indices(input, breakpoint_exchcd=None)
+    assert_frame_equal(input, before)
+    assert output.filter(like="decret").loc["2020-01-31"].isna().all()
+    for j in range(1, 11):
+        i1, i2 = 2 * j - 1, 2 * j
+        assert output.loc["2020-02-29", f"decret{j}"] == pytest.approx(
+            (i1**2 + i2**2) / (1000 * (i1 + i2))
+        )
+    nyse = np.arange(1, 21, 4)
+    assert output.loc["2020-02-29", "ewretd_nyse"] == pytest.approx(nyse.mean() / 1000)
+    assert output.loc["2020-02-29", "usdval_nyse"] == nyse.sum()
+
+    # With NYSE breakpoints (caps 1, 5, 9, 13, 17), the 90th percentile
+    # is 15.4 and stocks 16 to 20 are in decile 10
+    output = calc_CRSP_indices.calc_CRSP_sub_indices(input)
+    top = np.arange(16, 21)
+    assert output.loc["2020-02-29", "decret10"] == pytest.approx(
+        (top**2).sum() / (1000 * top.sum())
+    )
+
+
+def test_calc_CRSP_sub_indices_merge(tmp_path):
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=500, start_year=2000, end_year=2005, block_size=200
+    )
+    df_msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path)
+    df_msix = load_CRSP_stock.load_CRSP_index_files(data_dir=tmp_path)
+    df = calc_CRSP_indices.calc_CRSP_sub_indices_merge(df_msf, df_msix)
+    assert len(df) == len(df_msix)
+    for j in range(1, 11):
+        assert (df[f"decret{j}"] - df[f"decret{j}_manual"]).abs().max() < 1e-12
+
+    # The exchange sub-indices add up to the whole market
+    usdval = df[[f"usdval_{name}" for name in calc_CRSP_indices.EXCHANGES.values()]]
+    vwretd = df[[f"vwretd_{name}" for name in calc_CRSP_indices.EXCHANGES.values()]]
+    market = (vwretd.to_numpy() * usdval.to_numpy()).sum(axis=1) / usdval.sum(axis=1)
+    assert (market - df["vwretd"]).abs().max() < 1e-12
+
+
 def test_compare_CRSP_manual():
     
     VW_AVE_THRESHOLD = 0.002
@@ -241,3 +373,49 @@ def test_compare_CRSP_manual():
     assert df[["vwretx", "vwretx_manual"]].corr().iloc[0, 1] > 0.999
     assert df[["ewretd", "ewretd_manual"]].corr().iloc[0, 1] > 0.99
     assert df[["ewretx", "ewretx_manual"]].corr().iloc[0, 1] > 0.99
+
+
+def test_apply_delisting_returns():
+    input = pd.DataFrame(
+        {
+            "ret": [0.01, 0.02, -0.1, np.nan, 0.03, 0.05],
+            "retx": [0.01, 0.01, -0.1, np.nan, 0.02, 0.05],
+            "dlret": [np.nan, np.nan, np.nan, np.nan, 0.2, np.nan],
+            "dlretx": [np.nan, np.nan, np.nan, np.nan, 0.1, -0.5],
+            "dlstcd": [np.nan, 100, 552, 231, 231, 500],
+        }
+    )
+    before = input.copy()
+    output = load_CRSP_stock.apply_delisting_returns(input)
+    assert_frame_equal(input, before)
+    # Missing delisting returns: -30% for performance codes, -100% for
+    # other delisting codes and none for active securities
+    np.testing.assert_array_equal(output["dlret"], [np.nan, np.nan, -0.3, -1.0, 0.2, -0.3])
+    np.testing.assert_array_equal(output["dlretx"], [np.nan, np.nan, -0.3, -1.0, 0.1, -0.5])
+    np.testing.assert_array_equal(output["ret"], [0.01, 0.02, -0.3, -1.0, 0.2, -0.3])
+    np.testing.assert_array_equal(output["retx"], [0.01, 0.01, -0.3, -1.0, 0.1, -0.5])
+
+    output = load_CRSP_stock.apply_delisting_returns(input, convention="alt")
+    np.testing.assert_allclose(output["ret"], [0.01, 0.02, -0.1, np.nan, 0.23, 0.05])
+    np.testing.assert_allclose(output["retx"], [0.01, 0.01, -0.1, np.nan, 0.12, -0.45])
+    # Missing delisting returns are 0, whatever the delisting code
+    np.testing.assert_array_equal(output["dlret"], [0, 0, 0, 0, 0.2, 0])
+    with pytest.raises(ValueError):
+        load_CRSP_stock.apply_delisting_returns(input, convention="other")
+
+
+def test_memory_mapped_monthly_file_matches_parquet(tmp_path):
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=200, start_year=2000, end_year=2005
+    )
+    df_msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path)
+    df_msf_mmap = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path, memory_map=True)
+    assert_frame_equal(df_msf_mmap, df_msf)
+    assert (tmp_path / "pulled" / "CRSP_MSF_INDEX_INPUTS.arrow").exists()
+
+    # The index calculations do not write to the read-only panel
+    df_msix = load_CRSP_stock.load_CRSP_index_files(data_dir=tmp_path)
+    assert_frame_equal(
+        calc_CRSP_indices.calc_CRSP_indices_merge(df_msf_mmap, df_msix),
+        calc_CRSP_indices.calc_CRSP_indices_merge(df_msf, df_msix),
+    )
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import load_CRSP_Compustat
+from calc_Fama_French_1993_daily_factors import (
+    calc_daily_portfolio_returns_chunk,
+    create_daily_Fama_French_factors,
+    date_chunks,
+)
+
+
+def _example_daily():
+    # Stock 1 is held in ffyear 2019 and 2020, stock 2 only in ffyear 2020.
+    # Stock 3 is not held.
+    dates = pd.to_datetime(["2020-06-29", "2020-06-30", "2020-07-01", "2020-07-02"])
+    crsp_d = pd.DataFrame(
+        {
+            "permno": np.repeat([1, 2, 3], 4),
+            "dlycaldt": np.tile(dates, 3),
+            "dlyret": [0.1, 0.2, -0.1, 0.05, 0.0, 0.0, 0.02, 0.01, 0.5, 0.5, 0.5, 0.5],
+            "dlyretx": [0.1, np.nan, -0.1, 0.05, 0.0, 0.0, 0.02, 0.01, 0.5, 0.5, 0.5, 0.5],
+        }
+    )
+    base = pd.DataFrame(
+        {
+            "permno": [1, 1, 2],
+            "ffyear": [2019, 2020, 2020],
+            "szport": ["S", "S", "S"],
+            "bmport": ["L", "L", "L"],
+            "mebase": [100.0, 50.0, 150.0],
+        }
+    )
+    return crsp_d, base
+
+
+def test_daily_weights_drift_within_year():
+    crsp_d, base = _example_daily()
+    portfolios, carry = calc_daily_portfolio_returns_chunk(crsp_d, base, pd.Series(dtype=float))
+
+    # 2020-06-30: stock 1 drifts from 100 to 110. A missing return leaves
+    # the weight unchanged. 2020-07-01: new year, stock 1 restarts at 50
+    # and stock 2 at 150. 2020-07-02: weights 45 and 153.
+    expected_vwret = [0.1, 0.2, (50 * -0.1 + 150 * 0.02) / 200, (45 * 0.05 + 153 * 0.01) / 198]
+    assert np.allclose(portfolios["vwret"], expected_vwret)
+    assert portfolios["n_firms"].tolist() == [1, 1, 2, 2]
+    assert np.allclose(carry.loc[(1, 2020)], 0.9 * 1.05)
+
+    # Splitting the dates into two chunks carries the drift over
+    first, carry = calc_daily_portfolio_returns_chunk(
+        crsp_d[crsp_d["dlycaldt"] <= "2020-07-01"], base, pd.Series(dtype=float)
+    )
+    second, carry = calc_daily_portfolio_returns_chunk(
+        crsp_d[crsp_d["dlycaldt"] > "2020-07-01"], base, carry
+    )
+    assert_frame_equal(pd.concat([first, second], ignore_index=True), portfolios)
+    assert carry.index.get_level_values("ffyear").tolist() == [2020, 2020]
+
+
+def test_date_chunks():
+    chunks = date_chunks("2020-02-15", "2020-08-31", chunk_freq="QS")
+    assert chunks == [
+        (pd.Timestamp("2020-02-15"), pd.Timestamp("2020-03-31")),
+        (pd.Timestamp("2020-04-01"), pd.Timestamp("2020-06-30")),
+        (pd.Timestamp("2020-07-01"), pd.Timestamp("2020-08-31")),
+    ]
+
+
+def test_chunk_size_does_not_change_factors(tmp_path):
+    rng = np.random.default_rng(0)
+    dates = pd.bdate_range("2019-06-01", "2021-06-30")
+    n_stocks = 12
+    crsp_d = pd.DataFrame(
+        {
+            "permno": np.repeat(np.arange(n_stocks), len(dates)),
+            "dlycaldt": np.tile(dates, n_stocks),
+            "dlyret": rng.normal(0.0005, 0.02, n_stocks * len(dates)),
+        }
+    )
+    crsp_d["dlyretx"] = crsp_d["dlyret"] - 0.0001
+    for year, crsp_year in crsp_d.groupby(crsp_d["dlycaldt"].dt.year):
+        load_CRSP_Compustat.save_CRSP_daily_partition(crsp_year, year, data_dir=tmp_path)
+
+    labels = [(sz, bm) for sz in "SB" for bm in "LMH"]
+    base = pd.DataFrame(
+        [
+            (permno, ffyear) + labels[(permno + ffyear) % 6]
+            for permno in range(n_stocks)
+            for ffyear in [2019, 2020]
+        ],
+        columns=["permno", "ffyear", "szport", "bmport"],
+    )
+    base["mebase"] = rng.lognormal(5, 1, len(base))
+
+    expected = create_daily_Fama_French_factors(data_dir=tmp_path, base=base, chunk_freq="10YS")
+    for chunk_freq in ["MS", "QS"]:
+        outputs = create_daily_Fama_French_factors(data_dir=tmp_path, base=base, chunk_freq=chunk_freq)
+        for output, expected_output in zip(outputs, expected):
+            assert_frame_equal(output, expected_output)
+    assert len(expected[0]) == len(dates[dates >= "2019-07-01"])
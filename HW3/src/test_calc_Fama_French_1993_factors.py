@@ -1,17 +1,36 @@
+import shutil
+
+import numpy as np
 import pandas as pd
 from pandas.testing import assert_frame_equal
+import pytest
 
 import load_CRSP_Compustat
+import stage_cache
 from calc_Fama_French_1993_factors import (
     calc_book_equity_and_years_in_compustat,
     subset_CRSP_to_common_stock_and_exchanges,
     calculate_market_equity,
     use_dec_market_equity,
+    calc_cumulative_return_weights,
+    calc_prior_returns,
+    calc_lagged_value,
+    assign_momentum_portfolios,
+    calc_parity_report,
+    compare_with_Ken_French_report,
     merge_CRSP_and_Compustat,
     assign_size_and_bm_portfolios,
     create_fama_french_portfolios,
     create_factors_from_portfolios,
     create_Fama_French_factors,
+    update_Fama_French_factors,
+    run_prep_stages,
+    calc_portfolios_by_formation_year,
+    link_Compustat_to_CRSP,
+    size_bucket,
+    book_to_market_bucket,
+    assign_size_buckets,
+    assign_book_to_market_buckets,
 )
 
 
@@ -51,6 +70,46 @@ def test_subset_CRSP_to_common_stock_and_exchanges():
     
     assert output== expected
 
+def test_load_CRSP_stock_ciz_with_filters_matches_subset():
+    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=DATA_DIR)
+    expected = subset_CRSP_to_common_stock_and_exchanges(crsp)
+    expected = expected[expected["mthcaldt"] >= "2000-01-01"]
+
+    output = load_CRSP_Compustat.load_CRSP_stock_ciz(
+        data_dir=DATA_DIR, common_stock_only=True, start_date="2000-01-01"
+    )
+    # The categories of the flag columns only include the values that were read
+    assert_frame_equal(output, expected.reset_index(drop=True), check_categorical=False)
+
+    output = load_CRSP_Compustat.load_CRSP_stock_ciz(
+        data_dir=DATA_DIR, columns=["permno", "mthret"], common_stock_only=True
+    )
+    assert list(output.columns) == ["permno", "mthret"]
+
+def test_load_CRSP_stock_ciz_memory_map_matches_parquet(tmp_path):
+    (tmp_path / "pulled").mkdir()
+    shutil.copy(DATA_DIR / "pulled" / "CRSP_stock_ciz.parquet", tmp_path / "pulled")
+    for kwargs in [
+        {},
+        {"common_stock_only": True, "start_date": "2000-01-01", "float32": True},
+        {"columns": ["permno", "jdate", "mthret"], "end_date": "2010-12-31"},
+    ]:
+        expected = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path, **kwargs)
+        output = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path, memory_map=True, **kwargs)
+        assert_frame_equal(output, expected, check_categorical=False)
+
+def test_load_CRSP_stock_ciz_dtypes():
+    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=DATA_DIR)
+    assert crsp["permno"].dtype == "int32"
+    assert crsp["permco"].dtype == "int32"
+    assert crsp["primaryexch"].dtype == "category"
+    assert crsp["mthprc"].dtype == "float64"
+
+    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=DATA_DIR, float32=True)
+    assert crsp["mthprc"].dtype == "float32"
+    assert crsp["shrout"].dtype == "float32"
+    assert crsp["mthret"].dtype == "float64"
+
 def test_calculate_market_equity():
     crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=DATA_DIR)
     crsp = subset_CRSP_to_common_stock_and_exchanges(crsp)
@@ -67,6 +126,151 @@ def test_calculate_market_equity():
     """
     assert output.replace(" ", "").replace("\n", "") == expected.replace(" ", "").replace("\n", "")
 
+def test_calculate_market_equity_ties():
+    # Permco 1 has two permnos that tie on ME in January and no ME at all
+    # in February. Permco 2 has a single permno.
+    crsp = pd.DataFrame(
+        {
+            "permno": [12, 11, 12, 11, 20, 20],
+            "permco": [1, 1, 1, 1, 2, 2],
+            "jdate": pd.to_datetime(
+                ["2020-01-31", "2020-01-31", "2020-02-29", "2020-02-29",
+                 "2020-01-31", "2020-02-29"]
+            ),
+            "mthprc": [10.0, 20.0, np.nan, np.nan, 5.0, 6.0],
+            "shrout": [2.0, 1.0, 1.0, 1.0, 3.0, np.nan],
+        }
+    )
+    crsp2 = calculate_market_equity(crsp.copy())
+    expected = pd.DataFrame(
+        {
+            "permno": [11, 11, 20, 20],
+            "permco": [1, 1, 2, 2],
+            "jdate": pd.to_datetime(
+                ["2020-01-31", "2020-02-29", "2020-01-31", "2020-02-29"]
+            ),
+            "mthprc": [20.0, np.nan, 5.0, 6.0],
+            "shrout": [1.0, 1.0, 3.0, np.nan],
+            "me": [40.0, 0.0, 15.0, 0.0],
+        }
+    )
+    assert_frame_equal(crsp2, expected)
+
+    # The original merge keeps both tied permnos
+    crsp2_merge = calculate_market_equity(crsp.copy(), vectorized=False)
+    assert crsp2_merge["permno"].tolist() == [11, 11, 12, 12, 20, 20]
+
+
+def test_prior_returns_and_lagged_me_are_gap_aware():
+    # Permno 1 has 14 consecutive months. Permno 2 has the same months
+    # except June 2019.
+    dates = pd.date_range("2019-01-31", periods=14, freq="M")
+    rets = np.linspace(-0.05, 0.08, 14)
+    crsp2 = pd.DataFrame(
+        {
+            "permno": np.repeat([1, 2], 14),
+            "jdate": np.tile(dates, 2),
+            "mthret": np.tile(rets, 2),
+            "me": np.arange(28, dtype=float),
+        }
+    )
+    crsp2 = crsp2[~((crsp2["permno"] == 2) & (crsp2["jdate"] == "2019-06-30"))]
+    # Shuffled rows give the same results
+    crsp2 = crsp2.sample(frac=1, random_state=0)
+
+    prior = calc_prior_returns(crsp2).sort_index()
+    # Permno 1: t-12 to t-2 is complete from its 13th month on
+    assert prior.loc[0:11].isna().all()
+    assert np.isclose(prior.loc[12], np.prod(1 + rets[0:11]) - 1)
+    assert np.isclose(prior.loc[13], np.prod(1 + rets[1:12]) - 1)
+    # Permno 2: the windows of its last two months include June 2019,
+    # although there are 11 earlier rows.
+    assert prior.loc[14:].isna().all()
+
+    lagged = calc_lagged_value(crsp2, "me").sort_index()
+    assert np.isnan(lagged.loc[0])
+    assert lagged.loc[1] == 0.0
+    # July 2019 of permno 2 has no June 2019 record to lag
+    assert np.isnan(lagged.loc[20])
+    assert lagged.loc[21] == 20.0
+
+
+def test_momentum_portfolios():
+    crsp2 = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=DATA_DIR)
+    crsp2 = calculate_market_equity(subset_CRSP_to_common_stock_and_exchanges(crsp2))
+    mom = assign_momentum_portfolios(crsp2)
+    assert set(mom["szport"]) == {"S", "B"}
+    assert set(mom["momport"]) == {"L", "M", "H"}
+    assert (mom["me_lag"] > 0).all() and mom["prior_ret"].notna().all()
+    # Within each month, every High stock has a higher prior return than
+    # every Low stock of the same size group
+    by_port = mom.groupby(["jdate", "szport", "momport"])["prior_ret"].agg(["min", "max"])
+    by_port = by_port.unstack("momport")
+    both = by_port[("max", "L")].notna() & by_port[("min", "H")].notna()
+    assert (by_port.loc[both, ("max", "L")] < by_port.loc[both, ("min", "H")]).mean() > 0.9
+
+
+def test_parity_report():
+    dates = pd.date_range("2000-01-31", periods=24, freq="M")
+    rng = np.random.default_rng(0)
+    actual = pd.DataFrame(rng.normal(0, 0.05, (24, 2)), index=dates, columns=["smb", "hml"])
+    manual = actual.copy()
+    manual["smb"] += 0.001
+    manual.loc[dates[5], "hml"] += 0.02
+    manual.loc[dates[9], "hml"] -= 0.03
+    manual.loc[dates[0], "hml"] = np.nan
+    # Extra dates and columns are ignored
+    manual.loc[pd.Timestamp("2010-01-31")] = 0.0
+    manual["umd"] = 0.0
+
+    summary, worst, rolling_corr = calc_parity_report(actual, manual, window=12, n_worst=2)
+    assert summary.index.tolist() == ["smb", "hml"]
+    assert summary["n_obs"].tolist() == [24, 23]
+    assert np.isclose(summary.loc["smb", "corr"], 1.0)
+    assert np.isclose(summary.loc["smb", "tracking_error"], 0.0)
+    assert np.isclose(summary.loc["smb", "mean_diff"], 0.001)
+    assert np.isclose(summary.loc["hml", "max_abs_diff"], 0.03)
+    hml_worst = worst[worst["column"] == "hml"]
+    assert hml_worst["date"].tolist() == [dates[9], dates[5]]
+    assert np.allclose(hml_worst["diff"], [-0.03, 0.02])
+    assert worst["rank"].tolist() == [1, 2, 1, 2]
+
+    expected = actual["hml"].where(manual["hml"].notna()).rolling(12).corr(manual["hml"])
+    assert np.allclose(rolling_corr["hml"], expected.reindex(dates), equal_nan=True)
+    assert rolling_corr["smb"].iloc[:11].isna().all()
+
+
+def test_compare_with_Ken_French_report_reads_local_files(tmp_path):
+    (tmp_path / "pulled").mkdir()
+    dates = pd.date_range("1969-11-30", periods=4, freq="M")
+    ff = pd.DataFrame({"date": dates, "smb": [0.01, 0.02, -0.01, 0.03], "hml": 0.0, "umd": 0.01})
+    ff.to_parquet(tmp_path / "pulled" / "FF_FACTORS.parquet")
+    header = "This file was created using the 202312 CRSP database.\n\n"
+    header += "  Average Value Weighted Returns -- Monthly\n"
+    header += ",SMALL LoBM,ME1 BM2,SMALL HiBM,BIG LoBM,ME2 BM2,BIG HiBM\n"
+    rows = [f"{d:%Y%m},   1.00,   2.00,   3.00,   4.00,   5.00, -99.99\n" for d in dates]
+    footer = "\n  Average Equal Weighted Returns -- Monthly\n,SMALL LoBM\n196911,  9.00\n"
+    (tmp_path / "pulled" / "6_Portfolios_2x3.CSV").write_text(header + "".join(rows) + footer)
+
+    ff_factors = pd.DataFrame({"date": dates, "WSMB": ff["smb"] + 0.001, "WHML": 0.0})
+    umd_factors = pd.DataFrame({"date": dates, "WUMD": 0.01})
+    vwret = pd.DataFrame(
+        [(d, p, 0.01 * (i + 1)) for d in dates for i, p in enumerate(["SL", "SM", "SH", "BL", "BM", "BH"])],
+        columns=["jdate", "sbport", "vwret"],
+    )
+    summary, worst, _ = compare_with_Ken_French_report(
+        ff_factors, vwret, umd_factors, data_dir=tmp_path, window=None
+    )
+    assert summary.index.tolist() == ["smb", "hml", "umd", "SL", "SM", "SH", "BL", "BM", "BH"]
+    # Only dates from 1970
+    assert summary.loc["smb", "n_obs"] == 2
+    assert np.isclose(summary.loc["smb", "mean_diff"], 0.001)
+    assert np.allclose(summary.loc[["SL", "SM", "SH", "BL", "BM"], "max_abs_diff"], 0.0)
+    # Missing library values (-99.99) are not compared
+    assert summary.loc["BH", "n_obs"] == 0
+    assert "BH" not in set(worst["column"])
+
+
 def test_factors():
     vwret, vwret_n, ff_factors, ff_nfirms = create_Fama_French_factors(data_dir=DATA_DIR)
     expected = """
@@ -81,7 +285,199 @@ def test_factors():
     # print(output)
     assert expected == output.replace(" ", "").replace("\n", "")
 
+def test_vectorized_buckets_match_row_wise_buckets():
+    # Includes ties with the breakpoints and missing breakpoints, which is
+    # what happens when a jdate has no eligible NYSE stocks.
+    df = pd.DataFrame(
+        {
+            "me": [1.0, 2.0, 3.0, 2.0, 5.0, 0.5],
+            "sizemedn": [2.0, 2.0, 2.0, np.nan, 2.0, 2.0],
+            "beme": [0.1, 0.3, 0.5, 0.7, 0.9, 0.3],
+            "bm30": [0.3, 0.3, 0.3, np.nan, 0.3, 0.3],
+            "bm70": [0.7, 0.7, 0.7, np.nan, 0.7, np.nan],
+        }
+    )
+    expected_sz = df.apply(size_bucket, axis=1).tolist()
+    expected_bm = df.apply(book_to_market_bucket, axis=1).tolist()
+
+    output_sz = assign_size_buckets(df["me"], df["sizemedn"]).tolist()
+    output_bm = assign_book_to_market_buckets(df["beme"], df["bm30"], df["bm70"]).tolist()
+
+    assert output_sz == expected_sz == ["S", "S", "B", "B", "B", "S"]
+    assert output_bm == expected_bm == ["L", "L", "M", "", "H", "L"]
+
+def test_vectorized_portfolio_returns_match_wavg():
+    ccm4 = pd.DataFrame(
+        {
+            "jdate": pd.to_datetime(["2020-07-31"] * 6),
+            "szport": ["S", "S", "S", "B", "B", "B"],
+            "bmport": ["L", "L", "L", "H", "H", "M"],
+            "mthret": [0.1, np.nan, -0.2, 0.05, 0.15, np.nan],
+            "wt": [1.0, 2.0, 3.0, 4.0, 0.0, 0.0],
+        }
+    )
+    vwret, vwret_n = create_fama_french_portfolios(ccm4, vectorized=True)
+    expected_vwret, expected_vwret_n = create_fama_french_portfolios(ccm4, vectorized=False)
+
+    assert_frame_equal(vwret, expected_vwret)
+    assert_frame_equal(vwret_n, expected_vwret_n)
+    # The weight of a missing return stays in the denominator, as in wavg,
+    # and a zero total weight gives NaN.
+    assert vwret["sbport"].tolist() == ["BH", "BM", "SL"]
+    assert vwret["vwret"].round(4).fillna(-99).tolist() == [0.05, -99, -0.0833]
+    assert vwret_n["n_firms"].tolist() == [2, 0, 2]
+
+def test_segment_kernel_matches_groupby_weights():
+    # Permno 1 starts in August (no July row for its first stock-year) and
+    # has a missing return. Permno 2 starts in July.
+    jdate = pd.to_datetime(
+        ["2019-08-31", "2019-09-30", "2020-06-30", "2020-07-31", "2020-08-31",
+         "2020-07-31", "2020-08-31", "2020-09-30"]
+    )
+    crsp2 = pd.DataFrame(
+        {
+            "permno": [1, 1, 1, 1, 1, 2, 2, 2],
+            "mthcaldt": jdate,
+            "jdate": jdate,
+            "mthretx": [0.1, np.nan, -0.5, 0.2, 0.1, 0.05, -0.1, 0.3],
+            "me": [10.0, 11.0, 6.0, 7.2, 8.0, 100.0, 90.0, np.nan],
+        }
+    )
+    crsp2["mthret"] = crsp2["mthretx"]
+    for col in ["sharetype", "securitytype", "securitysubtype", "usincflg",
+                "issuertype", "primaryexch", "conditionaltype", "tradingstatusflg"]:
+        crsp2[col] = ""
+    crsp3, _ = use_dec_market_equity(crsp2.copy(), segment_kernel=True)
+    expected_crsp3, _ = use_dec_market_equity(crsp2.copy(), segment_kernel=False)
+    assert_frame_equal(crsp3, expected_crsp3, check_exact=True)
+    assert crsp3["wt"].round(4).fillna(-99).tolist() == [
+        -99, -99, -99, 6.0, 7.2, 95.2381, 100.0, 90.0
+    ]
+
+    empty = calc_cumulative_return_weights([], [], [], [], [])
+    assert all(len(values) == 0 for values in empty.values())
+
+
+def test_link_Compustat_to_CRSP_matches_merge_and_filter():
+    comp = pd.DataFrame(
+        {
+            "gvkey": ["001000", "001000", "001000", "002000", "003000"],
+            "datadate": pd.to_datetime(
+                ["2018-12-31", "2019-12-31", "2020-12-31", "2020-12-31", "2020-12-31"]
+            ),
+            "be": [1.0, 2.0, 3.0, 4.0, 5.0],
+            "count": [0, 1, 2, 0, 0],
+        }
+    )
+    # gvkey 001000 switches permno in 2020, and has a secondary link that
+    # overlaps both. gvkey 003000 has no link.
+    ccm = pd.DataFrame(
+        {
+            "gvkey": ["001000", "002000", "001000", "001000"],
+            "permno": [10, 20, 11, 12],
+            "linktype": ["LC", "LU", "LC", "LC"],
+            "linkprim": ["P", "P", "P", "C"],
+            "linkdt": pd.to_datetime(["2000-01-01", "2000-01-01", "2020-07-01", "2019-01-01"]),
+            "linkenddt": pd.to_datetime(["2020-06-30", None, None, "2021-12-31"]),
+        }
+    )
+    crsp_jun = pd.DataFrame(
+        {
+            "permno": [10, 10, 11, 12, 12, 20],
+            "jdate": pd.to_datetime(
+                ["2019-06-30", "2020-06-30", "2021-06-30", "2020-06-30", "2021-06-30", "2021-06-30"]
+            ),
+            "dec_me": [1000.0] * 6,
+        }
+    )
+
+    ccm2 = link_Compustat_to_CRSP(comp, ccm)
+    assert list(zip(ccm2["gvkey"], ccm2["permno"], ccm2["be"])) == [
+        ("001000", 10, 1.0),
+        ("001000", 12, 1.0),
+        ("001000", 10, 2.0),
+        ("001000", 12, 2.0),
+        ("001000", 11, 3.0),
+        ("001000", 12, 3.0),
+        ("002000", 20, 4.0),
+    ]
+    # The link table is left untouched
+    assert ccm["linkenddt"].isna().sum() == 2
+
+    output = merge_CRSP_and_Compustat(crsp_jun, comp, ccm, interval_join=True)
+    expected = merge_CRSP_and_Compustat(crsp_jun, comp, ccm.copy(), interval_join=False)
+    assert_frame_equal(output, expected, check_dtype=False)
+
+def test_incremental_update_matches_full_rebuild(tmp_path):
+    # Build the state from a copy of the data that ends in March 2022,
+    # then add the remaining months (which include a new June formation
+    # date) and compare with a full rebuild.
+    pulled = tmp_path / "pulled"
+    pulled.mkdir()
+    for file in ["Compustat.parquet", "CRSP_Comp_Link_Table.parquet"]:
+        shutil.copy(DATA_DIR / "pulled" / file, pulled / file)
+    crsp_full = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=DATA_DIR)
+    crsp_full[crsp_full["jdate"] <= "2022-03-31"].to_parquet(pulled / "CRSP_stock_ciz.parquet")
+
+    create_Fama_French_factors(data_dir=tmp_path, save_state=True)
+
+    crsp_full.to_parquet(pulled / "CRSP_stock_ciz.parquet")
+    outputs = update_Fama_French_factors(data_dir=tmp_path)
+    expected = create_Fama_French_factors(data_dir=DATA_DIR)
+    for output, expected_output in zip(outputs, expected):
+        assert_frame_equal(output, expected_output)
+
+    # Nothing new to add
+    outputs_again = update_Fama_French_factors(data_dir=tmp_path)
+    assert_frame_equal(outputs_again[2], expected[2])
+
+    # check_parity compares the saved state with a full rebuild
+    update_Fama_French_factors(data_dir=tmp_path, check_parity=True)
+    path = tmp_path / "derived" / "FF_1993_state" / "ff_factors.parquet"
+    ff_factors = pd.read_parquet(path)
+    ff_factors.loc[0, "WSMB"] += 0.01
+    ff_factors.to_parquet(path)
+    with pytest.raises(ValueError, match="ff_factors"):
+        update_Fama_French_factors(data_dir=tmp_path, check_parity=True)
+
+
+def test_parallel_by_formation_year_matches_serial():
+    expected = create_Fama_French_factors(data_dir=DATA_DIR)
+    outputs = create_Fama_French_factors(data_dir=DATA_DIR, n_jobs=2)
+    for output, expected_output in zip(outputs, expected):
+        assert_frame_equal(output, expected_output)
+
+
+def test_portfolios_by_formation_year_without_formation_years():
+    crsp3, ccm_jun, _ = run_prep_stages(data_dir=DATA_DIR)
+    last_year = ccm_jun["jdate"].dt.year.max()
+    expected = calc_portfolios_by_formation_year(
+        ccm_jun[ccm_jun["jdate"].dt.year == last_year], crsp3, n_jobs=1
+    )
+    # Empty, and without a June date
+    for ccm_jun_empty in [ccm_jun.iloc[:0], ccm_jun.iloc[:5].assign(jdate=pd.NaT)]:
+        outputs = calc_portfolios_by_formation_year(ccm_jun_empty, crsp3, n_jobs=1)
+        for output, expected_output in zip(outputs, expected):
+            assert output.empty
+            assert_frame_equal(output, expected_output.iloc[:0])
+
+    for n_jobs in [0, -1]:
+        with pytest.raises(ValueError, match="n_jobs"):
+            calc_portfolios_by_formation_year(ccm_jun, crsp3, n_jobs=n_jobs)
+
+
+def test_stage_cache_matches_uncached(tmp_path):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    expected = create_Fama_French_factors(data_dir=DATA_DIR)
+    for _ in range(2):
+        outputs = create_Fama_French_factors(data_dir=DATA_DIR, cache=cache)
+        for output, expected_output in zip(outputs, expected):
+            assert_frame_equal(output, expected_output)
+    assert sorted(cache.inspect()["name"]) == ["ccm_jun", "comp", "crsp2", "crsp3"]
 
 
-test_calc_book_equity_and_years_in_compustat()
-print('be success')
\ No newline at end of file
+def test_polars_backend_matches_pandas():
+    expected = create_Fama_French_factors(data_dir=DATA_DIR)
+    outputs = create_Fama_French_factors(data_dir=DATA_DIR, backend="polars")
+    for output, expected_output in zip(outputs, expected):
+        assert_frame_equal(output, expected_output)
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import calc_portfolio_sorts
+
+
+def _example_panel():
+    """Two formation dates with five stocks each. The first four stocks
+    on each date are NYSE stocks.
+    """
+    return pd.DataFrame(
+        {
+            "jdate": pd.to_datetime(["2020-06-30"] * 5 + ["2021-06-30"] * 5),
+            "primaryexch": ["N", "N", "N", "N", "Q"] * 2,
+            "me": [1.0, 2.0, 3.0, 4.0, 100.0, 10.0, 20.0, 30.0, 40.0, np.nan],
+            "beme": [0.1, 0.2, 0.3, 0.4, 0.5, 0.4, 0.3, 0.2, 0.1, 0.5],
+        }
+    )
+
+
+def test_calc_breakpoints():
+    df = _example_panel()
+    breakpoints = calc_portfolio_sorts.calc_breakpoints(
+        df, sorts={"me": [0.5], "beme": [0.25, 0.75]}, universe=df["primaryexch"] == "N"
+    )
+
+    expected_me = pd.DataFrame(
+        {0.5: [2.5, 25.0]},
+        index=pd.to_datetime(["2020-06-30", "2021-06-30"]),
+    )
+    expected_me.index.name = "jdate"
+    expected_me.columns.name = None
+    output_me = breakpoints["me"]
+    output_me.columns.name = None
+    assert_frame_equal(output_me, expected_me)
+
+    assert breakpoints["beme"].round(4).values.tolist() == [[0.175, 0.325]] * 2
+
+
+def test_assign_buckets_ties_and_missing():
+    breakpoints = pd.DataFrame(
+        {0.5: [2.0, np.nan]},
+        index=pd.to_datetime(["2020-06-30", "2021-06-30"]),
+    )
+    values = [1.0, 2.0, 3.0, np.nan, 1.0, 1.0]
+    dates = pd.to_datetime(
+        ["2020-06-30"] * 4 + ["2021-06-30", "2022-06-30"]
+    )
+    # Ties go to the lower bucket. Missing values, missing breakpoints
+    # and dates without breakpoints are unassigned (0).
+    output = calc_portfolio_sorts.assign_buckets(values, dates, breakpoints)
+    assert output.tolist() == [1, 1, 2, 0, 0, 0]
+
+
+def test_sort_portfolios_2x3():
+    df = _example_panel()
+    eligible = df["me"].notna()
+    ports = calc_portfolio_sorts.sort_portfolios(
+        df,
+        sorts={"me": [0.5], "beme": [0.3, 0.7]},
+        universe=eligible & (df["primaryexch"] == "N"),
+        eligible=eligible,
+        labels={"me": ["S", "B"], "beme": ["L", "M", "H"]},
+        sep="",
+    )
+    assert ports["me_port"].tolist() == [1, 1, 2, 2, 2, 1, 1, 2, 2, 0]
+    assert ports["beme_port"].tolist() == [1, 2, 2, 3, 3, 3, 2, 2, 1, 0]
+    assert ports["port"].tolist() == [
+        "SL", "SM", "BM", "BH", "BH", "SH", "SM", "BM", "BL", "",
+    ]
+
+
+def test_sort_portfolios_default_labels():
+    df = _example_panel()
+    ports = calc_portfolio_sorts.sort_portfolios(
+        df, sorts={"me": calc_portfolio_sorts.QUINTILES}
+    )
+    assert ports["port"].tolist() == ["1", "2", "3", "4", "5", "1", "2", "4", "5", ""]
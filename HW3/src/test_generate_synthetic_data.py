@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import calc_CRSP_indices
+import calc_Fama_French_1993_factors
+import generate_synthetic_data
+import load_CRSP_Compustat
+import load_CRSP_stock
+import misc_tools
+import stage_cache
+
+
+def test_files_have_loader_schemas(tmp_path):
+    paths = generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=300, start_year=2000, end_year=2010, block_size=100
+    )
+    assert all(path.exists() for path in paths.values())
+
+    crsp = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path)
+    comp = load_CRSP_Compustat.load_compustat(data_dir=tmp_path)
+    ccm = load_CRSP_Compustat.load_CRSP_Comp_Link_Table(data_dir=tmp_path)
+    msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path)
+    for df, schema in [
+        (crsp, load_CRSP_Compustat.schema_crsp),
+        (comp, load_CRSP_Compustat.schema_compustat),
+        (ccm, load_CRSP_Compustat.schema_crsp_comp_link),
+        (msf, load_CRSP_stock.schema_msf),
+    ]:
+        # The files are saved with the dtypes the loaders cast to
+        assert_frame_equal(misc_tools.apply_dtype_schema(df, schema), df)
+    assert list(crsp.columns) == [
+        "permno", "permco", "mthcaldt", "issuertype", "securitytype", "securitysubtype",
+        "sharetype", "usincflg", "primaryexch", "conditionaltype", "tradingstatusflg",
+        "mthret", "mthretx", "shrout", "mthprc", "jdate",
+    ]
+    assert (crsp["jdate"] == crsp["mthcaldt"] + pd.offsets.MonthEnd(0)).all()
+    assert crsp["permno"].nunique() == 300
+    assert msf["dlstcd"].notna().any()
+    # Churned links are split in two rows
+    assert ccm["gvkey"].duplicated().any()
+
+    # The same seed gives the same files
+    again = tmp_path / "again"
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=again, n_firms=300, start_year=2000, end_year=2010, block_size=100
+    )
+    assert_frame_equal(load_CRSP_Compustat.load_compustat(data_dir=again), comp)
+
+
+def _naive_CRSP_indices(msf):
+    """Index returns and counts of `msf`, one record at a time. The value
+    weights are the market caps of the same PERMNO in the previous month.
+    """
+    months = sorted(msf["date"].unique())
+    previous_month = dict(zip(months[1:], months[:-1]))
+    cap = {}
+    for permno, date, altprc, shrout in zip(msf["permno"], msf["date"], msf["altprc"], msf["shrout"]):
+        cap[permno, date] = altprc * shrout
+    rows = {}
+    for permno, date, ret in zip(msf["permno"], msf["date"], msf["ret"]):
+        row = rows.setdefault(date, {"vw": 0.0, "usdval": 0.0, "ew": 0.0, "n_ret": 0, "totcnt": 0})
+        row["totcnt"] += 1
+        if np.isnan(ret):
+            continue
+        row["ew"] += ret
+        row["n_ret"] += 1
+        lag_cap = cap.get((permno, previous_month.get(date)), np.nan)
+        if not np.isnan(lag_cap):
+            row["vw"] += lag_cap * ret
+            row["usdval"] += lag_cap
+    return pd.DataFrame(
+        [
+            {
+                "caldt": date,
+                "vwretd": row["vw"] / row["usdval"] if row["usdval"] else np.nan,
+                "ewretd": row["ew"] / row["n_ret"] if row["n_ret"] else np.nan,
+                "totcnt": row["totcnt"],
+            }
+            for date, row in sorted(rows.items())
+        ]
+    )
+
+
+def test_naive_CRSP_indices_by_hand():
+    msf = pd.DataFrame(
+        {
+            "permno": [1, 1, 2, 2, 3],
+            "date": pd.to_datetime(["2000-01-31", "2000-02-29", "2000-01-31", "2000-02-29", "2000-02-29"]),
+            "ret": [np.nan, 0.10, 0.05, -0.20, 0.30],
+            "altprc": [10.0, 11.0, 20.0, 16.0, 5.0],
+            "shrout": [100.0, 100.0, 150.0, 150.0, 10.0],
+        }
+    )
+    idx = _naive_CRSP_indices(msf).set_index("caldt")
+    assert np.isnan(idx.loc["2000-01-31", "vwretd"])
+    assert idx.loc["2000-01-31", "ewretd"] == 0.05
+    # (1000 * 0.10 + 3000 * -0.20) / (1000 + 3000)
+    assert np.isclose(idx.loc["2000-02-29", "vwretd"], -0.125)
+    assert np.isclose(idx.loc["2000-02-29", "ewretd"], 0.2 / 3)
+    assert list(idx["totcnt"]) == [2, 3]
+
+
+def test_pipelines_run_on_synthetic_data(tmp_path):
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=400, start_year=2000, end_year=2010
+    )
+    vwret, vwret_n, ff_factors, ff_nfirms = calc_Fama_French_1993_factors.create_Fama_French_factors(
+        data_dir=tmp_path
+    )
+    assert ff_factors[["WSMB", "WHML"]].notna().all().all()
+    assert (ff_nfirms["TOTAL"] > 0).all()
+
+    df_msf = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path)
+    df_msix = load_CRSP_stock.load_CRSP_index_files(data_dir=tmp_path)
+    # The generated index file against the indices computed record by record
+    naive = _naive_CRSP_indices(df_msf).dropna(subset=["vwretd"])
+    msix = df_msix.set_index("caldt").loc[naive["caldt"]]
+    assert (msix["totcnt"].to_numpy() == naive["totcnt"].to_numpy()).all()
+    assert np.abs(msix["ewretd"].to_numpy() - naive["ewretd"].to_numpy()).max() < 1e-12
+    assert np.abs(msix["vwretd"].to_numpy() - naive["vwretd"].to_numpy()).max() < 1e-12
+
+    df = calc_CRSP_indices.calc_CRSP_indices_merge(df_msf, df_msix)
+    assert (df["totcnt"] == df["totcnt_manual"]).all()
+    assert (df["ewretd"] - df["ewretd_manual"]).abs().max() < 1e-12
+    assert (df["vwretd"] - df["vwretd_manual"]).abs().max() < 1e-12
+
+
+def test_pipelines_run_on_year_partitioned_datasets(tmp_path):
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=200, start_year=2000, end_year=2005
+    )
+    expected = calc_Fama_French_1993_factors.create_Fama_French_factors(data_dir=tmp_path)
+
+    # The layout of the streaming pulls (see pull_CRSP_Compustat)
+    datasets = tmp_path / "datasets"
+    (datasets / "pulled").mkdir(parents=True)
+    for file, date_col in [
+        ("Compustat.parquet", "datadate"),
+        ("CRSP_stock_ciz.parquet", "mthcaldt"),
+    ]:
+        df = pd.read_parquet(tmp_path / "pulled" / file)
+        misc_tools.write_parquet_dataset_by_year([df], datasets / "pulled" / file, date_col)
+        assert (datasets / "pulled" / file).is_dir()
+    (tmp_path / "pulled" / "CRSP_Comp_Link_Table.parquet").rename(
+        datasets / "pulled" / "CRSP_Comp_Link_Table.parquet"
+    )
+
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    for kwargs in [{"cache": cache}, {"cache": cache}, {"backend": "polars"}]:
+        outputs = calc_Fama_French_1993_factors.create_Fama_French_factors(
+            data_dir=datasets, **kwargs
+        )
+        for output, expected_output in zip(outputs, expected):
+            assert_frame_equal(output, expected_output)
+    assert sorted(cache.inspect()["name"]) == ["ccm_jun", "comp", "crsp2", "crsp3"]
@@ -0,0 +1,216 @@
+import pandas as pd
+import sqlalchemy as sa
+from pandas.testing import assert_frame_equal
+
+import generate_synthetic_data
+import load_CRSP_Compustat
+import load_CRSP_stock
+import misc_tools
+import wrds_pool
+
+
+def _sorted(df, by):
+    return df.sort_values(by, ignore_index=True)
+
+
+def _as_objects(df):
+    return df.astype({col: object for col in df.select_dtypes("category").columns})
+
+
+def test_streaming_pulls_match_in_memory_pulls(tmp_path):
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=200, start_year=2000, end_year=2005
+    )
+    crsp_file = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path)
+    comp_file = load_CRSP_Compustat.load_compustat(data_dir=tmp_path)
+    db_dir = generate_synthetic_data.write_sqlite_stand_in(data_dir=tmp_path)
+
+    pulled = tmp_path / "pulled"
+    db = generate_synthetic_data.connect_sqlite_stand_in(db_dir)
+    crsp = load_CRSP_Compustat.pull_CRSP_stock_ciz(db=db)
+    comp = load_CRSP_Compustat.pull_compustat(db=db)
+    # Replace the synthetic files with the streamed datasets
+    path = load_CRSP_Compustat.pull_CRSP_stock_ciz(
+        db=db, output_path=pulled / "CRSP_stock_ciz.parquet", chunksize=1000
+    )
+    load_CRSP_Compustat.pull_compustat(
+        db=db, output_path=pulled / "Compustat.parquet", chunksize=100
+    )
+    db.close()
+
+    # The stand-in returns the synthetic files
+    assert_frame_equal(crsp, crsp_file)
+    assert_frame_equal(comp, comp_file)
+
+    assert sorted(p.name for p in path.iterdir()) == [f"year={y}" for y in range(2000, 2006)]
+    assert len(list(path.glob("year=*/*.parquet"))) >= len(crsp) // 1000
+    crsp_streamed = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path)
+    assert_frame_equal(
+        _sorted(crsp_streamed, ["mthcaldt", "permno"]), _sorted(crsp, ["mthcaldt", "permno"])
+    )
+    comp_streamed = load_CRSP_Compustat.load_compustat(data_dir=tmp_path)
+    assert_frame_equal(
+        _sorted(comp_streamed, ["datadate", "gvkey"]), _sorted(comp, ["datadate", "gvkey"])
+    )
+
+
+def test_concurrent_pulls_share_a_connection_pool(tmp_path):
+    synthetic = tmp_path / "synthetic"
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=synthetic, n_firms=200, start_year=2000, end_year=2005
+    )
+    db_dir = generate_synthetic_data.write_sqlite_stand_in(data_dir=synthetic)
+    engine = generate_synthetic_data.sqlite_stand_in_engine(db_dir)
+    connections = []
+    sa.event.listen(engine, "connect", lambda dbapi_connection, record: connections.append(1))
+
+    with wrds_pool.ConnectionPool(engine=engine) as pool:
+        load_CRSP_Compustat.pull_CRSP_Compustat(
+            data_dir=tmp_path / "sequential", db=pool, max_workers=1
+        )
+        msix = load_CRSP_stock.pull_CRSP_index_files("2000-01-01", "2005-12-31", db=pool)
+        # The pulls reuse the first connection
+        assert len(connections) == 1
+        load_CRSP_Compustat.pull_CRSP_Compustat(
+            data_dir=tmp_path / "concurrent", db=pool, max_workers=4
+        )
+        assert len(connections) <= 4
+
+    assert_frame_equal(msix, load_CRSP_stock.load_CRSP_index_files(data_dir=synthetic))
+    for load, by in [
+        (load_CRSP_Compustat.load_compustat, ["datadate", "gvkey"]),
+        (load_CRSP_Compustat.load_CRSP_stock_ciz, ["mthcaldt", "permno"]),
+        (load_CRSP_Compustat.load_CRSP_Comp_Link_Table, ["gvkey", "linkdt"]),
+    ]:
+        expected = _sorted(load(data_dir=synthetic), by)
+        assert_frame_equal(_sorted(load(data_dir=tmp_path / "sequential"), by), expected)
+        assert_frame_equal(_sorted(load(data_dir=tmp_path / "concurrent"), by), expected)
+    ff = load_CRSP_Compustat.load_Fama_French_factors(data_dir=tmp_path / "concurrent")
+    assert (ff["date"] == msix["caldt"] + pd.offsets.MonthEnd(0)).all()
+
+
+def test_incremental_pull_replaces_rows_after_the_lookback(tmp_path):
+    synthetic = tmp_path / "synthetic"
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=synthetic, n_firms=200, start_year=2000, end_year=2005
+    )
+    db_dir = generate_synthetic_data.write_sqlite_stand_in(data_dir=synthetic)
+    path = tmp_path / "pulled" / "CRSP_stock_ciz.parquet"
+    by = ["mthcaldt", "permno"]
+    with wrds_pool.ConnectionPool(
+        engine=generate_synthetic_data.sqlite_stand_in_engine(db_dir)
+    ) as pool:
+        # Without stored data, everything is pulled
+        load_CRSP_Compustat.pull_CRSP_stock_ciz(db=pool, output_path=path, incremental=True)
+        stored = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path)
+        assert_frame_equal(
+            _sorted(stored, by), _sorted(load_CRSP_Compustat.pull_CRSP_stock_ciz(db=pool), by)
+        )
+
+        # Restate returns before and within the lookback, and add a month
+        with pool.connection() as db, db.connection.begin():
+            db.connection.exec_driver_sql(
+                "UPDATE crsp.msf_v2 SET mthret = 1.0 "
+                "WHERE mthcaldt < '2000-06-01' OR mthcaldt > '2005-06-01'"
+            )
+            new_month = db.raw_sql("SELECT * FROM crsp.msf_v2 WHERE mthcaldt > '2005-12-01'")
+            new_month["mthcaldt"] = "2006-01-31"
+            new_month.to_sql(
+                "msf_v2", db.connection, schema="crsp", if_exists="append", index=False
+            )
+
+        since = misc_tools.incremental_since(path, "mthcaldt", lookback_months=12)
+        load_CRSP_Compustat.pull_CRSP_stock_ciz(
+            db=pool, output_path=path, incremental=True, lookback_months=12
+        )
+        restated = load_CRSP_Compustat.pull_CRSP_stock_ciz(db=pool)
+
+    assert since == stored["mthcaldt"].max() - pd.DateOffset(months=12)
+    loaded = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path)
+    expected = pd.concat(
+        [stored[stored["mthcaldt"] < since], restated[restated["mthcaldt"] >= since]]
+    )
+    # The categories of the two pulls differ
+    assert_frame_equal(_sorted(_as_objects(loaded), by), _sorted(_as_objects(expected), by))
+    assert (loaded["mthcaldt"] == "2006-01-31").sum() == len(new_month) > 0
+    assert (loaded.loc[loaded["mthcaldt"] > "2005-06-01", "mthret"] == 1.0).all()
+    # Restatements before the lookback are not pulled
+    assert not (loaded.loc[loaded["mthcaldt"] < "2000-06-01", "mthret"] == 1.0).any()
+
+
+def test_incremental_pull_picks_up_months_after_the_end_date(tmp_path):
+    synthetic = tmp_path / "synthetic"
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=synthetic, n_firms=100, start_year=2020, end_year=2022
+    )
+    db_dir = generate_synthetic_data.write_sqlite_stand_in(data_dir=synthetic)
+    path = tmp_path / "pulled" / "CRSP_stock_ciz.parquet"
+    with wrds_pool.ConnectionPool(
+        engine=generate_synthetic_data.sqlite_stand_in_engine(db_dir)
+    ) as pool:
+        load_CRSP_Compustat.pull_CRSP_stock_ciz(db=pool, output_path=path)
+        stored = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path)
+        assert stored["jdate"].max() == pd.Timestamp("2022-12-31")
+
+        # A month published after the stored data and after config.END_DATE
+        with pool.connection() as db, db.connection.begin():
+            new_month = db.raw_sql("SELECT * FROM crsp.msf_v2 WHERE mthcaldt > '2022-12-01'")
+            new_month["mthcaldt"] = "2023-01-31"
+            new_month.to_sql(
+                "msf_v2", db.connection, schema="crsp", if_exists="append", index=False
+            )
+
+        # A full pull stops at config.END_DATE
+        full = load_CRSP_Compustat.pull_CRSP_stock_ciz(db=pool)
+        assert full["mthcaldt"].max() == stored["mthcaldt"].max()
+        load_CRSP_Compustat.pull_CRSP_stock_ciz(db=pool, output_path=path, incremental=True)
+
+    loaded = load_CRSP_Compustat.load_CRSP_stock_ciz(data_dir=tmp_path)
+    assert (loaded["mthcaldt"] == "2023-01-31").sum() == len(new_month) > 0
+    assert sorted(p.name for p in path.iterdir())[-1] == "year=2023"
+    assert len(loaded) == len(stored) + len(new_month)
+
+
+def test_incremental_monthly_file_pull_picks_up_months_after_the_end_date(tmp_path):
+    synthetic = tmp_path / "synthetic"
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=synthetic, n_firms=100, start_year=2020, end_year=2022
+    )
+    db_dir = generate_synthetic_data.write_sqlite_stand_in(data_dir=synthetic)
+    path = tmp_path / "pulled" / "CRSP_MSF_INDEX_INPUTS.parquet"
+    by = ["date", "permno"]
+    with wrds_pool.ConnectionPool(
+        engine=generate_synthetic_data.sqlite_stand_in_engine(db_dir)
+    ) as pool:
+        load_CRSP_stock.pull_CRSP_monthly_file(start_date="2020-01-01", db=pool, output_path=path)
+        stored = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path)
+        # The stand-in gives back the synthetic file
+        expected = load_CRSP_stock.load_CRSP_monthly_file(data_dir=synthetic)
+        assert_frame_equal(
+            _sorted(_as_objects(stored), by),
+            _sorted(_as_objects(expected[stored.columns]), by),
+            check_dtype=False,
+        )
+
+        # A month published after the stored data and after config.END_DATE
+        with pool.connection() as db, db.connection.begin():
+            for table, date_cols in [("msf", ["date"]), ("msenames", ["namedt", "nameendt"])]:
+                new_rows = db.raw_sql(
+                    f"SELECT * FROM crsp.{table} WHERE {date_cols[0]} > '2022-12-01'"
+                )
+                new_rows[date_cols] = "2023-01-31"
+                new_rows.to_sql(
+                    table, db.connection, schema="crsp", if_exists="append", index=False
+                )
+
+        # A full pull stops at config.END_DATE
+        full = load_CRSP_stock.pull_CRSP_monthly_file(start_date="2020-01-01", db=pool)
+        assert full["date"].max() == stored["date"].max()
+        load_CRSP_stock.pull_CRSP_monthly_file(
+            start_date="2020-01-01", db=pool, output_path=path, incremental=True
+        )
+
+    loaded = load_CRSP_stock.load_CRSP_monthly_file(data_dir=tmp_path)
+    n_new = (loaded["date"] == "2023-01-31").sum()
+    assert n_new == (stored["date"] == stored["date"].max()).sum() > 0
+    assert len(loaded) == len(stored) + n_new
@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import misc_tools
+
+
+def _example_panel():
+    return pd.DataFrame(
+        {
+            "permno": np.array([1, 1, 2, 2], dtype="int32"),
+            "date": pd.to_datetime(["2020-01-31", "2020-02-29", "2020-01-31", "2020-02-29"]),
+            "ret": [np.nan, 0.1, 0.2, -0.1],
+            "exchange": pd.Categorical(["N", "N", "Q", None]),
+            "name": ["A", "A", "B", "B"],
+        }
+    )
+
+
+def test_arrow_ipc_round_trip_is_zero_copy(tmp_path):
+    df = _example_panel()
+    path = misc_tools.save_arrow_ipc(df, tmp_path / "panel.arrow")
+    loaded = misc_tools.load_arrow_ipc(path)
+    assert_frame_equal(loaded, df)
+    # Numeric and date columns are read-only views of the mapped file,
+    # including float columns with missing values
+    for col in ["permno", "date", "ret"]:
+        assert not loaded[col].to_numpy().flags.writeable
+
+    subset = misc_tools.load_arrow_ipc(
+        path, columns=["permno", "ret"], filters=[("permno", "==", 2)]
+    )
+    assert_frame_equal(subset, df.loc[df["permno"] == 2, ["permno", "ret"]].reset_index(drop=True))
+
+
+def test_arrow_ipc_copy_is_rebuilt_when_parquet_changes(tmp_path):
+    parquet_path = tmp_path / "panel.parquet"
+    df = _example_panel()
+    df.to_parquet(parquet_path)
+    arrow_path = misc_tools.arrow_ipc_copy(parquet_path)
+    assert arrow_path == tmp_path / "panel.arrow"
+    assert_frame_equal(misc_tools.load_arrow_ipc(arrow_path), df)
+
+    df["ret"] = 0.0
+    df.to_parquet(parquet_path)
+    # Make the parquet file newer than the copy
+    mtime = arrow_path.stat().st_mtime + 10
+    os.utime(parquet_path, (mtime, mtime))
+    assert_frame_equal(misc_tools.load_arrow_ipc(misc_tools.arrow_ipc_copy(parquet_path)), df)
+    assert [p.name for p in tmp_path.iterdir() if p.name.startswith(".")] == []
+
+
+def test_lag_by_month_ordinal_skips_gaps():
+    df = pd.DataFrame(
+        {
+            "permno": [1, 1, 1, 2, 2, 2],
+            "date": pd.to_datetime(
+                ["2020-01-31", "2020-02-29", "2020-04-30", "2019-12-31", "2020-01-31", None]
+            ),
+            "me": [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+        }
+    )
+    month = misc_tools.calc_month_ordinal(df["date"])
+    assert month.tolist()[:2] == [2020 * 12, 2020 * 12 + 1] and month[-1] == -1
+
+    expected = [np.nan, 1.0, np.nan, np.nan, 4.0, np.nan]
+    lagged = misc_tools.lag_by_month_ordinal(df["permno"], month, df["me"])
+    np.testing.assert_array_equal(lagged, expected)
+    # groupby().shift() takes the stale February value for April
+    assert df.groupby("permno")["me"].shift(1).iloc[2] == 2.0
+
+    # Shuffled rows give the same values
+    shuffled = df.sample(frac=1, random_state=0)
+    lagged = misc_tools.lag_by_month_ordinal(
+        shuffled["permno"], misc_tools.calc_month_ordinal(shuffled["date"]), shuffled["me"]
+    )
+    np.testing.assert_array_equal(lagged, np.array(expected)[shuffled.index])
+
+    # Leads and longer lags
+    np.testing.assert_array_equal(
+        misc_tools.lag_by_month_ordinal(df["permno"], month, df["me"], lag=-1),
+        [2.0, np.nan, np.nan, 5.0, np.nan, np.nan],
+    )
+    np.testing.assert_array_equal(
+        misc_tools.lag_by_month_ordinal(df["permno"], month, df["me"], lag=2),
+        [np.nan, np.nan, 2.0, np.nan, np.nan, np.nan],
+    )
+
+
+def test_write_parquet_dataset_by_year_unifies_chunk_types(tmp_path):
+    df = _example_panel()
+    df["date"] = pd.to_datetime(["2019-12-31", "2020-01-31", "2019-12-31", "2020-01-31"])
+    df["note"] = [None, None, "x", None]
+    df["count"] = [1, 2, 3, 4]
+    chunks = [df.iloc[:2], df.iloc[2:].assign(count=[3.5, np.nan])]
+    path = tmp_path / "panel.parquet"
+    df.to_parquet(path)
+    assert misc_tools.write_parquet_dataset_by_year(chunks, path, "date") == path
+    assert sorted(p.relative_to(path).as_posix() for p in path.glob("*/*")) == [
+        "year=2019/part-0.parquet",
+        "year=2019/part-1.parquet",
+        "year=2020/part-0.parquet",
+        "year=2020/part-1.parquet",
+    ]
+
+    loaded = pd.read_parquet(path)
+    # The first chunk had no notes and integer counts
+    expected = df.assign(exchange=df["exchange"].astype(object), count=[1, 2, 3.5, np.nan])
+    expected = expected.sort_values("date", kind="stable", ignore_index=True)
+    assert_frame_equal(loaded.drop(columns="year"), expected)
+    assert loaded["year"].astype(int).tolist() == [2019, 2019, 2020, 2020]
+    assert [p.name for p in tmp_path.iterdir()] == ["panel.parquet"]
+
+
+def test_write_parquet_dataset_by_year_since_replaces_recent_rows(tmp_path):
+    dates = pd.to_datetime(["2019-06-30", "2019-12-31", "2020-01-31", "2020-06-30"])
+    stored = pd.DataFrame({"id": [1, 1, 1, 2], "date": dates, "x": [1.0, 2.0, 3.0, 4.0]})
+    path = misc_tools.write_parquet_dataset_by_year([stored], tmp_path / "panel", "date")
+    assert misc_tools.incremental_since(path, "date") == pd.Timestamp("2020-06-30")
+    since = misc_tools.incremental_since(path, "date", lookback_months=5)
+    assert since == pd.Timestamp("2020-01-30")
+    assert misc_tools.incremental_since(tmp_path / "missing", "date") is None
+    kept = path / "year=2019" / "part-0.parquet"
+    inode = kept.stat().st_ino
+
+    # From 2020-01-30: a restated value, a row deleted and a new year
+    update = pd.DataFrame(
+        {"id": [1, 1], "date": pd.to_datetime(["2020-01-31", "2021-01-31"]), "x": [3.5, 5.0]}
+    )
+    misc_tools.write_parquet_dataset_by_year([update], path, "date", since=since)
+    loaded = pd.read_parquet(path).drop(columns="year")
+    expected = pd.concat([stored.iloc[:2], update], ignore_index=True)
+    assert_frame_equal(loaded.sort_values("date", ignore_index=True), expected)
+    # The partitions before the year of `since` are not rewritten
+    assert kept.stat().st_ino == inode
+    assert [p.name for p in tmp_path.iterdir()] == ["panel"]
@@ -0,0 +1,117 @@
+import inspect
+
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+import load_CRSP_Compustat
+import misc_tools
+import stage_cache
+
+calls = []
+
+
+def double_values(df, factor=2):
+    calls.append(factor)
+    return df.assign(x=df["x"] * factor)
+
+
+SCALE = 2
+
+
+def scale(df):
+    return df * SCALE
+
+
+def scale_twice(df):
+    return scale(scale(df))
+
+
+def scale_stage(df):
+    return scale_twice(df)
+
+
+def split_rows(df):
+    return df.iloc[:1], df.iloc[1:]
+
+
+def test_run_skips_stage_when_key_matches(tmp_path):
+    calls.clear()
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    df = pd.DataFrame({"x": [1.0, 2.0, 3.0]})
+
+    first, key = cache.run("double", double_values, df)
+    second, key_again = cache.run("double", double_values, df)
+    assert key == key_again
+    assert calls == [2]
+    assert_frame_equal(first, second)
+    assert_frame_equal(second, pd.DataFrame({"x": [2.0, 4.0, 6.0]}))
+
+    # Parameters and upstream keys are part of the key
+    _, key_factor = cache.run("double", double_values, df, factor=3)
+    _, key_upstream = cache.run("double", double_values, df, upstream=["abc"])
+    assert len({key, key_factor, key_upstream}) == 3
+    assert calls == [2, 3, 2]
+
+    (head, tail), _ = cache.run("split", split_rows, df)
+    (head_cached, tail_cached), _ = cache.run("split", split_rows, df)
+    assert_frame_equal(head, head_cached)
+    assert_frame_equal(tail, tail_cached)
+
+
+def test_input_file_contents_change_key(tmp_path):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    path = tmp_path / "input.parquet"
+    pd.DataFrame({"x": [1.0]}).to_parquet(path)
+    key = cache.stage_key("load", pd.read_parquet, input_files=[path])
+    assert key == cache.stage_key("load", pd.read_parquet, input_files=[path])
+
+    pd.DataFrame({"x": [2.0]}).to_parquet(path)
+    assert key != cache.stage_key("load", pd.read_parquet, input_files=[path])
+
+
+def test_eviction_inspect_and_clear(tmp_path):
+    cache = stage_cache.StageCache(tmp_path / "cache")
+    df = pd.DataFrame({"x": range(1000)}, dtype=float)
+    for factor in [1, 2, 3]:
+        cache.run("double", double_values, df, factor=factor)
+    entries = cache.inspect()
+    assert entries["name"].tolist() == ["double"] * 3
+    entry_bytes = entries["n_bytes"].max()
+
+    # Reading the oldest entry makes it the most recently used one, so
+    # the entry of factor 2 is evicted first.
+    _, key_1 = cache.run("double", double_values, df, factor=1)
+    _, key_3 = cache.run("double", double_values, df, factor=3)
+    cache.max_bytes = 2 * entry_bytes
+    removed = cache.evict()
+    assert len(removed) == 1
+    assert set(cache.inspect()["key"]) == {key_1, key_3}
+
+    cache.run("split", split_rows, df)
+    cache.clear("double")
+    assert cache.inspect()["name"].tolist() == ["split"]
+    cache.clear()
+    assert cache.inspect().empty
+
+
+def test_run_stage_without_cache():
+    df = pd.DataFrame({"x": [1.0]})
+    result, key = stage_cache.run_stage(None, "double", double_values, df, factor=3)
+    assert key is None
+    assert result["x"].tolist() == [3.0]
+
+
+def test_function_sources_follow_callees_and_constants():
+    sources = stage_cache.function_sources(scale_stage)
+    assert inspect.getsource(scale) in sources
+    assert "SCALE = 2" in sources
+
+    # Functions and schemas of other modules of the repository
+    sources = stage_cache.function_sources(load_CRSP_Compustat.load_CRSP_stock_ciz)
+    assert inspect.getsource(misc_tools.apply_dtype_schema) in sources
+    assert any(s.startswith("schema_crsp = {") for s in sources)
+    assert any(s.startswith("COMMON_STOCK_AND_EXCHANGE_FILTERS = [") for s in sources)
+
+    # Third-party functions are not followed
+    assert stage_cache.function_sources(pd.read_parquet) == [inspect.getsource(pd.read_parquet)]
+    assert not any("class Substitution" in s for s in sources)
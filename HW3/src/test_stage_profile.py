@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+import calc_Fama_French_1993_factors
+import generate_synthetic_data
+import stage_profile
+
+
+@stage_profile.profile_stage
+def allocate_and_filter(df, n_bytes=0):
+    buffer = np.ones(n_bytes // 8)
+    return df[df["x"] > 1], buffer.sum()
+
+
+def test_profile_stage_records_calls(monkeypatch, tmp_path):
+    df = pd.DataFrame({"x": [1, 2, 3]})
+    # Disabled: nothing is recorded
+    stage_profile.start_run("toy")
+    allocate_and_filter(df)
+    assert stage_profile.write_run_log(tmp_path) is None
+
+    monkeypatch.setattr(stage_profile, "ENABLED", True)
+    stage_profile.start_run("toy")
+    allocate_and_filter(df, n_bytes=200 * 2**20)
+    allocate_and_filter(df.iloc[:2])
+    records = stage_profile.stage_records()
+    assert records["stage"].tolist() == ["allocate_and_filter"] * 2
+    assert records["call"].tolist() == [0, 1]
+    assert records["rows_in"].tolist() == [[3], [2]]
+    assert records["rows_out"].tolist() == [[2], [1]]
+    assert records.loc[0, "peak_rss_delta_mb"] >= 150
+    assert (records["wall_s"] >= 0).all() and (records["cpu_s"] >= 0).all()
+
+    path = stage_profile.write_run_log(tmp_path)
+    assert path.name.startswith("toy_") and path.suffix == ".json"
+    diff = stage_profile.diff_run_logs(path, path)
+    assert np.allclose(diff["wall_ratio"].dropna(), 1.0)
+
+
+def test_profile_stage_without_rss(monkeypatch, tmp_path):
+    # As on Windows, without /proc and the resource module
+    def no_proc(*args, **kwargs):
+        raise OSError
+
+    monkeypatch.setattr(stage_profile, "open", no_proc, raising=False)
+    monkeypatch.setattr(stage_profile, "resource", None)
+    monkeypatch.setattr(stage_profile, "ENABLED", True)
+    stage_profile.start_run("toy")
+    allocate_and_filter(pd.DataFrame({"x": [1, 2, 3]}))
+    records = stage_profile.stage_records()
+    assert records["rows_out"].tolist() == [[2]]
+    assert records[["rss_before_mb", "peak_rss_delta_mb"]].isna().all().all()
+    assert stage_profile.write_run_log(tmp_path) is not None
+
+
+def test_factor_pipeline_run_log(monkeypatch, tmp_path):
+    generate_synthetic_data.write_synthetic_data(
+        data_dir=tmp_path, n_firms=200, start_year=2000, end_year=2005
+    )
+    monkeypatch.setattr(stage_profile, "ENABLED", True)
+    monkeypatch.setattr(stage_profile, "PROFILE_DIR", tmp_path / "profiles")
+    calc_Fama_French_1993_factors.create_Fama_French_factors(data_dir=tmp_path)
+
+    (path,) = (tmp_path / "profiles").glob("create_Fama_French_factors_*.json")
+    records = stage_profile.read_run_log(path)
+    assert records["stage"].tolist() == [
+        "calc_book_equity_and_years_in_compustat",
+        "subset_CRSP_to_common_stock_and_exchanges",
+        "calculate_market_equity",
+        "use_dec_market_equity",
+        "merge_CRSP_and_Compustat",
+        "calc_june_portfolio_assignments",
+        "merge_june_portfolio_assignments",
+        "create_fama_french_portfolios",
+        "create_factors_from_portfolios",
+    ]
+    # Output rows of a stage are input rows of the next one
+    crsp_rows = records.set_index("stage")["rows_out"]
+    assert records.set_index("stage").loc["calculate_market_equity", "rows_in"] == crsp_rows[
+        "subset_CRSP_to_common_stock_and_exchanges"
+    ]
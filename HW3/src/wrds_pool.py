@@ -0,0 +1,122 @@
+"""
+A pool of connections to the WRDS database shared by the pull functions
+of `load_CRSP_stock.py` and `load_CRSP_Compustat.py`.
+
+Creating a `wrds.Connection` looks up the credentials (the .pgpass file,
+or a prompt for the username and password) and opens a new connection
+to the server. `ConnectionPool` does this once and then hands out
+connections from the pool of its SQLAlchemy engine: pulls run one after
+the other reuse the same server connection, and pulls run at the same
+time (see `pull_concurrently`) each check out their own, so that their
+network I/O overlaps.
+
+Every pull function takes a `db` argument, resolved by `connect`:
+
+>>> with ConnectionPool(wrds_username=WRDS_USERNAME) as pool:
+...     comp = load_CRSP_Compustat.pull_compustat(db=pool)
+...     results = pull_concurrently(
+...         {
+...             "ccm": (load_CRSP_Compustat.pull_CRSP_Comp_Link_Table, {}),
+...             "ff": (load_CRSP_Compustat.pull_Fama_French_factors, {}),
+...         },
+...         db=pool,
+...     )
+
+A pool can also wrap any SQLAlchemy engine, such as the SQLite stand-in
+of `generate_synthetic_data.sqlite_stand_in_engine`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import wrds
+
+import config
+
+WRDS_USERNAME = config.WRDS_USERNAME
+WRDS_MAX_CONNECTIONS = config.WRDS_MAX_CONNECTIONS
+
+
+class ConnectionPool:
+    """Connections to WRDS (or to the database of `engine`) checked out
+    by `connection` and returned to the pool after use.
+
+    The server connection opened by `wrds.Connection` to check the
+    credentials is the first connection of the pool. `close` closes the
+    connections of the pool.
+    """
+
+    def __init__(self, wrds_username=WRDS_USERNAME, engine=None):
+        if engine is None:
+            db = wrds.Connection(wrds_username=wrds_username)
+            engine = db.engine
+            # Returned to the pool of the engine, for the first checkout
+            db.connection.close()
+        self.engine = engine
+
+    @contextmanager
+    def connection(self):
+        """A `wrds.Connection` on a connection checked out of the pool,
+        returned to the pool on exit. Do not call its `close` method,
+        which would close the pool.
+        """
+        db = wrds.Connection(autoconnect=False)
+        db.engine = self.engine
+        db.connection = self.engine.connect()
+        try:
+            yield db
+        finally:
+            db.connection.close()
+
+    def close(self):
+        self.engine.dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@contextmanager
+def connect(db=None, wrds_username=WRDS_USERNAME):
+    """The `wrds.Connection` that a pull function uses for its `db`
+    argument:
+
+     - None: a new `wrds.Connection`, closed on exit;
+     - a `ConnectionPool`: a connection checked out of the pool, returned
+       to it on exit;
+     - an open `wrds.Connection`: itself, left open.
+    """
+    if db is None:
+        with wrds.Connection(wrds_username=wrds_username) as db:
+            yield db
+    elif isinstance(db, ConnectionPool):
+        with db.connection() as connection:
+            yield connection
+    else:
+        yield db
+
+
+def pull_concurrently(pulls, db=None, max_workers=WRDS_MAX_CONNECTIONS):
+    """Run independent pulls in a pool of `max_workers` threads and return
+    their results in a dictionary with the keys of `pulls`.
+
+    `pulls` maps names to `(pull_function, kwargs)`, and each pull is
+    called as `pull_function(db=db, **kwargs)`. With a `ConnectionPool`
+    as `db` (by default, a pool is opened and closed), each running pull
+    checks out its own connection, so at most `max_workers` connections
+    are open at a time. With `max_workers=1`, the pulls run one after the
+    other on a single connection. The first exception raised by a pull is
+    raised once the running pulls complete.
+    """
+    pool = ConnectionPool() if db is None else db
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(pull_function, db=pool, **kwargs)
+                for name, (pull_function, kwargs) in pulls.items()
+            }
+        return {name: future.result() for name, future in futures.items()}
+    finally:
+        if db is None:
+            pool.close()